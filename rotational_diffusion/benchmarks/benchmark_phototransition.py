@@ -0,0 +1,59 @@
+import copy
+import time
+
+from rotational_diffusion.src import np
+from rotational_diffusion.src import fluorophore
+
+## User variables:
+NUM_MOLECULES = 10**6                            # population size
+FRACTIONS = [1, 0.1, 0.01, 0.001]                # fraction of it in the initial state
+NUM_REPEATS = 5                                  # best-of, per fraction and method
+METHODS = ('mask', 'index', 'buckets')
+
+
+def masked_phototransition(c, initial_state, final_state, intensity=1, polarization_xyz=(0, 0, 1)):
+    """The original phototransition: a full-length boolean mask, and
+    chained gathers and write-backs through it. Kept for comparison."""
+    initial_state = c.state_info[initial_state].state_num
+    final_states, lifetimes = c.state_info.get_state_num_and_lifetime(final_state)
+    px, py, pz = np.sqrt(intensity) * np.asarray(polarization_xyz, 'float')
+    o = c.orientations
+    i = (c.states == initial_state)
+    effective_intensity = (px*o.x[i] + py*o.y[i] + pz*o.z[i])**2
+    selection_prob = 1 - 2**(-effective_intensity)
+    selected = c.rng.uniform(0, 1, len(selection_prob)) <= selection_prob
+    t = o.t_rel[i][selected]
+    tr_t = c.transition_times_rel[i]
+    c.states[i] = np.where(selected, final_states, c.states[i])
+    tr_t[selected] = t + c.rng.exponential(lifetimes, t.shape)
+    c.transition_times_rel[i] = tr_t
+
+
+## Benchmark:
+# Like a triplet->singlet trigger: most of the population is in one
+# state, and the pulse only acts on a small fraction in another:
+ground = fluorophore.ElectronicState('ground')
+triplet = fluorophore.ElectronicState('triplet')
+state_info = fluorophore.PossibleStates(ground)
+state_info.add_state(triplet)
+for fraction in FRACTIONS:
+    states = np.full(NUM_MOLECULES, ground.state_num, dtype='uint8')
+    states[:int(fraction * NUM_MOLECULES)] = triplet.state_num
+    timings = {}
+    for method in METHODS:
+        original = fluorophore.FluorophoreCollection(
+            NUM_MOLECULES, 1000, state_info, state_buckets=(method == 'buckets'))
+        original.states = states  # Assigned whole, so buckets are rebuilt
+        best = np.inf
+        for _ in range(NUM_REPEATS):
+            c = copy.deepcopy(original)
+            start = time.perf_counter()
+            if method == 'mask':
+                masked_phototransition(c, 'triplet', 'ground', intensity=0.25)
+            else:
+                c.phototransition('triplet', 'ground', intensity=0.25)
+            best = min(best, time.perf_counter() - start)
+        timings[method] = best
+    print(f"{fraction:>6.1%} in the initial state: " +
+          ", ".join(f"{method} {1e3*t:6.2f} ms" for method, t in timings.items()) +
+          f" ({timings['mask'] / timings['index']:.1f}x, {timings['mask'] / timings['buckets']:.1f}x)")
@@ -0,0 +1,31 @@
+import time
+
+from rotational_diffusion.src import np
+from rotational_diffusion.src.utils import general
+
+## User variables:
+NUM_MOLECULES = [10**4, 10**5, 10**6, 10**7]    # sizes to benchmark
+NUM_REPEATS = 5                                  # best-of, per size and method
+METHODS = ('naive', 'accurate', 'tangent')
+
+## Benchmark:
+# Random orientations, with a few percent near the south pole, where
+# 'accurate' has to patch things up with a masked subset:
+for n in NUM_MOLECULES:
+    cos_th = np.random.uniform(-1, 1, n)
+    sin_ph, cos_ph = general.sin_cos(np.random.uniform(0, 2*np.pi, n), '0,2pi')
+    x = np.sqrt(1 - cos_th*cos_th) * cos_ph
+    y = np.sqrt(1 - cos_th*cos_th) * sin_ph
+    z = cos_th
+    theta_d = np.random.uniform(0, 0.5, n)
+    phi_d = np.random.uniform(0, 2*np.pi, n)
+    timings = {}
+    for method in METHODS:
+        best = np.inf
+        for _ in range(NUM_REPEATS):
+            start = time.perf_counter()
+            general.polar_displacement(x, y, z, theta_d, phi_d, method=method)
+            best = min(best, time.perf_counter() - start)
+        timings[method] = best
+    print(f"{n:>9d} molecules: " +
+          ", ".join(f"{method} {1e9*t/n:5.1f} ns/molecule" for method, t in timings.items()))
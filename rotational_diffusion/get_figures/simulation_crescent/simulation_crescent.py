@@ -4,12 +4,17 @@ from dataclasses import dataclass
 from datetime import datetime
 import os
 
-from rotational_diffusion.src import np, fluorophore  # for GPU-agnosticism
+import numpy
+
+from rotational_diffusion.src import np, backends, fluorophore  # for GPU-agnosticism
 from rotational_diffusion.src.utils.base_logger import logger       # for logging progress
 
 ## User variables
 NUM_MOLECULES = 2E07               # default 2E07,      Decrease = faster, noisier
 EXPERIMENTAL_REPETITIONS = 10      # default 10,        Decrease = faster, noisier
+SEED = None                        # default None,      Set an int to reproduce a run exactly
+WEIGHTED = False                   # default False,     True = less noise per molecule simulated
+RECORD_ONLY_MEASURED = True        # default True,      False = keep every transition (more memory)
 
 
 ## Define our fluorophore's properties
@@ -23,6 +28,13 @@ class mScarlet:
 ## Create excitation scheme
 def run_crescent_scheme(fluorophores, fluorophore_properties, laser_properties, collection_time_point_ns):
     total_run_time = 0
+    if fluorophores.weighted:
+        # Declare the pulses to come, so pulses with only one useful
+        # outcome weigh molecules instead of sampling them
+        pulses = [('ground', 'singlet'), ('triplet', 'singlet')]
+        if laser_properties.crescent_laser.intensity > 0:
+            pulses.insert(1, ('triplet', 'singlet'))
+        fluorophores.declare_measurements([('singlet', 'ground')], pulses)
 
     # excite molecules to singlet state
     fluorophores.phototransition(
@@ -80,16 +92,21 @@ def run_crescent_scheme(fluorophores, fluorophore_properties, laser_properties,
 
 ## Store the sample properties
 class SampleProperties:
-    def __init__(self, fluorescent_molecule, num_molecules, rdt, fluorophore_state_info):
+    def __init__(self, fluorescent_molecule, num_molecules, rdt, fluorophore_state_info, seed=None):
         self.fluorescent_molecule = fluorescent_molecule
         self.num_molecules = num_molecules
         self.rdt = rdt
         self.rdt_unpied = self.rdt / np.pi
         self.state_info = fluorophore_state_info
+        # Recorded, so the initial orientations can be reproduced:
+        seed = backends.seed_sequence(seed)
+        self.seed, self.seed_spawn_key = seed.entropy, seed.spawn_key
         self.fluorophore_holder = fluorophore.FluorophoreCollection(
             num_molecules=self.num_molecules,
             state_info=self.state_info,
-            rot_diffusion_time=self.rdt
+            rot_diffusion_time=self.rdt,
+            rng=seed,
+            weighted=WEIGHTED,
         )
 
 
@@ -116,10 +133,15 @@ class Experiment:
                  sample: SampleProperties,
                  excitation_props: ExcitationProperties,
                  collection_time_point_ns: float,
-                 repetitions):
+                 repetitions,
+                 seed=None):
         self.sample = sample
         self.excitation_props = excitation_props
         self.repetitions = repetitions
+        # Each repetition draws from its own child of 'seed'. Recorded
+        # with each row, so any result can be reproduced:
+        seed = backends.seed_sequence(seed)
+        self.seed, self.seed_spawn_key = seed.entropy, seed.spawn_key
 
         self.collection_time_point = collection_time_point_ns
 
@@ -143,9 +165,17 @@ class Experiment:
         photons_x = []
         photons_y = []
         total_photons = []
-        for rep_num in range(self.repetitions):
+        repetition_seeds = numpy.random.SeedSequence(
+            self.seed, spawn_key=self.seed_spawn_key).spawn(self.repetitions)
+        for rep_num, repetition_seed in enumerate(repetition_seeds):
             # Clone original properties since it will change throughout the course of the experiment
             sample_copy = copy.deepcopy(self.sample)
+            # ...and give the clone (and the detector) its own random numbers
+            collection_seed, detector_seed = repetition_seed.spawn(2)
+            sample_copy.fluorophore_holder.reseed(collection_seed)
+            # ...and only record the transition we measure
+            if RECORD_ONLY_MEASURED:
+                sample_copy.fluorophore_holder.subscribe('singlet', 'ground', fields=('x', 'y', 't'))
 
             # Log progress
             rep_percentage = round(rep_num / self.repetitions * 100)
@@ -164,7 +194,8 @@ class Experiment:
             counts_tuple = self.get_detector_counts(
                 sample_copy.fluorophore_holder,
                 'singlet', 'ground',
-                collection_times[0][1:]
+                collection_times[0][1:],
+                backends.get().generator(detector_seed),
             )
             ratio_outputs.append(counts_tuple[0])
             photons_x.append(counts_tuple[1])
@@ -182,7 +213,14 @@ class Experiment:
         self.total_photons_std = np.nanstd(np.array(total_photons))
 
     @staticmethod
-    def get_detector_counts(fluorophores, from_state, to_state, collection_times):
+    def get_detector_counts(fluorophores, from_state, to_state, collection_times, rng=np.random):
+        if fluorophores.weighted:
+            # Add up each photon's chance of reaching each channel (and
+            # each molecule's weight), rather than flipping coins
+            _, photons_x, photons_y = fluorophores.get_expected_counts(from_state, to_state, collection_times)
+            ratio_xy = np.nan if photons_y <= 0 else photons_x / photons_y
+            return ratio_xy, photons_x, photons_y, photons_x + photons_y
+
         x, y, _, t, = fluorophores.get_xyzt_at_transitions(from_state, to_state)
 
         t_gated = t[(t >= collection_times[0]) & (t <= collection_times[1])]
@@ -190,7 +228,7 @@ class Experiment:
         y_gated = y[(t >= collection_times[0]) & (t <= collection_times[1])]
 
         p_x, p_y = x_gated ** 2, y_gated ** 2
-        r = np.random.uniform(0, 1, size=len(t_gated))
+        r = rng.uniform(0, 1, size=len(t_gated))
         in_channel_x = (r < p_x)
         in_channel_y = (p_x <= r) & (r < p_x + p_y)
         t_x, t_y = t_gated[in_channel_x], t_gated[in_channel_y]
@@ -302,6 +340,9 @@ def run():
     ## Define some collection time points
     collection_times_ns = np.linspace(10000, 1E6, num=100).tolist()
 
+    # Every sample and experiment gets its own child of this
+    seeds = numpy.random.SeedSequence(SEED)
+
     # Run the multi-variate simulation
     for crescent_num, crescent_intensity in enumerate(crescent_intensities):
         for sample_num, rotational_diffusion_time in enumerate(rotational_diffusion_times):
@@ -309,11 +350,13 @@ def run():
                 logger.info(f'\nSample \t\t\t\t\t\t{sample_num + 1} of {len(rotational_diffusion_times)}\n'
                             f'Crescent intensity \t\t{crescent_num + 1} of {len(crescent_intensities)}\n'
                             f'Collection \t\t\t\t{collection_num + 1} of {len(collection_times_ns)}\n')
+                sample_seed, experiment_seed = seeds.spawn(2)
                 sample = SampleProperties(
                     fluorescent_molecule=fluorophore_molecule,
                     num_molecules=NUM_MOLECULES,
                     rdt=rotational_diffusion_time,
                     fluorophore_state_info=state_info,
+                    seed=sample_seed,
                 )
 
                 excitation_laser = LaserProperties(
@@ -337,7 +380,8 @@ def run():
                     sample=sample,
                     excitation_props=excitation_properties,
                     collection_time_point_ns=collection_time_point_ns,
-                    repetitions=EXPERIMENTAL_REPETITIONS
+                    repetitions=EXPERIMENTAL_REPETITIONS,
+                    seed=experiment_seed,
                 )
                 experiment.run_experiment()
                 experiment.csv_save(csv_path)
@@ -4,12 +4,19 @@ from dataclasses import dataclass
 from datetime import datetime
 import os
 
-from rotational_diffusion.src import np, fluorophore  # for GPU-agnosticism
+import numpy
+
+from rotational_diffusion.src import np, backends, fluorophore  # for GPU-agnosticism
+from rotational_diffusion.src.detectors import PolarizationDetector
 from rotational_diffusion.src.utils.base_logger import logger
 
 ## User variables
 NUM_MOLECULES = 1E05  # Decrease = faster, noisier
 EXPERIMENTAL_REPETITIONS = 4  # Decrease = faster, noisier
+SEED = None  # Set an int to reproduce a run exactly
+WEIGHTED = False  # True = less noise per molecule simulated
+RECORD_ONLY_MEASURED = True  # False = keep every transition (more memory)
+STREAMING_DETECTOR = False  # True = count photons as they happen (flat memory)
 
 
 ## Define our fluorophore
@@ -56,16 +63,21 @@ def run_photoswitch_scheme(fluorophores, laser_properties, collection_time_ns=1E
 
 ## Store the sample properties
 class SampleProperties:
-    def __init__(self, fluorescent_molecule, num_molecules, rdt, fluorophore_state_info):
+    def __init__(self, fluorescent_molecule, num_molecules, rdt, fluorophore_state_info, seed=None):
         self.fluorescent_molecule = fluorescent_molecule
         self.num_molecules = num_molecules
         self.rdt = rdt
         self.rdt_unpied = self.rdt / np.pi
         self.state_info = fluorophore_state_info
+        # Recorded, so the initial orientations can be reproduced:
+        seed = backends.seed_sequence(seed)
+        self.seed, self.seed_spawn_key = seed.entropy, seed.spawn_key
         self.fluorophore_holder = fluorophore.FluorophoreCollection(
             num_molecules=self.num_molecules,
             state_info=self.state_info,
-            rot_diffusion_time=self.rdt
+            rot_diffusion_time=self.rdt,
+            rng=seed,
+            weighted=WEIGHTED,
         )
 
 
@@ -77,10 +89,14 @@ class LaserProperties:
 
 
 class Experiment:
-    def __init__(self, sample: SampleProperties, excitation_props: LaserProperties, repetitions):
+    def __init__(self, sample: SampleProperties, excitation_props: LaserProperties, repetitions, seed=None):
         self.sample = sample
         self.excitation_props = excitation_props
         self.repetitions = repetitions
+        # Each repetition draws from its own child of 'seed'. Recorded
+        # with each row, so any result can be reproduced:
+        seed = backends.seed_sequence(seed)
+        self.seed, self.seed_spawn_key = seed.entropy, seed.spawn_key
 
         self.photons_x_mean = 0
         self.photons_x_std = 0
@@ -102,9 +118,22 @@ class Experiment:
         photons_x = []
         photons_y = []
         total_photons = []
-        for rep_num in range(self.repetitions):
+        repetition_seeds = numpy.random.SeedSequence(
+            self.seed, spawn_key=self.seed_spawn_key).spawn(self.repetitions)
+        for rep_num, repetition_seed in enumerate(repetition_seeds):
             # Clone original properties since it will change throughout the course of the experiment
             sample_copy = copy.deepcopy(self.sample)
+            # ...and give the clone (and the detector) its own random numbers
+            collection_seed, detector_seed = repetition_seed.spawn(2)
+            sample_copy.fluorophore_holder.reseed(collection_seed)
+            # ...and only record the transition we measure
+            if STREAMING_DETECTOR:
+                # ...or don't even record it, and count its photons as they happen
+                detector = PolarizationDetector('excited', 'ground', rng=detector_seed)
+                sample_copy.fluorophore_holder.attach(detector)
+                sample_copy.fluorophore_holder.subscribe('excited', 'ground', collection_times=[])
+            elif RECORD_ONLY_MEASURED:
+                sample_copy.fluorophore_holder.subscribe('excited', 'ground', fields=('x', 'y', 't'))
 
             # Log progress
             rep_percentage = round(rep_num / self.repetitions * 100)
@@ -118,10 +147,14 @@ class Experiment:
             )
 
             # Get the number of photons emitted in each channel
-            counts_tuple = self.get_detector_counts(
-                sample_copy.fluorophore_holder,
-                'excited', 'ground'
-            )
+            if STREAMING_DETECTOR:
+                counts_tuple = detector.counts()
+            else:
+                counts_tuple = self.get_detector_counts(
+                    sample_copy.fluorophore_holder,
+                    'excited', 'ground',
+                    backends.get().generator(detector_seed),
+                )
             ratio_outputs.append(counts_tuple[0])
             photons_x.append(counts_tuple[1])
             photons_y.append(counts_tuple[2])
@@ -138,11 +171,18 @@ class Experiment:
         self.total_photons_std = np.nanstd(np.array(total_photons))
 
     @staticmethod
-    def get_detector_counts(fluorophores, from_state, to_state):
+    def get_detector_counts(fluorophores, from_state, to_state, rng=np.random):
+        if fluorophores.weighted:
+            # Add up each photon's chance of reaching each channel (and
+            # each molecule's weight), rather than flipping coins
+            _, photons_x, photons_y = fluorophores.get_expected_counts(from_state, to_state)
+            ratio_xy = np.nan if photons_y <= 0 else photons_x / photons_y
+            return ratio_xy, photons_x, photons_y, photons_x + photons_y
+
         x, y, _, t, = fluorophores.get_xyzt_at_transitions(from_state, to_state)
 
         p_x, p_y = x ** 2, y ** 2
-        r = np.random.uniform(0, 1, size=len(t))
+        r = rng.uniform(0, 1, size=len(t))
         in_channel_x = (r < p_x)
         in_channel_y = (p_x <= r) & (r < p_x + p_y)
         t_x, t_y = t[in_channel_x], t[in_channel_y]
@@ -230,16 +270,21 @@ def run():
     excitation_intensities = [0.002, 0.010, 0.05, 0.25, 1.25, 6.25]
     excitation_polarization = (1, 0, 0)
 
+    # Every sample and experiment gets its own child of this
+    seeds = numpy.random.SeedSequence(SEED)
+
     # Run the multi-variate simulation
     for excitation_num, excitation_intensity in enumerate(excitation_intensities):
         for sample_num, rotational_diffusion_time in enumerate(rotational_diffusion_times):
             logger.info(f'\nSample \t\t\t\t\t\t{sample_num + 1} of {len(rotational_diffusion_times)}\n'
                         f'Excitation intensity \t\t{excitation_num + 1} of {len(excitation_intensities)}')
+            sample_seed, experiment_seed = seeds.spawn(2)
             sample = SampleProperties(
                 fluorescent_molecule=fluorophore_molecule,
                 num_molecules=NUM_MOLECULES,
                 rdt=rotational_diffusion_time,
                 fluorophore_state_info=state_info,
+                seed=sample_seed,
             )
 
             excitation_laser = LaserProperties(
@@ -250,7 +295,8 @@ def run():
             experiment = Experiment(
                 sample=sample,
                 excitation_props=excitation_laser,
-                repetitions=EXPERIMENTAL_REPETITIONS
+                repetitions=EXPERIMENTAL_REPETITIONS,
+                seed=experiment_seed,
             )
             experiment.run_experiment()
             experiment.csv_save(csv_path)
@@ -5,10 +5,14 @@
 # This is because the GPU can do many calculations in parallel.
 # Also note that if the simulation is very large, the GPU may run out of memory where the CPU wouldn't,
 #  but at that point the simulation would take a very long time anyway.
+#
+# 'np' is the default backend's array module (see backends.py, which
+# also explains how to choose one). Each collection can use a
+# different backend.
+import logging
 
-try:
-    import cupy as np
-    print("[INFO] Running on GPU.")
-except ModuleNotFoundError:
-    import numpy as np
-    print("[INFO] Running on CPU.")
+from rotational_diffusion.src import backends
+
+np = backends.default().xp
+logging.getLogger(__name__).info(
+    "Running on %s.", "CPU" if backends.default().is_host else backends.default().name)
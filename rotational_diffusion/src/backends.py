@@ -0,0 +1,180 @@
+## Array backends
+# Which array library holds a simulation's arrays: numpy (CPU), cupy
+# (NVIDIA GPU), or anything else with a NumPy-compatible API. Every
+# collection carries its own backend, so one process can mix CPU and
+# GPU collections. Functions that just compute on arrays don't need to
+# be told the backend; they use namespace() to follow their inputs.
+#
+# The default backend comes from the ROTATIONAL_DIFFUSION_BACKEND
+# environment variable: 'numpy', 'cupy', the import path of any other
+# NumPy-compatible module, or 'auto' (the default: cupy if it's
+# installed, else numpy).
+import importlib
+import os
+
+import numpy
+
+
+class Backend:
+    """
+    An array namespace, plus the few things we need that aren't in it.
+
+    Parameters:
+    xp (module): The array namespace (numpy, cupy, ...)
+    name (str): Importable name of 'xp', used for messages and pickling
+    random (module): Random number functions with the numpy.random API;
+                     default is xp.random. This is the shared, global
+                     stream; see generator() for independent ones.
+    to_host (callable): Converts one of our arrays to a numpy.ndarray;
+                        default handles numpy, cupy, and anything that
+                        supports numpy.asarray
+
+    Attributes:
+    is_host (bool): Do our arrays live in host memory (i.e. are they numpy arrays)?
+    """
+    def __init__(self, xp, name=None, random=None, to_host=None):
+        self.xp = xp
+        self.name = xp.__name__ if name is None else name
+        self.random = xp.random if random is None else random
+        self._to_host = to_host
+        self.is_host = xp is numpy
+
+    def asarray(self, x, dtype=None):
+        """Copy 'x' to this backend, unless it's already there."""
+        return self.xp.asarray(x, dtype=dtype)
+
+    def generator(self, seed=None):
+        """
+        A new random number generator for this backend, with the
+        numpy.random API (uniform, exponential, choice...).
+
+        Parameters:
+        seed (None, int or numpy.random.SeedSequence): Seeds the
+            generator; None draws fresh entropy from the OS
+
+        Returns:
+        numpy.random.Generator on the host; elsewhere, the namespace's
+        RandomState (e.g. cupy's Generator lacks choice())
+        """
+        seed = seed_sequence(seed)
+        if self.is_host:
+            return numpy.random.default_rng(seed)
+        return self.xp.random.RandomState(int(seed.generate_state(1)[0]))
+
+    def rng(self, rng=None):
+        """
+        Resolve the 'rng' argument of a simulation: None is the shared
+        stream (self.random, e.g. np.random); a seed (int or SeedSequence)
+        makes a new generator(); anything else is already a generator,
+        and is returned as is.
+        """
+        if rng is None:
+            return self.random
+        if isinstance(rng, (int, numpy.integer, numpy.random.SeedSequence)):
+            return self.generator(rng)
+        return rng
+
+    def to_host(self, x):
+        """Copy 'x' to a numpy array in host memory, unless it's already there."""
+        if self._to_host is not None:
+            return self._to_host(x)
+        return to_host(x)
+
+    def __repr__(self):
+        return f"Backend({self.name!r})"
+
+    # Modules can't be copied or pickled, so we pass around backends
+    # by name (see register()), and copies share the same module:
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return get, (self.name,)
+
+
+def to_host(x):
+    """Copy an array from any backend to a numpy array in host memory."""
+    if isinstance(x, numpy.ndarray):
+        return x
+    if hasattr(x, 'get'):  # cupy
+        return x.get()
+    return numpy.asarray(x)
+
+
+def seed_sequence(seed=None):
+    """
+    A numpy.random.SeedSequence from 'seed': None (fresh entropy), an
+    int, a SeedSequence (returned as is), or a random number generator
+    (which we draw a seed from).
+    """
+    if isinstance(seed, numpy.random.SeedSequence):
+        return seed
+    if seed is None or isinstance(seed, (int, numpy.integer)):
+        return numpy.random.SeedSequence(seed)
+    return numpy.random.SeedSequence(draw_seed(seed))
+
+
+def draw_seed(rng):
+    """A 63-bit seed, drawn from 'rng' (a Generator, a RandomState, or
+    a module like numpy.random)."""
+    if hasattr(rng, 'integers'):  # Generator
+        return int(rng.integers(0, 2**63, dtype='int64'))
+    return int(rng.randint(0, 2**63, dtype='int64'))
+
+
+def namespace(*arrays):
+    """
+    The array namespace (numpy, cupy, ...) that 'arrays' live in. Python
+    and numpy scalars don't count; if nothing else is left, it's numpy.
+    """
+    for x in arrays:
+        if isinstance(x, (numpy.ndarray, numpy.generic, int, float)):
+            continue
+        if type(x).__module__.split('.')[0] == 'cupy':
+            return importlib.import_module('cupy')
+        if hasattr(x, '__array_namespace__'):
+            return x.__array_namespace__()
+    return numpy
+
+
+_backends = {}  # By name, so each module is wrapped at most once
+
+
+def get(backend=None):
+    """
+    Look up a backend.
+
+    Parameters:
+    backend (None, str, module or Backend): None for the default backend,
+        'auto', a module name like 'numpy' or 'cupy', an array module,
+        or a Backend (returned as is)
+
+    Returns:
+    Backend
+    """
+    if backend is None:
+        backend = os.environ.get('ROTATIONAL_DIFFUSION_BACKEND', 'auto')
+    if isinstance(backend, Backend):
+        return backend
+    if not isinstance(backend, str):  # A module
+        return _backends.setdefault(backend.__name__, Backend(backend))
+    if backend == 'auto':
+        try:
+            return get('cupy')
+        except ModuleNotFoundError:
+            return get('numpy')
+    if backend not in _backends:
+        _backends[backend] = Backend(importlib.import_module(backend), backend)
+    return _backends[backend]
+
+
+def register(backend):
+    """Make a custom Backend available by name, e.g. to get() or to
+    worker processes that unpickle it."""
+    _backends[backend.name] = backend
+    return backend
+
+
+def default():
+    """The default backend (see ROTATIONAL_DIFFUSION_BACKEND)."""
+    return get()
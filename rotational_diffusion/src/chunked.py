@@ -0,0 +1,228 @@
+import copy
+import os
+import tempfile
+
+from rotational_diffusion.src import backends
+from rotational_diffusion.src.fluorophore import FluorophoreCollection, PossibleStates
+from rotational_diffusion.src.utils.molecule_store import MoleculeStore
+import numpy
+
+
+class ChunkedFluorophoreCollection:
+    """
+    A FluorophoreCollection that's split into chunks of 'chunk_size'
+    molecules, each a FluorophoreCollection of its own.
+
+    Molecules don't interact, so every operation (phototransition,
+    time_evolve, deleting, recording transitions) can run one chunk at
+    a time, and the stepping temporaries only ever cover one chunk.
+    Each chunk (including its uniformly random initial orientations)
+    is generated the first time it's used, so making or copying a
+    collection that hasn't been used yet is cheap.
+
+    If you give a 'memmap_dir', each chunk's per-molecule arrays live
+    in a memory-mapped temporary file there instead of in RAM, so the
+    size of the population is limited by disk, not memory. The files
+    are anonymous; they disappear when the chunks do.
+
+    If you give an 'event_dir', each chunk spills its recorded
+    transitions to its own subdirectory there (see
+    FluorophoreCollection); flush_events() writes out the rest.
+
+    Chunks draw random numbers one after another, from the same
+    generator as everything else, so a chunked simulation matches an
+    unchunked one in distribution, not draw-for-draw (unless there's
+    only one chunk). If you give an 'rng' (a seed or a generator), each
+    chunk gets its own child stream of it instead, so results don't
+    depend on the order chunks are generated in.
+
+    Parameters:
+    num_molecules (int): Total number of molecules
+    rot_diffusion_time (float or np.ndarray): Like FluorophoreCollection
+    state_info (PossibleStates): Like FluorophoreCollection
+    chunk_size (int): Number of molecules per chunk
+    memmap_dir (str): Directory for memory-mapped chunks, or None to use RAM
+    event_dir (str): Directory to spill recorded transitions to, or None to keep them in RAM
+    **kwargs: Passed on to each chunk's FluorophoreCollection
+    """
+    def __init__(
+            self,
+            num_molecules,
+            rot_diffusion_time,
+            state_info: PossibleStates,
+            chunk_size=2**20,
+            memmap_dir=None,
+            event_dir=None,
+            **kwargs,
+    ):
+        n = int(num_molecules)
+        rot_diffusion_time = numpy.asarray(rot_diffusion_time)
+        assert n >= 1
+        assert chunk_size >= 1
+        assert isinstance(state_info, PossibleStates)
+        assert rot_diffusion_time.shape in ((), (1,), (n,))
+        assert memmap_dir is None or backends.get(kwargs.get('backend')).is_host  # Memory maps live on the host
+        assert kwargs.get('precision', 'double') == 'double' or n < 2**32  # uint32 ids
+        self.num_molecules = n
+        self.rot_diffusion_time = rot_diffusion_time
+        self.state_info = state_info
+        self.chunk_size = int(chunk_size)
+        self.memmap_dir = memmap_dir
+        self.event_dir = event_dir
+        rng = kwargs.pop('rng', None)
+        self.kwargs = kwargs
+        self.weighted = kwargs.get('weighted', False)  # Like FluorophoreCollection.weighted
+        self._chunks = [None] * (-(-n // self.chunk_size))  # Not generated yet
+        self._seeds = [None] * len(self._chunks)  # None: the shared stream
+        self._measurements = None  # See declare_measurements
+        self._subscriptions = []  # See subscribe
+        self._detectors = []  # See attach
+        if rng is not None:
+            self.reseed(rng)
+
+    def _bounds(self, i):
+        start = i * self.chunk_size
+        return start, min(start + self.chunk_size, self.num_molecules)
+
+    def _chunk(self, i):
+        """The i'th chunk, generated if it hasn't been yet."""
+        if self._chunks[i] is None:
+            start, stop = self._bounds(i)
+            rdt = self.rot_diffusion_time
+            if rdt.shape == (self.num_molecules,):
+                rdt = rdt[start:stop]
+            buffer = None
+            if self.memmap_dir is not None:
+                columns = FluorophoreCollection.columns(
+                    rdt.shape == (stop - start,) and stop - start > 1,
+                    self.kwargs.get('precision', 'double'),
+                    self.kwargs.get('weighted', False))
+                buffer = self._memmap(MoleculeStore.nbytes(stop - start, columns))
+            event_dir = None
+            if self.event_dir is not None:  # One per chunk, so segments don't collide
+                event_dir = os.path.join(self.event_dir, f"chunk{i:06d}")
+                os.makedirs(event_dir, exist_ok=True)
+            chunk = FluorophoreCollection(
+                stop - start, rdt, self.state_info, buffer=buffer, rng=self._seeds[i],
+                event_dir=event_dir, **self.kwargs)
+            chunk.id += start  # Unique across chunks
+            if self._measurements is not None:
+                chunk.declare_measurements(*self._measurements)
+            for args in self._subscriptions:
+                chunk.subscribe(*args)
+            for detector in self._detectors:
+                chunk.attach(detector)
+            self._chunks[i] = chunk
+        return self._chunks[i]
+
+    def _memmap(self, nbytes):
+        with tempfile.TemporaryFile(dir=self.memmap_dir) as f:
+            # The map keeps the (already unlinked) file alive:
+            return numpy.memmap(f, 'uint8', 'w+', shape=(max(nbytes, 1),))
+
+    def chunks(self):
+        """Iterate over the chunks, generating them as needed."""
+        for i in range(len(self._chunks)):
+            yield self._chunk(i)
+
+    @property
+    def num_alive(self):
+        """Number of molecules that haven't been deleted."""
+        return sum(stop - start if chunk is None else chunk.num_alive
+                   for chunk, (start, stop) in zip(
+                       self._chunks, map(self._bounds, range(len(self._chunks)))))
+
+    def reseed(self, seed):
+        """Like FluorophoreCollection.reseed; each chunk gets its own
+        child stream of 'seed'."""
+        self._seeds = backends.seed_sequence(seed).spawn(len(self._chunks))
+        for chunk, child in zip(self._chunks, self._seeds):
+            if chunk is not None:
+                chunk.reseed(child)
+
+    def declare_measurements(self, transitions, pulses=()):
+        """Like FluorophoreCollection.declare_measurements. Chunks that
+        haven't been generated yet get the declaration when they are."""
+        self._measurements = [list(transitions), list(pulses)]
+        for chunk in self._chunks:
+            if chunk is not None:
+                chunk.declare_measurements(*self._measurements)
+
+    def subscribe(self, initial_state, final_state, collection_times=None, fields=('x', 'y', 'z', 't')):
+        """Like FluorophoreCollection.subscribe. Chunks that haven't been
+        generated yet subscribe when they are."""
+        args = (initial_state, final_state, collection_times, tuple(fields))
+        self._subscriptions.append(args)
+        for chunk in self._chunks:
+            if chunk is not None:
+                chunk.subscribe(*args)
+
+    def attach(self, detector):
+        """Like FluorophoreCollection.attach; every chunk (including ones
+        that haven't been generated yet) feeds the same detector."""
+        self._detectors.append(detector)
+        for chunk in self._chunks:
+            if chunk is not None:
+                chunk.attach(detector)
+
+    def phototransition(self, *args, **kwargs):
+        """Like FluorophoreCollection.phototransition, one chunk at a time."""
+        for chunk in self.chunks():
+            chunk.phototransition(*args, **kwargs)
+
+    def time_evolve(self, delta_t):
+        """Like FluorophoreCollection.time_evolve, one chunk at a time."""
+        for chunk in self.chunks():
+            chunk.time_evolve(delta_t)
+
+    def delete_fluorophores_in_state(self, state):
+        """Like FluorophoreCollection.delete_fluorophores_in_state, one chunk at a time."""
+        for chunk in self.chunks():
+            chunk.delete_fluorophores_in_state(state)
+
+    def flush_events(self):
+        """Write every chunk's recorded transitions that are still in memory to disk."""
+        for chunk in self._chunks:
+            if chunk is not None:
+                chunk.event_log.flush()
+
+    def compact(self):
+        for chunk in self._chunks:
+            if chunk is not None:
+                chunk.compact()
+
+    def get_xyz_for_state(self, state):
+        xyz = [chunk.get_xyz_for_state(state) for chunk in self.chunks()]
+        return tuple(self._concatenate([c[k] for c in xyz]) for k in range(3))
+
+    def get_xyzt_at_transitions(self, initial_state, final_state):
+        # Each chunk recorded its own transitions; join them up:
+        xyzt = [chunk.get_xyzt_at_transitions(initial_state, final_state)
+                for chunk in self.chunks()]
+        return tuple(None if xyzt[0][k] is None else self._concatenate([c[k] for c in xyzt])
+                     for k in range(4))  # None: not recorded (see subscribe)
+
+    def get_expected_counts(self, initial_state, final_state, collection_times=None):
+        # Expected counts just add up over chunks:
+        counts = [chunk.get_expected_counts(initial_state, final_state, collection_times)
+                  for chunk in self.chunks()]
+        return tuple(sum(c[k] for c in counts) for k in range(3))
+
+    def _concatenate(self, arrays):
+        return backends.get(self.kwargs.get('backend')).xp.concatenate(arrays)
+
+    def __deepcopy__(self, memo):
+        # Copy memory-mapped chunks into new memory-mapped files, rather
+        # than into RAM. Registering the new buffer in 'memo' makes
+        # deepcopy use it for the chunk's store.
+        for chunk in self._chunks:
+            if chunk is not None and isinstance(chunk._store.buffer, numpy.memmap):
+                old = chunk._store.buffer
+                new = self._memmap(old.size)
+                new[:] = old
+                memo[id(old)] = new
+        result = self.__class__.__new__(self.__class__)
+        memo[id(self)] = result
+        for k, v in self.__dict__.items():
+            setattr(result, k, copy.deepcopy(v, memo))
+        return result
@@ -0,0 +1,136 @@
+## Streaming detectors
+# get_detector_counts in the get_figures scripts counts photons after
+# the whole scheme has run, from the recorded transitions, so the whole
+# event log has to stay in memory until then. A detector instead
+# watches the transitions as they happen: attach it to a collection,
+# and every time_evolve hands it each wave of transitions. It keeps
+# only its running counts (and histograms, if you want them), so its
+# memory doesn't grow with the length of the run.
+#
+# To keep memory flat, tell the collection not to record the events
+# too (e.g. subscribe to the measured transition with collection_times=[];
+# see FluorophoreCollection.subscribe).
+
+
+class PolarizationDetector:
+    """
+    A polarizing beam splitter and two photon counters: each spontaneous
+    transition from 'initial_state' to 'final_state' emits a photon,
+    which goes to the x channel with probability x^2, to the y channel
+    with probability y^2, and is lost otherwise.
+
+    Attach it to a collection before running a scheme (see attach).
+    Fed the same transitions and the same generator, it draws the same
+    numbers in the same order as get_detector_counts, so it gives the
+    same counts.
+
+    Parameters:
+    initial_state, final_state (int or str): The transition that emits photons
+    collection_times (tuple): (start, stop) time window (inclusive); default is all times
+    time_bins (array-like): Optional bin edges (absolute times) for a
+                            histogram of each channel's photons (TCSPC)
+    rng (None, int, SeedSequence or generator): Flips the coins that send
+        photons to channels; see Backend.rng. Give it its own stream, so
+        detecting doesn't change the simulation's random numbers.
+    expected (bool): Add up each photon's chance of reaching each channel,
+                     rather than flipping coins. Weighted collections are
+                     always counted this way, each photon with its
+                     molecule's weight (like get_expected_counts).
+    """
+    def __init__(
+            self,
+            initial_state,
+            final_state,
+            collection_times=None,
+            time_bins=None,
+            rng=None,
+            expected=False,
+    ):
+        assert collection_times is None or collection_times[0] <= collection_times[1]
+        self.initial_state = initial_state
+        self.final_state = final_state
+        self.collection_times = collection_times
+        self.time_bins = time_bins
+        self.rng = rng
+        self.expected = expected
+        self.backend = None  # Set by attach
+        self.reset()
+
+    def attach(self, collection):
+        """Start detecting the transitions of 'collection' (a FluorophoreCollection)."""
+        assert self.initial_state in collection.state_info
+        assert self.final_state in collection.state_info
+        if self.backend is None:
+            self.backend = collection.backend
+            # Seeds become generators once, so they don't restart on each chunk:
+            self.rng = None if self.rng is None else self.backend.rng(self.rng)
+            self.expected = self.expected or collection.weighted
+            self.reset()
+        assert self.backend is collection.backend, "Only attach to collections on one backend"
+        assert self.expected or not collection.weighted
+        self._pair = (collection.state_info[self.initial_state].state_num,
+                      collection.state_info[self.final_state].state_num)
+        collection.detectors.append(self)
+
+    def reset(self):
+        """Forget every photon so far."""
+        self.photons_x = self.photons_y = 0
+        self.histogram_x = self.histogram_y = None
+        if self.time_bins is not None and self.backend is not None:
+            self._bins = self.backend.asarray(self.time_bins, dtype='float64')
+            assert self._bins.ndim == 1 and len(self._bins) >= 2
+            dtype = 'float64' if self.expected else 'int64'
+            self.histogram_x = self.backend.xp.zeros(len(self._bins) - 1, dtype)
+            self.histogram_y = self.backend.xp.zeros(len(self._bins) - 1, dtype)
+
+    def detect(self, collection, idx, initial_states, final_states, t):
+        """
+        Count the photons of a wave of transitions. Called by the
+        collection during time_evolve.
+
+        Parameters:
+        collection (FluorophoreCollection): Where the transitions happened
+        idx (array): Indices of the molecules that just transitioned
+        initial_states, final_states (array): Their state numbers
+        t (array): Their (absolute) transition times
+        """
+        xp = self.backend.xp
+        seen = (initial_states == self._pair[0]) & (final_states == self._pair[1])
+        if self.collection_times is not None:
+            seen &= (t >= self.collection_times[0]) & (t <= self.collection_times[1])
+        idx, t = idx[seen], t[seen]
+        if len(idx) == 0:
+            return None  # Nothing to see
+        o = collection.orientations  # Local nickname
+        p_x, p_y = o.x[idx] ** 2, o.y[idx] ** 2
+        if self.expected:
+            if collection.weighted:
+                w = collection.weights[idx]
+                p_x, p_y = w * p_x, w * p_y
+            self.photons_x += float(p_x.sum())
+            self.photons_y += float(p_y.sum())
+            if self.histogram_x is not None:
+                self.histogram_x += xp.histogram(t, self._bins, weights=p_x)[0]
+                self.histogram_y += xp.histogram(t, self._bins, weights=p_y)[0]
+            return None
+        # Flip a coin for each photon, exactly like get_detector_counts:
+        rng = self.backend.random if self.rng is None else self.rng
+        r = rng.uniform(0, 1, size=len(t))
+        in_channel_x = (r < p_x)
+        in_channel_y = (p_x <= r) & (r < p_x + p_y)
+        self.photons_x += int(in_channel_x.sum())
+        self.photons_y += int(in_channel_y.sum())
+        if self.histogram_x is not None:
+            self.histogram_x += xp.histogram(t[in_channel_x], self._bins)[0]
+            self.histogram_y += xp.histogram(t[in_channel_y], self._bins)[0]
+
+    def counts(self):
+        """
+        The photons so far, like get_detector_counts.
+
+        Returns:
+        tuple: (ratio_xy, photons_x, photons_y, total); ratio_xy is nan
+               if the y channel hasn't seen anything
+        """
+        ratio_xy = float('nan') if self.photons_y <= 0 else self.photons_x / self.photons_y
+        return ratio_xy, self.photons_x, self.photons_y, self.photons_x + self.photons_y
@@ -1,5 +1,13 @@
-from rotational_diffusion.src import np
-from rotational_diffusion.src.utils import general, diffusive_steps
+from rotational_diffusion.src import backends
+from rotational_diffusion.src.utils import general, diffusive_steps, compiled, threads, dispatch
+from rotational_diffusion.src.utils.event_log import EventLog
+from rotational_diffusion.src.utils.molecule_store import MoleculeStore
+from rotational_diffusion.src.utils.state_buckets import StateBuckets
+import numpy
+
+# Deleted molecules linger in their slots, in this (unreachable) state,
+# until the collection compacts its arrays:
+DEAD = 255
 
 
 class Orientations:
@@ -9,48 +17,288 @@ class Orientations:
 
     Time evolution consists of rotational diffusion of orientation.
     You get to choose the "diffusion_time" (roughly, how long it
-    takes the molecules to scramble their orientations).
+    takes the molecules to scramble their orientations), and the
+    "propagator" used to draw each step (see diffusive_steps.propagators;
+    'exact' takes any time step in one go).
+
+    The "kernel" decides how steps are computed: 'numpy' (the default;
+    always available), 'compiled' (a fused, in-place loop; needs numba,
+    see utils.compiled), or 'auto' (compiled when possible, else numpy).
+    The compiled kernel draws its random numbers differently, so it
+    agrees with numpy in distribution, not draw-for-draw; that's why
+    it's opt-in, so a seeded run gives the same numbers whether or not
+    numba happens to be installed.
+    With 'num_threads', steps are split into cache-sized chunks, which
+    a pool of threads steps concurrently (see utils.threads).
+    kernel='adaptive' picks, for each step, whichever of these (numpy
+    or compiled, threaded or not) is fastest for the number of molecules
+    being stepped, from a one-time calibration (see utils.dispatch).
+    Adaptive simulations are reproducible in distribution, but not
+    draw-for-draw, since which kernel draws depends on the calibration.
+
+    The per-molecule arrays (x, y, z, t, and rot_diffusion_time if it
+    varies per molecule) live in a MoleculeStore, which can be shared
+    with the owner of these orientations (see FluorophoreCollection).
+
+    The "precision" is 'double' (float64 everything) or 'compact', which
+    halves the memory per molecule: orientations are stored as float32
+    (each step renormalizes in double precision before rounding, so
+    rounding errors don't pile up), and clocks are stored as float32
+    relative to a float64 'epoch', which moves forward as the clocks do
+    (see rebase()), so they keep sub-ns resolution however long we run.
+    Clocks are always stored relative to 'epoch' ('t_rel'); in 'double'
+    precision the epoch just stays at 0.
+
+    The "backend" decides where the arrays live (see backends.get); the
+    default is the one chosen at import time. Random numbers come from
+    "rng": None (the default) draws from the backend's shared stream,
+    np.random; a seed (int or np.random.SeedSequence) or a generator
+    gives these orientations a stream of their own (see
+    Backend.generator), for reproducible runs that don't depend on what
+    else draws from np.random. A utils.random_pool.RandomPool draws in
+    bulk, which is faster when there are many small steps.
     """
     def __init__(
             self,
             num_molecules,
             rot_diffusion_time,
             initial_orientations='uniform',
+            propagator='ghosh',
+            kernel='numpy',
+            store=None,
+            precision='double',
+            num_threads=None,
+            backend=None,
+            rng=None,
     ):
-        self.n = int(num_molecules)
-        self.t = np.zeros(self.n, 'float64')
-        rot_diffusion_time = np.asarray(rot_diffusion_time)
-        self.rot_diffusion_time = rot_diffusion_time
+        self.backend = backends.get(backend)
+        xp = self.backend.xp
+        self.rng = self.backend.rng(rng)
+        n = int(num_molecules)
+        rot_diffusion_time = xp.asarray(rot_diffusion_time)
 
         assert num_molecules >= 1
-        assert rot_diffusion_time.shape in ((), (1,), (self.n,))
-        assert np.all(rot_diffusion_time > 0)
+        assert rot_diffusion_time.shape in ((), (1,), (n,))
+        assert xp.all(rot_diffusion_time > 0)
         assert initial_orientations in ('uniform', 'polar')
+        assert propagator in diffusive_steps.propagators
+        self.propagator = propagator
+        assert kernel in ('auto', 'numpy', 'compiled', 'adaptive')
+        if kernel == 'compiled' and not compiled.available:
+            raise ModuleNotFoundError("kernel='compiled' needs numba installed.")
+        self.kernel = kernel
+        assert precision in ('double', 'compact')
+        self.precision = precision
+        assert num_threads is None or num_threads >= 1
+        assert num_threads is None or self.backend.is_host  # Threads are for the CPU
+        self.num_threads = num_threads
+
+        per_molecule = rot_diffusion_time.shape == (n,) and n > 1
+        if store is None:
+            store = MoleculeStore(n, self.columns(per_molecule, precision), xp=xp)
+        assert store.n == n
+        self._store = store
+        self.epoch = numpy.float64(0)  # Not a Python float, so epoch + float32 is float64
+        self.t_rel = 0
+        if per_molecule:
+            store['rot_diffusion_time'] = rot_diffusion_time
+        else:
+            self._rot_diffusion_time = rot_diffusion_time
 
         # Everybody starts at the north pole:
-        self.x = np.zeros(self.n)
-        self.y = np.zeros(self.n)
-        self.z = np.ones(self.n)
+        self.x = 0
+        self.y = 0
+        self.z = 1
         if initial_orientations == 'uniform':
             self._assign_uniform_positions()
 
+    @staticmethod
+    def columns(per_molecule_rot_diffusion_time=False, precision='double'):
+        """The MoleculeStore columns that Orientations needs."""
+        f = 'float64' if precision == 'double' else 'float32'
+        columns = {'x': f, 'y': f, 'z': f, 't': f}
+        if per_molecule_rot_diffusion_time:
+            columns['rot_diffusion_time'] = f
+        return columns
+
+    # The shared stream is a module, which can't be copied or pickled;
+    # copies of us just keep drawing from it:
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state['rng'] is self.backend.random:
+            state['rng'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None:
+            self.rng = self.backend.random
+
+    # Per-molecule attributes are views of the store's columns. Setting
+    # them copies into the store, so nobody is left holding a stale array.
+    @property
+    def n(self):
+        return self._store.n
+
+    @property
+    def x(self):
+        return self._store['x']
+
+    @x.setter
+    def x(self, value):
+        self._store['x'] = value
+
+    @property
+    def y(self):
+        return self._store['y']
+
+    @y.setter
+    def y(self, value):
+        self._store['y'] = value
+
+    @property
+    def z(self):
+        return self._store['z']
+
+    @z.setter
+    def z(self, value):
+        self._store['z'] = value
+
+    @property
+    def t_rel(self):
+        return self._store['t']
+
+    @t_rel.setter
+    def t_rel(self, value):
+        self._store['t'] = value
+
+    @property
+    def t(self):
+        # In compact precision this is a float64 copy, so assign to it
+        # (or to 't_rel') rather than modifying it in place.
+        if self.precision == 'double':
+            return self._store['t']
+        return self.epoch + self._store['t']
+
+    @t.setter
+    def t(self, value):
+        self._store['t'] = value - self.epoch
+
+    @property
+    def rot_diffusion_time(self):
+        if 'rot_diffusion_time' in self._store:
+            return self._store['rot_diffusion_time']
+        return self._rot_diffusion_time
+
     def _assign_uniform_positions(self):
+        xp = self.backend.xp
         # Generate random points on a sphere:
-        sin_ph, cos_ph = general.sin_cos(np.random.uniform(0, 2 * np.pi, self.n), '0,2pi')
-        cos_th = np.random.uniform(-1, 1, self.n)
-        sin_th = np.sqrt(1 - cos_th * cos_th)
+        sin_ph, cos_ph = general.sin_cos(self.rng.uniform(0, 2 * xp.pi, self.n), '0,2pi')
+        cos_th = self.rng.uniform(-1, 1, self.n)
+        sin_th = xp.sqrt(1 - cos_th * cos_th)
         self.x = sin_th * cos_ph
         self.y = sin_th * sin_ph
         self.z = cos_th
 
     def time_evolve(self, delta_t):
-        delta_t = np.asarray(delta_t)
+        xp = self.backend.xp
+        delta_t = xp.asarray(delta_t)
         assert delta_t.shape in ((), (1,), (self.n,))
-        assert np.all(delta_t > 0)
-        self.x, self.y, self.z = diffusive_steps.safe_diffusive_step(
-            self.x, self.y, self.z,
-            normalized_time_step=delta_t/self.rot_diffusion_time)
-        self.t += delta_t
+        assert xp.all(delta_t > 0)
+        self.step(delta_t)
+        self.t_rel += delta_t
+        if self.precision == 'compact':
+            self.rebase()
+
+    def rebase(self):
+        """Move 'epoch' up to the earliest clock, so the clocks stored
+        relative to it stay small. Returns how far the epoch moved."""
+        xp = self.backend.xp
+        shift = float(xp.amin(self.t_rel))
+        self.epoch += shift
+        self.t_rel -= shift
+        return shift
+
+    def step(self, delta_t, idx=None):
+        """Rotationally diffuse the molecules 'idx' (default: all of
+        them) for a time 'delta_t', without touching the clock 't'."""
+        xp = self.backend.xp
+        rdt = self.rot_diffusion_time
+        if idx is not None and rdt.size > 1:
+            rdt = rdt[idx]
+        normalized_time_step = delta_t / rdt
+        use_compiled, threaded = self._choose_kernel(
+            self.n if idx is None else len(range(self.n)[idx]) if isinstance(idx, slice) else len(idx))
+        if threaded:
+            self._step_threaded(normalized_time_step, idx, use_compiled)
+        elif use_compiled:  # Updates in place, no gathering
+            if isinstance(idx, slice):
+                idx = xp.arange(self.n)[idx]
+            # Numba keeps its own generator; seed it from ours (even the
+            # shared stream), so seeding ours reproduces a run:
+            compiled.seed(backends.draw_seed(self.rng) % 2**32)
+            compiled.safe_diffusive_step(
+                self.x, self.y, self.z, normalized_time_step, idx,
+                propagator=self.propagator)
+        elif idx is None:
+            self.x, self.y, self.z = diffusive_steps.safe_diffusive_step(
+                self.x, self.y, self.z, normalized_time_step,
+                propagator=self.propagator, rng=self.rng)
+        else:
+            self.x[idx], self.y[idx], self.z[idx] = diffusive_steps.safe_diffusive_step(
+                self.x[idx], self.y[idx], self.z[idx], normalized_time_step,
+                propagator=self.propagator, rng=self.rng)
+
+    def _choose_kernel(self, n):
+        """Should we step 'n' molecules with the compiled kernel? With threads?"""
+        if self.kernel != 'adaptive':
+            use_compiled = (self.kernel == 'compiled' or
+                            (self.kernel == 'auto' and compiled.supports(self.x, self.propagator)))
+            return use_compiled, self.num_threads is not None
+        kernels = ['numpy']
+        if compiled.supports(self.x, self.propagator):
+            kernels.append('compiled')
+        if self.num_threads is not None:
+            kernels += [k + '-threaded' for k in kernels]
+
+        def prepare(kernel):
+            # Time steps like ours, on a throwaway population of size n
+            def prepare_n(n):
+                o = Orientations(
+                    n, 1, 'uniform', self.propagator, kernel.split('-')[0],
+                    precision=self.precision, backend=self.backend, rng=0,
+                    num_threads=self.num_threads if kernel.endswith('-threaded') else None)
+                tau = self.backend.xp.full(n, 0.1)  # Typical of the event engine
+                return lambda: o.step(tau)
+            return prepare_n
+
+        choice = dispatch.get(
+            f"Orientations.step/{self.propagator}/{self.precision}/"
+            f"{self.backend.name}/{self.num_threads} threads",
+            {k: prepare(k) for k in kernels}).choose(n)
+        return choice.startswith('compiled'), choice.endswith('-threaded')
+
+    def _step_threaded(self, normalized_time_step, idx, use_compiled):
+        xp = self.backend.xp
+        # Each chunk steps its own part of 'idx' (or of everybody) in
+        # place, so chunks never write to the same memory.
+        if isinstance(idx, slice):
+            idx = xp.arange(self.n)[idx]
+        per_molecule = xp.size(normalized_time_step) > 1
+        x, y, z = self.x, self.y, self.z  # Views, not copies
+
+        def step_chunk(s, rng):
+            tau = normalized_time_step[s] if per_molecule else normalized_time_step
+            if use_compiled:
+                compiled.seed(int(rng.integers(2**32)))  # This thread's numba generator
+                i = xp.arange(s.start, s.stop) if idx is None else idx[s]
+                compiled.safe_diffusive_step(x, y, z, tau, i, propagator=self.propagator)
+            else:
+                i = s if idx is None else idx[s]
+                x[i], y[i], z[i] = diffusive_steps.safe_diffusive_step(
+                    x[i], y[i], z[i], tau, propagator=self.propagator, rng=rng)
+
+        threads.run(step_chunk, self.n if idx is None else len(idx), self.num_threads, self.rng)
 
 
 class ElectronicState:
@@ -74,7 +322,7 @@ class ElectronicState:
     - probabilities (List[float]): The list of transition probabilities for this electronic state.
     - state_num (int): The number assigned to this electronic state.
     """
-    def __init__(self, name: str, lifetime: float = np.inf,
+    def __init__(self, name: str, lifetime: float = numpy.inf,
                  transition_states=None,
                  probabilities=None):
         self.name = name
@@ -112,9 +360,9 @@ class ElectronicState:
             probabilities = [probabilities]
         for probability in probabilities:
             assert isinstance(probability, (int, float))
-        probabilities = np.asarray(probabilities, 'float64')
+        probabilities = numpy.asarray(probabilities, 'float64')
         assert probabilities.shape == (len(self.transition_states),)
-        assert np.all(probabilities > 0)
+        assert numpy.all(probabilities > 0)
         self.probabilities = probabilities / probabilities.sum()
 
     def assign_state_num(self, state_num):
@@ -137,19 +385,30 @@ class PossibleStates:
 
     - add_state: Adds a new electronic state to the collection.
     - get_state_num_and_lifetime: Returns the state number and lifetime of the specified electronic states.
+    - compile: Returns the spontaneous transitions as dense TransitionTables.
     """
     def __init__(self, electronic_state: ElectronicState):
         self.dict = {}
         self.valid = False
         self.orphan_states = []
+        self._compiled = None
         self.add_state(electronic_state)
 
     def add_state(self, electronic_state: ElectronicState):
         assert electronic_state.name not in self.dict
+        assert len(self.dict) < DEAD  # State numbers are stored as uint8
         electronic_state.assign_state_num(len(self.dict))
         self.dict[electronic_state.name] = electronic_state
+        self._compiled = None  # Out of date
         self._validate()
 
+    def compile(self):
+        """Our spontaneous transitions as TransitionTables, built the
+        first time somebody asks (and again after add_state)."""
+        if self._compiled is None:
+            self._compiled = TransitionTables(self)
+        return self._compiled
+
     def _validate(self):
         self.valid = True
         self.orphan_states = []
@@ -165,8 +424,8 @@ class PossibleStates:
             if not (isinstance(states, int) or isinstance(states, str)):
                 raise TypeError("states must be an integer, a string, or a list of either.")
             states = [states]
-        state_nums = np.asarray([self[state].state_num for state in states], 'uint')
-        lifetimes = np.asarray([self[state].lifetime for state in states], 'float')
+        state_nums = numpy.asarray([self[state].state_num for state in states], 'uint')
+        lifetimes = numpy.asarray([self[state].lifetime for state in states], 'float')
         return state_nums, lifetimes
 
     def __getitem__(self, item):
@@ -190,12 +449,185 @@ class PossibleStates:
         except (KeyError, IndexError):
             return False
 
+    def live_states(self, transitions, pulses=()):
+        """
+        Which states can still lead to one of the spontaneous
+        'transitions' (e.g. the ones we'll measure)? Molecules can get
+        there by spontaneous transitions, and by the phototransitions
+        still to come, in order.
+
+        Parameters:
+        transitions (iterable): (initial_state, final_state) pairs
+        pulses (iterable): (initial_state, final_states) of each
+                           phototransition still to come, in order
+
+        Returns:
+        np.ndarray: Boolean, one entry per state number
+        """
+        num_states = len(self.dict)
+        # spontaneous[i, f]: can a molecule in state i decay to state f?
+        spontaneous = numpy.zeros((num_states, num_states), dtype=bool)
+        for state in self.dict.values():
+            if numpy.isinf(state.lifetime):
+                continue  # Never transitions
+            final_states, _ = self.get_state_num_and_lifetime(state.transition_states)
+            spontaneous[state.state_num, final_states] = True
+
+        def leading_to(live):
+            # Add every state with a spontaneous path into 'live':
+            while True:
+                new = live | spontaneous[:, live].any(axis=1)
+                if numpy.array_equal(new, live):
+                    return live
+                live = new
+
+        live = numpy.zeros(num_states, dtype=bool)
+        for initial_state, final_state in transitions:
+            i, f = self[initial_state].state_num, self[final_state].state_num
+            assert spontaneous[i, f], f"{initial_state}->{final_state} isn't a spontaneous transition"
+            live[i] = True
+        live = leading_to(live)
+        # Work backwards from the last pulse. Just before a pulse, its
+        # initial state is live if any of its final states is live
+        # just after it:
+        for initial_state, final_states in reversed(list(pulses)):
+            final_states, _ = self.get_state_num_and_lifetime(final_states)
+            if live[final_states].any():
+                live[self[initial_state].state_num] = True
+                live = leading_to(live)
+        return live
+
+
+class TransitionTables:
+    """
+    The spontaneous transitions of a (valid) PossibleStates, as dense,
+    read-only arrays indexed by state number, so a whole wave of
+    transitions can be drawn at once, without a Python loop over states.
+
+    Attributes:
+    final_states (np.ndarray): final_states[s, k] is the k'th state that
+                               state 's' can decay to, padded with 's'
+    cumulative (np.ndarray): cumulative[s, k] is the probability that
+                             state 's' decays to one of its first k+1
+                             final states; padded with 1
+    lifetimes (np.ndarray): lifetimes[s] is the lifetime of state 's'
+    """
+    def __init__(self, state_info: PossibleStates):
+        states = list(state_info.dict.values())
+        num_states = len(states)
+        num_branches = max(len(state.transition_states) for state in states)
+        self.final_states = numpy.empty((num_states, num_branches), dtype='uint8')
+        self.cumulative = numpy.ones((num_states, num_branches), dtype='float64')
+        self.lifetimes = numpy.asarray([state.lifetime for state in states], 'float64')
+        for state in states:
+            s, k = state.state_num, len(state.transition_states)
+            final_states, _ = state_info.get_state_num_and_lifetime(state.transition_states)
+            self.final_states[s] = s
+            self.final_states[s, :k] = final_states
+            self.cumulative[s, :k] = numpy.cumsum(state.probabilities)
+            self.cumulative[s, k - 1:] = 1  # Exactly, despite rounding
+        for a in (self.final_states, self.cumulative, self.lifetimes):
+            a.flags.writeable = False
+
+    def draw(self, states, uniform):
+        """
+        The final state of each molecule that decays from 'states', by
+        inverse CDF: the branch is the number of cumulative probabilities
+        that a uniform draw is at or above. Arrays are numpy, or on
+        another backend like 'states' (see backends).
+
+        Parameters:
+        states (array): State numbers of the molecules that are decaying
+        uniform (array or None): A uniform draw per molecule on [0, 1),
+                                 or None if no state has more than one
+                                 final state
+
+        Returns:
+        tuple: (final_states, lifetimes) arrays; the lifetime of each final state
+        """
+        final_states, cumulative, lifetimes = self._device(states)
+        if uniform is None:
+            final_states = final_states[states, 0]
+        else:
+            branch = (uniform[:, None] >= cumulative[states]).sum(axis=1)
+            final_states = final_states[states, branch]
+        return final_states, lifetimes[final_states]
+
+    @property
+    def branching(self):
+        """Do any states have more than one final state?"""
+        return self.cumulative.shape[1] > 1
+
+    def _device(self, like):
+        """Our tables, in the same array library as 'like'."""
+        xp = backends.namespace(like)
+        if xp is numpy:
+            return self.final_states, self.cumulative, self.lifetimes
+        if getattr(self, '_on_device', (None,))[0] is not xp:  # Copy them over once
+            self._on_device = (xp,) + tuple(
+                xp.asarray(a) for a in (self.final_states, self.cumulative, self.lifetimes))
+        return self._on_device[1:]
+
 
 class FluorophoreCollection:
     """
     Generates a number of fluorophores with specified diffusion times and fluorophore states based on the
     FluorophoreStateInfo object. Contains methods to manipulate the fluorophores, such as
     simulating photo transitions, rotational diffusion, and fluorophore deletions.
+
+    Deleting fluorophores is lazy: deleted molecules are marked with the
+    state DEAD, which every operation skips, and the per-molecule arrays
+    are only compacted once the dead fraction exceeds
+    'compaction_threshold' (0 compacts on every deletion). Until then,
+    per-molecule attributes like 'states' and 'id' include the dead
+    slots; call compact() if you need them gone.
+
+    precision='compact' stores orientations, clocks and transition times
+    as float32 (see Orientations) and ids as uint32, roughly halving the
+    memory per molecule. Transition times are stored relative to the
+    orientations' 'epoch', which moves up to the current time at the
+    start of each time_evolve. Recorded transition times are float64.
+
+    'kernel' picks how orientations are stepped (see Orientations);
+    the default, 'numpy', doesn't depend on what's installed.
+
+    With 'num_threads', phototransitions and rotational diffusion run
+    in chunks on a pool of threads (see utils.threads). With
+    kernel='adaptive' as well, they only use threads when there are
+    enough molecules for it to pay off (see Orientations).
+
+    'backend' picks the array library every per-molecule array lives in
+    (see backends.get), so collections on different devices can coexist
+    in one process. 'rng' is the random number generator (or seed)
+    that every draw comes from, shared with our orientations (see
+    Orientations); reseed() gives a copy a stream of its own.
+
+    If you declare which transitions you'll measure, and which pulses
+    are still to come (see declare_measurements), molecules are deleted
+    as soon as they can't contribute to a measurement anymore, instead
+    of waiting for the next delete_fluorophores_in_state.
+
+    weighted=True gives each molecule a statistical weight, starting at
+    1. When only one outcome of a pulse can still lead to a measurement
+    (e.g. molecules left in the ground state by the excitation pulse
+    are useless), the pulse doesn't sample who's photoselected: every
+    molecule takes that outcome, and its weight is multiplied by the
+    probability of it. Without a declaration, pulses are sampled as
+    usual. Either way, get_expected_counts weighs each transition by
+    its molecule's weight; the expected counts are the same, but with
+    much less noise per molecule simulated.
+
+    state_buckets=True keeps the indices of the molecules in each state
+    (see utils.state_buckets), so pulses, deletions and per-state
+    queries don't compare every molecule's state. If you modify
+    'states' yourself, assign the whole array (which rebuilds the
+    buckets), rather than modifying it in place.
+
+    'event_dir' (an existing directory) spills recorded transitions to
+    disk as they pile up, rather than keeping them all in memory (see
+    utils.event_log); call event_log.flush() at the end of a run to
+    write out the rest, and EventLog.open to read them back later.
+    Host only.
     """
     def __init__(
             self,
@@ -204,22 +636,265 @@ class FluorophoreCollection:
             state_info: PossibleStates,
             orientation_initial='uniform',
             state_initial=0,
+            engine='event',
+            propagator='ghosh',
+            kernel='numpy',
+            compaction_threshold=0.5,
+            precision='double',
+            buffer=None,
+            num_threads=None,
+            backend=None,
+            rng=None,
+            weighted=False,
+            state_buckets=False,
+            event_dir=None,
     ):
         assert isinstance(state_info, PossibleStates)
         assert state_initial in state_info
+        assert engine in ('event', 'sorted')
+        assert 0 <= compaction_threshold < 1
+        self.compaction_threshold = compaction_threshold
         self.state_info = state_info
-        self.orientations = Orientations(num_molecules, rot_diffusion_time, orientation_initial)
-        self.states = np.full(self.orientations.n, state_initial, dtype='uint8')
-        self.transition_times = np.random.exponential(
+        # 'event' only touches the molecules that are due to transition
+        # on each pass of time_evolve; 'sorted' is the original engine,
+        # which re-sorts the whole population on every pass.
+        self.engine = engine
+        # Every per-molecule array lives in one store, shared with our
+        # orientations:
+        n = int(num_molecules)
+        self.backend = backends.get(backend)
+        xp = self.backend.xp
+        per_molecule = numpy.shape(rot_diffusion_time) == (n,) and n > 1
+        self.weighted = weighted
+        columns = self.columns(per_molecule, precision, weighted)
+        assert precision == 'double' or n < 2**32
+        # 'buffer' optionally preallocates the store (e.g. memory-mapped):
+        self._store = MoleculeStore(n, columns, buffer, xp)
+        self.orientations = Orientations(
+            n, rot_diffusion_time, orientation_initial, propagator, kernel, self._store,
+            precision, num_threads, self.backend, rng)
+        self.num_threads = num_threads
+        self._buckets = None
+        self.states = self.state_info[state_initial].state_num
+        if state_buckets:
+            self._buckets = StateBuckets(self.states, len(self.state_info.dict))
+        self.transition_times = self.rng.exponential(
             self.state_info[state_initial].lifetime, self.orientations.n
         )
         # The order of molecules isn't preserved, so we give them unique id's:
-        self.id = np.arange(self.orientations.n, dtype='int')
+        self.id = xp.arange(self.orientations.n, dtype=columns['id'])
+        if weighted:
+            self.weights = 1
+        self._dead = xp.zeros(0, dtype='int64')  # Slots of deleted molecules
+        # See declare_measurements; None means we don't prune anybody:
+        self._measured, self._pulses, self._prunable = None, [], None
         # We record molecular orientation and time for each spontaneous
         # transition. We use this information to simulate measurements,
         # since spontaneous transitions (e.g. excited->ground) are often
-        # associated with emitting light:
-        self.transition_events = {k: [] for k in ('x', 'y', 'z', 't', 'initial_state', 'final_state')}
+        # associated with emitting light. Events are kept per (initial,
+        # final) pair (see utils.event_log); coordinates are stored like
+        # our orientations (float32 in compact precision), times always
+        # in float64:
+        f = columns['x']
+        fields = {'x': f, 'y': f, 'z': f, 't': 'float64'}
+        if weighted:
+            fields['weight'] = f
+        self.event_log = EventLog(fields, self.backend, event_dir)
+        self.detectors = []  # See attach
+
+    @staticmethod
+    def columns(per_molecule_rot_diffusion_time=False, precision='double', weighted=False):
+        """The MoleculeStore columns that FluorophoreCollection needs."""
+        columns = Orientations.columns(per_molecule_rot_diffusion_time, precision)
+        if precision == 'double':
+            columns.update({'states': 'uint8', 'transition_times': 'float64', 'id': 'int64'})
+        else:
+            columns.update({'states': 'uint8', 'transition_times': 'float32', 'id': 'uint32'})
+        if weighted:
+            columns['weights'] = 'float64' if precision == 'double' else 'float32'
+        return columns
+
+    @property
+    def num_alive(self):
+        """Number of molecules that haven't been deleted."""
+        return self._store.n - len(self._dead)
+
+    @property
+    def rng(self):
+        return self.orientations.rng  # Shared, so there's one stream to seed
+
+    def reseed(self, seed):
+        """
+        Draw every random number from a new generator from now on.
+
+        Copies of a collection (e.g. one per repetition of an experiment)
+        copy its generator too, so they'd draw the same numbers; give
+        each copy its own child of a SeedSequence instead.
+
+        Parameters:
+        seed (int, np.random.SeedSequence or generator): See Backend.rng
+        """
+        self.orientations.rng = self.backend.rng(seed)
+
+    def declare_measurements(self, transitions, pulses=()):
+        """
+        Declare which spontaneous transitions we'll measure, and which
+        phototransitions are still to come. From then on, molecules
+        that enter a state that can't lead to a measured transition
+        anymore (see PossibleStates.live_states) are deleted right
+        away, even in the middle of a time_evolve, so we stop stepping
+        and storing them as early as possible.
+
+        Each phototransition must be the next one in 'pulses'; once it's
+        happened, molecules that could only reach a measurement through
+        it are deleted too. Measured transitions are still recorded as
+        usual, before the molecule is deleted.
+
+        Parameters:
+        transitions (iterable): (initial_state, final_state) of each transition we'll measure
+        pulses (iterable): (initial_state, final_states) of each
+                           phototransition still to come, in order,
+                           like the arguments of phototransition
+        """
+        self._measured = [(i, f) for i, f in transitions]
+        self._pulses = [(i, f) for i, f in pulses]
+        self._update_prunable()
+        self._prune_everybody()
+        self._compact_if_needed()
+
+    def subscribe(self, initial_state, final_state, collection_times=None, fields=('x', 'y', 'z', 't')):
+        """
+        Only record the spontaneous transitions we'll actually look at.
+        Without any subscriptions we record every transition; once there
+        are some, we only record transitions from 'initial_state' to
+        'final_state' (for each subscription), during 'collection_times',
+        and only their 'fields'. Everything else is dropped before it's
+        even gathered. Subscribing to the same transition again adds
+        to its windows and fields.
+
+        Subscribe before the first time_evolve.
+
+        Parameters:
+        initial_state, final_state (int or str): The transition to record
+        collection_times (tuple): (start, stop) time window (inclusive),
+                                  or a list of them; default is all times.
+                                  An empty list records nothing (e.g. when
+                                  a detector counts them instead; see attach)
+        fields (iterable): Any of 'x', 'y', 'z', 't'. In weighted mode,
+                           'weight' is always recorded too.
+        """
+        assert initial_state in self.state_info
+        assert final_state in self.state_info
+        if collection_times is not None and numpy.shape(collection_times) == (2,):
+            collection_times = [collection_times]  # Just the one window
+        fields = tuple(fields) + (('weight',) if self.weighted else ())
+        self.event_log.subscribe(self.state_info[initial_state].state_num,
+                                 self.state_info[final_state].state_num,
+                                 collection_times, fields)
+
+    def attach(self, detector):
+        """
+        Hand every spontaneous transition to 'detector' (e.g. a
+        detectors.PolarizationDetector) as it happens, whether or not
+        we record it.
+        """
+        detector.attach(self)
+
+    def _prune_everybody(self):
+        xp = self.backend.xp
+        if self._buckets is None:
+            self._prune(xp.flatnonzero(self.states != DEAD))
+        else:  # Only look at the molecules in prunable states
+            doomed = numpy.flatnonzero(backends.to_host(self._prunable)[:len(self.state_info.dict)])
+            self._prune(xp.concatenate(
+                [xp.zeros(0, dtype='int64')] + [self._in_state(s) for s in doomed]))
+
+    def _update_prunable(self):
+        live = self.state_info.live_states(self._measured, self._pulses)
+        prunable = numpy.zeros(DEAD + 1, dtype=bool)  # Indexed by state number
+        prunable[:len(live)] = ~live  # DEAD stays False; they're already deleted
+        self._prunable = self.backend.xp.asarray(prunable)
+
+    def _next_pulse(self, initial_state, final_states):
+        """Check a phototransition against the declared pulses."""
+        assert len(self._pulses) > 0, "This phototransition wasn't declared (see declare_measurements)"
+        initial, finals = self._pulses.pop(0)
+        nums = lambda states: set(self.state_info.get_state_num_and_lifetime(states)[0].tolist())
+        assert (self.state_info[initial].state_num == self.state_info[initial_state].state_num
+                and nums(finals) == nums(final_states)), (
+            f"Expected the phototransition {initial}->{finals} (see declare_measurements)")
+
+    def _prune(self, idx, target_time=None):
+        """
+        Delete the molecules in 'idx' (indices) whose states can't lead
+        to a measured transition anymore, and fast-forward their clocks
+        to 'target_time', if given. Returns the rest of 'idx'.
+        """
+        if self._prunable is None:
+            return idx
+        doomed = self._prunable[self.states[idx]]
+        if doomed.any():
+            dead = idx[doomed]
+            self._kill(dead)
+            if target_time is not None:  # Nobody will step them again
+                self.orientations.t_rel[dead] = target_time
+            idx = idx[~doomed]
+        return idx
+
+    # Per-molecule attributes are views of the store's columns:
+    @property
+    def states(self):
+        return self._store['states']
+
+    @states.setter
+    def states(self, value):
+        self._store['states'] = value
+        if self._buckets is not None:  # Start over
+            self._buckets = StateBuckets(self.states, len(self.state_info.dict))
+
+    @property
+    def transition_times_rel(self):
+        # Relative to self.orientations.epoch, like the clocks:
+        return self._store['transition_times']
+
+    @transition_times_rel.setter
+    def transition_times_rel(self, value):
+        self._store['transition_times'] = value
+
+    @property
+    def transition_times(self):
+        # A copy in compact precision, like Orientations.t
+        if self.orientations.precision == 'double':
+            return self._store['transition_times']
+        return self.orientations.epoch + self._store['transition_times']
+
+    @transition_times.setter
+    def transition_times(self, value):
+        self._store['transition_times'] = value - self.orientations.epoch
+
+    @property
+    def id(self):
+        return self._store['id']
+
+    @id.setter
+    def id(self, value):
+        self._store['id'] = value
+
+    @property
+    def transition_events(self):
+        """Every recorded event, in the layout we used to keep them in:
+        a list holding one array per field (a snapshot; see event_log)."""
+        return {k: [v] for k, v in self.event_log.to_dict().items()}
+
+    @property
+    def weights(self):
+        assert self.weighted, "Only weighted collections have weights"
+        return self._store['weights']
+
+    @weights.setter
+    def weights(self, value):
+        assert self.weighted, "Only weighted collections have weights"
+        self._store['weights'] = value
 
     def phototransition(
         self,
@@ -229,164 +904,393 @@ class FluorophoreCollection:
         intensity=1,  # Saturation units
         polarization_xyz=(0, 0, 1),  # Only the direction matters
     ):
-        if len(self.id) == 0:
+        xp = self.backend.xp
+        if self._measured is not None:
+            self._next_pulse(initial_state, final_states)
+        proposal = self._proposal(initial_state, final_states)
+        if self.num_alive == 0:
             return None  # No molecules, don't bother
 
         # Input sanitization
         assert initial_state in self.state_info
         initial_state = self.state_info[initial_state].state_num  # Ensure int
-        final_states, lifetimes = self.state_info.get_state_num_and_lifetime(final_states)
+        final_states, lifetimes = map(  # On our device
+            xp.asarray, self.state_info.get_state_num_and_lifetime(final_states))
 
         if final_states.shape == (1,):
             assert state_probabilities is None
         else:
-            state_probabilities = np.asarray(state_probabilities, 'float')
+            state_probabilities = xp.asarray(state_probabilities, 'float')
             assert state_probabilities.shape == final_states.shape
-            assert np.all(state_probabilities > 0)
+            assert xp.all(state_probabilities > 0)
             state_probabilities /= state_probabilities.sum()  # Sums to 1
 
         assert intensity > 0
-        polarization_xyz = np.asarray(polarization_xyz, dtype='float')
+        polarization_xyz = numpy.asarray(polarization_xyz, dtype='float')  # Host scalars
         assert polarization_xyz.shape == (3,)
-        polarization_xyz /= np.linalg.norm(polarization_xyz)  # Unit vector
+        polarization_xyz /= numpy.linalg.norm(polarization_xyz)  # Unit vector
         # A linearly polarized pulse of light, oriented in an arbitrary
         # direction, drives molecules to change their state. The
         # 'effective intensity' for each molecule varies like the square
         # of the cosine of the angle between the light's polarization
         # direction and the molecular orientation.
-        i = (self.states == initial_state)  # Who's in the initial state?
-        px, py, pz, = np.sqrt(intensity) * polarization_xyz
+        # One pass over the states (or a look in its bucket) finds who's
+        # in the initial state; after that, we only ever touch those
+        # molecules, by index:
+        i = self._in_state(initial_state)
+        polarization_xyz = numpy.sqrt(intensity) * polarization_xyz
+        if not self._threaded_phototransition(i):
+            selected = self._phototransition(
+                i, final_states, lifetimes, state_probabilities, polarization_xyz, self.rng,
+                proposal)
+        else:  # Chunks of the molecules in the initial state, in parallel
+            selected = threads.run(
+                lambda s, rng: self._phototransition(
+                    i[s], final_states, lifetimes, state_probabilities, polarization_xyz, rng,
+                    proposal),
+                len(i), self.num_threads, self.rng)
+            selected = xp.concatenate([i[:0]] + selected)
+        if self._buckets is not None:
+            self._buckets.moved(selected, initial_state, self.states[selected], self.states)
+        if self._measured is not None:
+            # This pulse is over, so some states might be dead ends now:
+            self._update_prunable()
+            self._prune_everybody()
+            self._compact_if_needed()
+
+    def _proposal(self, initial_state, final_states):
+        """
+        How a pulse picks who's photoselected: 'sample' flips a coin
+        per molecule; for weighted molecules, 'all' selects everybody
+        and 'none' nobody, weighting them by the probability of that.
+        We only skip sampling when the other outcome can't lead to a
+        measured transition (see declare_measurements) anymore, so it
+        would have been deleted anyway.
+        """
+        if not (self.weighted and self._measured is not None):
+            return 'sample'
+        live = self.state_info.live_states(self._measured, self._pulses)  # After this pulse
+        final_states, _ = self.state_info.get_state_num_and_lifetime(final_states)
+        if not live[self.state_info[initial_state].state_num]:
+            return 'all'
+        if not live[final_states].any():
+            return 'none'
+        return 'sample'
+
+    def _threaded_phototransition(self, i):
+        """Should we photoselect the molecules 'i' (indices) with threads?"""
+        if self.num_threads is None:
+            return False
+        if self.orientations.kernel != 'adaptive':
+            return True
+
+        def prepare(num_threads):
+            # Time a pulse like ours, on a throwaway population of size n
+            def prepare_n(n):
+                c = FluorophoreCollection(
+                    n, 1, PossibleStates(ElectronicState('ground')),
+                    precision=self.orientations.precision,
+                    num_threads=num_threads, backend=self.backend, rng=0)
+                return lambda: c.phototransition('ground', 'ground')
+            return prepare_n
+
+        choice = dispatch.get(
+            f"FluorophoreCollection.phototransition/{self.orientations.precision}/"
+            f"{self.backend.name}/{self.num_threads} threads",
+            {'numpy': prepare(None), 'numpy-threaded': prepare(self.num_threads)},
+        ).choose(len(i))
+        return choice == 'numpy-threaded'
+
+    def _phototransition(self, i, final_states, lifetimes, state_probabilities, polarization_xyz, rng,
+                         proposal='sample'):
+        xp = self.backend.xp
+        # 'i' are the indices of the molecules in the initial state
+        px, py, pz, = polarization_xyz
         o = self.orientations  # Temporary short nickname
         effective_intensity = (px*o.x[i] + py*o.y[i] + pz*o.z[i])**2  # Dot prod.
         selection_prob = 1 - 2**(-effective_intensity)  # Saturation units
-        selected = np.random.uniform(0, 1, len(selection_prob)) <= selection_prob
+        if proposal == 'sample':
+            selected = i[rng.uniform(0, 1, len(selection_prob)) <= selection_prob]
+        elif proposal == 'all':  # Weighted; see _proposal
+            self.weights[i] *= selection_prob
+            selected = i
+        else:  # Nobody changes state; only their weights do
+            self.weights[i] *= 1 - selection_prob
+            return i[:0]
         # Every photoselected molecule now changes to a new state. If
         # multiple 'final_states' are specified, the new state is
         # randomly selected according to 'state_probabilities'. New
         # 'transition_times' are randomly drawn for each new state from
-        # an exponential distribution given by 'lifetimes'.
-        t = o.t[i][selected]  # The current time
-        tr_t = self.transition_times[i]  # A copy of relevant transition times
+        # an exponential distribution given by 'lifetimes'. 'selected'
+        # are indices too, so we scatter straight into our arrays.
+        t = o.t_rel[selected]  # The current time
         if state_probabilities is None:
-            self.states[i] = np.where(selected, final_states, self.states[i])
-            tr_t[selected] = t + np.random.exponential(lifetimes, t.shape)
+            self.states[selected] = final_states
+            self.transition_times_rel[selected] = t + rng.exponential(lifetimes, t.shape)
         else:
-            which_state = np.random.choice(
-                np.arange(len(final_states), dtype='int'),
+            which_state = rng.choice(
+                xp.arange(len(final_states), dtype='int'),
                 size=t.shape, p=state_probabilities)
-            ss = self.states[i]  # A copy of the relevant states
-            ss[selected] = final_states[which_state]
-            self.states[i] = ss
-            tr_t[selected] = t + np.random.exponential(lifetimes[which_state])
-        self.transition_times[i] = tr_t
+            self.states[selected] = final_states[which_state]
+            self.transition_times_rel[selected] = t + rng.exponential(lifetimes[which_state])
+        return selected  # Indices of the molecules that changed state
 
     def time_evolve(self, delta_t):
-        if len(self.id) == 0:
+        xp = self.backend.xp
+        if self.num_alive == 0:
             return None  # No molecules, don't bother
         assert delta_t > 0
         o = self.orientations  # Local nickname
-        assert np.isclose(np.amin(o.t), np.amax(o.t)) # Orientations are synchronized
-        target_time = o.t[0] + delta_t
-        while np.any(o.t < target_time):
+        assert xp.isclose(xp.amin(o.t_rel), xp.amax(o.t_rel)) # Orientations are synchronized
+        if o.precision == 'compact':  # Keep relative times small
+            self.transition_times_rel -= o.rebase()
+        # From here on, every time is relative to o.epoch:
+        target_time = o.t_rel[0] + delta_t
+        # Dead molecules never transition, and fast-forwarding their
+        # clocks means neither engine will bother stepping them:
+        o.t_rel[self._dead] = target_time
+        if self.engine == 'event':
+            self._time_evolve_events(target_time)
+        else:
+            self._time_evolve_sorted(target_time)
+        self._compact_if_needed()  # Not in the middle, while we're using indices
+        return None
+
+    def _time_evolve_events(self, target_time):
+        xp = self.backend.xp
+        # Molecules evolve independently between transitions, so there's
+        # no need to keep the whole population in time order. The first
+        # pass steps everybody to their next transition (or the target
+        # time, whichever comes first). After that, each pass only
+        # touches the molecules that just transitioned and are due to
+        # transition again before the target time.
+        o = self.orientations  # Local nickname
+        due = None  # Everybody, on the first pass
+        while True:
+            if due is None:
+                t_next = xp.minimum(target_time, self.transition_times_rel)
+                dt = t_next - o.t_rel
+                moving = None if xp.all(dt > 0) else xp.flatnonzero(dt > 0)
+            else:
+                t_next = xp.minimum(target_time, self.transition_times_rel[due])
+                dt = t_next - o.t_rel[due]
+                moving = due[dt > 0]
+                dt = dt[dt > 0]
+            # Update the orientations
+            if moving is None:
+                o.step(dt)
+            elif moving.size > 0:
+                o.step(dt if due is not None else dt[moving], moving)
+            # Assign (rather than add) the new times, so molecules land
+            # exactly on their transition times:
+            if due is None:
+                o.t_rel = t_next
+                due = xp.flatnonzero(o.t_rel >= self.transition_times_rel)
+            else:
+                o.t_rel[due] = t_next
+                due = due[o.t_rel[due] >= self.transition_times_rel[due]]
+            if due.size == 0:
+                break  # Nobody else transitions before the target time
+            # Calculate and record spontaneous transitions
+            states = self.states[due]  # Copy of states that change
+            t = o.t_rel[due]
+            final_states, transition_times = self._draw_spontaneous_transitions(states, t)
+            self._record(due, states, final_states, t)
+            self.states[          due] = final_states
+            self.transition_times_rel[due] = transition_times
+            if self._buckets is not None:
+                self._buckets.moved(due, states, final_states, self.states)
+            due = self._prune(due, target_time)
+
+    def _time_evolve_sorted(self, target_time):
+        xp = self.backend.xp
+        o = self.orientations  # Local nickname
+        while xp.any(o.t_rel < target_time):
             # How much shall we step each molecule in time?
-            dt = np.minimum(target_time, self.transition_times) - o.t
+            dt = xp.minimum(target_time, self.transition_times_rel) - o.t_rel
             idx = self._sort_by(dt)
             dt = dt if idx is None else dt[idx]  # Skip if dt is already sorted
-            s = slice(np.searchsorted(dt, np.array(0), 'right'), None)  # Skip dt == 0
+            first = xp.searchsorted(dt, xp.array(0), 'right')  # Skip dt == 0
+            s = slice(first, None) if idx is None else idx[first:]
             # Update the orientations
-            o.x[s], o.y[s], o.z[s] = diffusive_steps.safe_diffusive_step(
-                o.x[s], o.y[s], o.z[s], (dt/o.rot_diffusion_time)[s])
-            o.t[s] += dt[s]
+            o.step(dt[first:], s)
+            o.t_rel[s] += dt[first:]
             # Calculate and record spontaneous transitions
-            transitioning = (o.t >= self.transition_times)
+            transitioning = (o.t_rel >= self.transition_times_rel)
             states = self.states[transitioning]  # Copy of states that change
             if states.size == 0:
                 continue  # No states change; skip ahead.
-            t = o.t[transitioning]
-            self.transition_events['initial_state'].append(states)
-            self.transition_events['t'            ].append(t)
-            self.transition_events['x'            ].append(o.x[transitioning])
-            self.transition_events['y'            ].append(o.y[transitioning])
-            self.transition_events['z'            ].append(o.z[transitioning])
-            idx = np.argsort(states)
-            states = states[idx]  # A sorted copy of the states that change
-            t = t[idx]
-            transition_times = np.empty(len(states), dtype='float')
-            state_slices = [slice(np.searchsorted(states, np.array(initial_state), 'left'),
-                                  np.searchsorted(states, np.array(initial_state), 'right'))
-                            for initial_state in range(len(self.state_info.dict.keys()))]
-            for initial_state, s in enumerate(state_slices):
-                if s.start == s.stop:
-                    continue
-                fs = self.state_info[initial_state].transition_states
-                final_states, lifetimes = self.state_info.get_state_num_and_lifetime(fs)
-                probabilities = self.state_info[initial_state].probabilities
-                which_final = np.random.choice(
-                    np.arange(len(final_states), dtype='int'),
-                    size=int(s.stop-s.start), p=probabilities)
-                states[s] = final_states[which_final]
-                transition_times[s] = t[s] + np.random.exponential(lifetimes[which_final])
-            # Undo our sorting of states and transition times, update originals
-            idx_rev = np.empty_like(idx)
-            idx_rev[idx] = np.arange(len(idx), dtype=idx.dtype)
-            final_states = states[idx_rev]
-            self.transition_events['final_state'].append(final_states)
+            t = o.t_rel[transitioning]
+            final_states, transition_times = self._draw_spontaneous_transitions(states, t)
+            transitioning = xp.flatnonzero(transitioning)
+            self._record(transitioning, states, final_states, t)
             self.states[          transitioning] = final_states
-            self.transition_times[transitioning] = transition_times[idx_rev]
-        return None
+            self.transition_times_rel[transitioning] = transition_times
+            if self._buckets is not None:
+                self._buckets.moved(transitioning, states, final_states, self.states)
+            if self._prunable is not None:
+                self._prune(transitioning, target_time)
+
+    def _record(self, idx, initial_states, final_states, t):
+        """Record the transitions of molecules 'idx' (indices) at
+        (relative) times 't', or the ones somebody subscribed to, and
+        show them all to our detectors."""
+        o = self.orientations  # Local nickname
+        log = self.event_log
+        t = o.epoch + t
+        for detector in self.detectors:
+            detector.detect(self, idx, initial_states, final_states, t)
+        # Decide who to keep from states and times alone, before we
+        # gather anybody's orientation:
+        keep = log.wanted(initial_states, final_states, t)
+        if keep is not None:
+            if not bool(keep.any()):
+                return None  # Nothing anybody wants
+            idx, initial_states, final_states, t = (
+                idx[keep], initial_states[keep], final_states[keep], t[keep])
+        fields = log.fields
+        columns = {k: getattr(o, k)[idx] for k in ('x', 'y', 'z') if k in fields}
+        if 't' in fields:
+            columns['t'] = t
+        if 'weight' in fields:
+            columns['weight'] = self.weights[idx]
+        log.append(initial_states, final_states, columns)
+
+    def _draw_spontaneous_transitions(self, states, t):
+        """Draw a final state and a new transition time for each molecule
+        that just left 'states' at time 't'."""
+        # Every molecule at once, whatever state it's leaving, from the
+        # compiled tables (see TransitionTables):
+        tables = self.state_info.compile()
+        uniform = self.rng.uniform(0, 1, len(states)) if tables.branching else None
+        final_states, lifetimes = tables.draw(states, uniform)
+        return final_states, t + self.rng.exponential(lifetimes)
 
     def get_xyz_for_state(self, state):
         assert state in self.state_info
         state = self.state_info[state].state_num  # Ensure int
-        idx = (self.states == state)
+        idx = self._in_state(state)
         o = self.orientations  # Local nickname
         return o.x[idx], o.y[idx], o.z[idx]
 
+    def get_ids_for_state(self, state):
+        assert state in self.state_info
+        return self.id[self._in_state(self.state_info[state].state_num)]
+
+    def _in_state(self, state):
+        """Indices of the molecules in 'state' (a state number), in storage order."""
+        if self._buckets is not None:
+            return self._buckets.get(state, self.states)
+        return self.backend.xp.flatnonzero(self.states == state)
+
     def get_xyzt_at_transitions(self, initial_state, final_state):
+        """x, y, z and t of each recorded transition; fields we didn't
+        record (see subscribe) are None. If we spill events to disk,
+        this reads them all back into memory (see EventLog.segments)."""
+        x, y, z, t, _ = self._get_transitions(initial_state, final_state)
+        return x, y, z, t
+
+    def _get_transitions(self, initial_state, final_state):
+        """x, y, z, t and weight of each recorded transition from
+        'initial_state' to 'final_state'. Weights are 1 unless we're
+        weighted; fields we didn't record are None."""
+        xp = self.backend.xp
         assert initial_state in self.state_info
         assert final_state in self.state_info
-        # We built 'self.transition_events' by appending 1D numpy arrays
-        # to lists. Now's a good time to join each list of arrays into
-        # a single array:
-        if len(self.transition_events['t']) == 0: # No transitions yet
-               return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
-        if len(self.transition_events['t']) > 1:
-            for k, v in self.transition_events.items():
-                self.transition_events[k] = [np.concatenate(v)]
-        # Select only the records that correspond to a particular transition:
-        e = self.transition_events # Local nickname
-        tr = ((e['initial_state'][0] == self.state_info[initial_state].state_num) &
-              (e[  'final_state'][0] == self.state_info[  final_state].state_num))
-        x, y, z, t = e['x'][0][tr], e['y'][0][tr], e['z'][0][tr], e['t'][0][tr]
-        return x, y, z, t
+        # The log keeps each pair's events together; these are views:
+        e = self.event_log.get(self.state_info[initial_state].state_num,
+                               self.state_info[final_state].state_num)
+        n = len(next(iter(e.values())))
+        w = e['weight'] if self.weighted else xp.ones(n)
+        return e.get('x'), e.get('y'), e.get('z'), e.get('t'), w
+
+    def get_expected_counts(self, initial_state, final_state, collection_times=None):
+        """
+        Expected number of photons a polarizing beam splitter would
+        send to its x and y channels, from the recorded transitions
+        from 'initial_state' to 'final_state'. Each photon goes to the
+        x channel with probability x^2 and to y with probability y^2,
+        so we add those up rather than flipping a coin per photon; in
+        weighted mode, each transition counts with its molecule's
+        weight. Like SpectralFluorophoreCollection.get_expected_counts.
+
+        Parameters:
+        initial_state, final_state (int or str): The transition to count
+        collection_times (tuple): (start, stop) time window; default is everything so far
+
+        Returns:
+        tuple: (transitions, photons_x, photons_y), floats
+        """
+        xp = self.backend.xp
+        assert initial_state in self.state_info
+        assert final_state in self.state_info
+        counts = [0.0, 0.0, 0.0]
+        # A piece at a time, so a log spilled to disk isn't read into
+        # memory all at once (see EventLog.segments):
+        for e in self.event_log.segments(self.state_info[initial_state].state_num,
+                                         self.state_info[final_state].state_num):
+            assert 'x' in e and 'y' in e, "Subscribe to 'x' and 'y' to count photons"
+            x, y = e['x'], e['y']
+            w = e['weight'] if self.weighted else xp.ones(len(x))
+            if collection_times is not None:
+                assert 't' in e, "Subscribe to 't' to gate counts"
+                gated = (e['t'] >= collection_times[0]) & (e['t'] <= collection_times[1])
+                x, y, w = x[gated], y[gated], w[gated]
+            counts[0] += float(w.sum())
+            counts[1] += float((w * x**2).sum())
+            counts[2] += float((w * y**2).sum())
+        return tuple(counts)
 
     def delete_fluorophores_in_state(self, state):
-        if len(self.id) == 0:
+        if self.num_alive == 0:
             return None # No molecules, don't bother
         assert state in self.state_info
         state = self.state_info[state].state_num  # Convert to int
-        idx = (self.states != state)
-        self.states = self.states[idx]
-        self.transition_times = self.transition_times[idx]
-        o = self.orientations # Local nickname
-        o.x, o.y, o.z, o.t = o.x[idx], o.y[idx], o.z[idx], o.t[idx]
-        if o.rot_diffusion_time.shape == (o.n,):
-            o.rot_diffusion_time = o.rot_diffusion_time[idx]
-        o.n = len(o.t)
-        self.id = self.id[idx]
+        # Mark the molecules dead, rather than reallocating (or even
+        # compacting) every per-molecule array on every call:
+        self._kill(self._in_state(state))
+        if self._buckets is not None:
+            self._buckets.clear(state)  # Nobody's left
+        self._compact_if_needed()
+
+    def _kill(self, dead):
+        """Mark the molecules 'dead' (indices) deleted."""
+        xp = self.backend.xp
+        old_states = self.states[dead]
+        self.states[dead] = DEAD
+        if self._buckets is not None:
+            self._buckets.moved(dead, old_states, DEAD, self.states)
+        self.transition_times_rel[dead] = xp.inf
+        self._dead = xp.concatenate((self._dead, dead))
+
+    def _compact_if_needed(self):
+        if len(self._dead) > self.compaction_threshold * self._store.n:
+            self.compact()
+
+    def compact(self):
+        """Drop the slots of deleted molecules from every per-molecule array."""
+        xp = self.backend.xp
+        if len(self._dead) == 0:
+            return None
+        self._store.keep(self.states != DEAD)
+        self._dead = xp.zeros(0, dtype='int64')
+        if self._buckets is not None:  # Everybody's moved
+            self._buckets = StateBuckets(self.states, len(self.state_info.dict))
 
     def _sort_by(self, x):
-        x = np.asarray(x)
+        """
+        Find a permutation that sorts 'x' (one entry per molecule).
+
+        We don't move any molecules; the permutation is kept in the
+        store's 'order', and reused if 'x' is still sorted in that
+        order. Returns None if 'x' is already sorted in storage order.
+        """
+        xp = self.backend.xp
+        x = xp.asarray(x)
         assert x.shape == self.id.shape
-        x_is_sorted = np.all(np.diff(x) >= 0)
+        order = self._store.order
+        x = x if order is None else x[order]
+        x_is_sorted = xp.all(xp.diff(x) >= 0)
         if x_is_sorted:
-            return None
-        idx = np.argsort(x)
-        self.states = self.states[idx]
-        self.transition_times = self.transition_times[idx]
-        o = self.orientations  # Local nickname
-        o.x, o.y, o.z, o.t = o.x[idx], o.y[idx], o.z[idx], o.t[idx]
-        if o.rot_diffusion_time.size == o.n:
-            o.rot_diffusion_time = o.rot_diffusion_time[idx]
-        self.id = self.id[idx]
-        return idx
+            return order
+        return self._store.reorder(xp.argsort(x))
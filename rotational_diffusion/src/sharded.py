@@ -0,0 +1,273 @@
+import gc
+import io
+import multiprocessing
+import os
+import pickle
+import weakref
+from multiprocessing import shared_memory
+
+from rotational_diffusion.src import backends
+from rotational_diffusion.src.fluorophore import FluorophoreCollection, PossibleStates
+from rotational_diffusion.src.utils import compiled
+from rotational_diffusion.src.utils.molecule_store import MoleculeStore
+import numpy
+
+
+class ShardedFluorophoreCollection:
+    """
+    A FluorophoreCollection that's split into 'num_shards' shards, each
+    a FluorophoreCollection living in its own worker process, so one
+    big simulation can use every core on a CPU.
+
+    Calls to phototransition, time_evolve, delete_fluorophores_in_state
+    and compact are broadcast to every shard, which run them
+    concurrently. Recorded transitions stay with their shards until you
+    ask for them (get_xyzt_at_transitions), when they're merged.
+
+    Each shard keeps its per-molecule arrays in a block of shared
+    memory, so copying a sharded collection (e.g. copy.deepcopy, once
+    per repetition of an experiment) is a plain memory copy, rather than
+    pickling every array through a pipe.
+
+    Each shard has its own random number generator, seeded from
+    np.random when the shard starts, so seeding np.random still makes
+    a simulation reproducible (for a fixed number of shards). If you
+    give an 'rng' (a seed or a generator), each shard draws from its
+    own child stream of it instead.
+
+    Worker processes stop when the collection is garbage collected, or
+    when you call close().
+
+    Parameters:
+    num_molecules (int): Total number of molecules
+    rot_diffusion_time (float or np.ndarray): Like FluorophoreCollection
+    state_info (PossibleStates): Like FluorophoreCollection
+    num_shards (int): Number of worker processes; default is one per CPU
+    **kwargs: Passed on to each shard's FluorophoreCollection
+    """
+    def __init__(
+            self,
+            num_molecules,
+            rot_diffusion_time,
+            state_info: PossibleStates,
+            num_shards=None,
+            **kwargs,
+    ):
+        assert backends.get(kwargs.get('backend')).is_host  # Shared memory lives on the host
+        n = int(num_molecules)
+        num_shards = os.cpu_count() if num_shards is None else int(num_shards)
+        num_shards = max(1, min(num_shards, n))
+        rot_diffusion_time = numpy.asarray(rot_diffusion_time)
+        assert n >= 1
+        assert isinstance(state_info, PossibleStates)
+        assert rot_diffusion_time.shape in ((), (1,), (n,))
+        assert kwargs.get('precision', 'double') == 'double' or n < 2**32  # uint32 ids
+        self.num_molecules = n
+        self.num_shards = num_shards
+        self.weighted = kwargs.get('weighted', False)  # Like FluorophoreCollection.weighted
+        rng = kwargs.pop('rng', None)
+        seeds = None
+        if rng is not None:  # A stream per shard, and a seed for its worker
+            seeds = [child.spawn(2) for child in backends.seed_sequence(rng).spawn(num_shards)]
+        setups = []
+        for i in range(num_shards):
+            start, stop = n * i // num_shards, n * (i + 1) // num_shards
+            rdt = rot_diffusion_time
+            if rdt.shape == (n,):
+                rdt = rdt[start:stop]
+            columns = FluorophoreCollection.columns(
+                rdt.shape == (stop - start,) and stop - start > 1,
+                kwargs.get('precision', 'double'),
+                kwargs.get('weighted', False))
+            nbytes = MoleculeStore.nbytes(stop - start, columns)
+            shard_kwargs = kwargs if seeds is None else dict(kwargs, rng=seeds[i][0])
+            setups.append((nbytes, None, (start, (stop - start, rdt, state_info), shard_kwargs)))
+        self._start(setups, None if seeds is None else
+                    [int(worker_seed.generate_state(1)[0]) for _, worker_seed in seeds])
+
+    def _start(self, setups, seeds=None):
+        """Start one worker per (nbytes, source, setup). 'setup' is either
+        the arguments for a new FluorophoreCollection, or a pickled one
+        whose arrays we copy from the shared memory 'source'. Each
+        worker's global generators are seeded from 'seeds', by default
+        drawn from np.random."""
+        self._shm, self._conns, self._workers = [], [], []
+        # Make sure we clean up, even if nobody calls close():
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self._shm, self._conns, self._workers)
+        if seeds is None:
+            seeds = numpy.random.randint(0, 2**32, len(setups), dtype='int64')
+        for (nbytes, source, setup), seed in zip(setups, seeds):
+            shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            self._shm.append(shm)
+            if source is not None:
+                shm.buf[:source.size] = source.buf  # Copy another shard's arrays
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_serve, args=(child_conn, shm.name, int(seed), setup), daemon=True)
+            worker.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+        self._broadcast('num_alive')  # Wait until every shard is ready
+
+    def _broadcast(self, name, *args, **kwargs):
+        """Call a method (or get an attribute) of every shard's
+        FluorophoreCollection, concurrently. Returns a list of results."""
+        return self._scatter(name, [args] * self.num_shards, kwargs)
+
+    def _scatter(self, name, args, kwargs={}):
+        """Like _broadcast, with different arguments 'args[i]' for shard i."""
+        assert self._finalizer.alive, "This collection has been closed."
+        for conn, a in zip(self._conns, args):
+            conn.send((name, a, kwargs))
+        replies = [conn.recv() for conn in self._conns]
+        for status, result in replies:
+            if status == 'error':
+                raise result
+        return [result for status, result in replies]
+
+    @property
+    def num_alive(self):
+        """Number of molecules that haven't been deleted."""
+        return sum(self._broadcast('num_alive'))
+
+    def reseed(self, seed):
+        """Like FluorophoreCollection.reseed; each shard gets its own
+        child stream of 'seed'."""
+        children = backends.seed_sequence(seed).spawn(self.num_shards)
+        self._scatter('reseed', [(child,) for child in children])
+
+    def declare_measurements(self, transitions, pulses=()):
+        """Like FluorophoreCollection.declare_measurements, on every shard at once."""
+        self._broadcast('declare_measurements', list(transitions), list(pulses))
+
+    def subscribe(self, initial_state, final_state, collection_times=None, fields=('x', 'y', 'z', 't')):
+        """Like FluorophoreCollection.subscribe, on every shard at once."""
+        self._broadcast('subscribe', initial_state, final_state, collection_times, tuple(fields))
+
+    def phototransition(self, *args, **kwargs):
+        """Like FluorophoreCollection.phototransition, on every shard at once."""
+        self._broadcast('phototransition', *args, **kwargs)
+
+    def time_evolve(self, delta_t):
+        """Like FluorophoreCollection.time_evolve, on every shard at once."""
+        self._broadcast('time_evolve', delta_t)
+
+    def delete_fluorophores_in_state(self, state):
+        """Like FluorophoreCollection.delete_fluorophores_in_state, on every shard at once."""
+        self._broadcast('delete_fluorophores_in_state', state)
+
+    def compact(self):
+        self._broadcast('compact')
+
+    def get_xyz_for_state(self, state):
+        xyz = self._broadcast('get_xyz_for_state', state)
+        return tuple(numpy.concatenate([s[k] for s in xyz]) for k in range(3))
+
+    def get_xyzt_at_transitions(self, initial_state, final_state):
+        # Each shard recorded its own transitions; join them up:
+        xyzt = self._broadcast('get_xyzt_at_transitions', initial_state, final_state)
+        return tuple(None if xyzt[0][k] is None else numpy.concatenate([s[k] for s in xyzt])
+                     for k in range(4))  # None: not recorded (see subscribe)
+
+    def get_expected_counts(self, initial_state, final_state, collection_times=None):
+        # Expected counts just add up over shards:
+        counts = self._broadcast('get_expected_counts', initial_state, final_state, collection_times)
+        return tuple(sum(c[k] for c in counts) for k in range(3))
+
+    def close(self):
+        """Stop the worker processes and free their shared memory."""
+        self._finalizer()
+
+    def __deepcopy__(self, memo):
+        # Each shard pickles everything except its per-molecule arrays,
+        # which we copy directly from shared memory to shared memory:
+        dumps = self._broadcast('_dump')
+        result = self.__class__.__new__(self.__class__)
+        memo[id(self)] = result
+        result.num_molecules = self.num_molecules
+        result.num_shards = self.num_shards
+        result.weighted = self.weighted
+        result._start([(shm.size, shm, dump) for shm, dump in zip(self._shm, dumps)])
+        return result
+
+
+## Worker side
+class _Pickler(pickle.Pickler):
+    # Pickle a collection, leaving out its shared-memory buffer
+    def __init__(self, file, buffer):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffer = buffer
+
+    def persistent_id(self, obj):
+        return 'buffer' if obj is self.buffer else None
+
+
+class _Unpickler(pickle.Unpickler):
+    # ...and unpickle it again, with a new buffer
+    def __init__(self, file, buffer):
+        super().__init__(file)
+        self.buffer = buffer
+
+    def persistent_load(self, pid):
+        assert pid == 'buffer'
+        return self.buffer
+
+
+def _serve(conn, shm_name, seed, setup):
+    """Worker process: own one shard, and run whatever we're sent."""
+    numpy.random.seed(seed)
+    if compiled.available:
+        compiled.seed(seed)
+    shm = shared_memory.SharedMemory(shm_name)
+    buffer = numpy.frombuffer(shm.buf, 'uint8')
+    if isinstance(setup, bytes):
+        collection = _Unpickler(io.BytesIO(setup), buffer).load()
+    else:
+        start, args, kwargs = setup
+        collection = FluorophoreCollection(*args, buffer=buffer, **kwargs)
+        collection.id += start  # Unique across shards
+    result = None
+    while True:
+        try:
+            name, args, kwargs = conn.recv()
+        except EOFError:
+            break  # Our owner is gone
+        if name == '_close':
+            break
+        try:
+            if name == '_dump':
+                f = io.BytesIO()
+                _Pickler(f, buffer).dump(collection)
+                result = f.getvalue()
+            else:
+                result = getattr(collection, name)
+                if callable(result):
+                    result = result(*args, **kwargs)
+            conn.send(('ok', result))
+        except Exception as e:
+            conn.send(('error', e))
+    conn.close()
+    # Let go of every view of the shared memory before closing it (our
+    # owner unlinks it):
+    del collection, buffer, result
+    gc.collect()
+    shm.close()
+
+
+def _shutdown(shms, conns, workers):
+    for conn in conns:
+        try:
+            conn.send(('_close', (), {}))
+        except (BrokenPipeError, OSError):
+            pass
+    for worker in workers:
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+    for conn in conns:
+        conn.close()
+    for shm in shms:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,275 @@
+## Spectral solver
+# Instead of simulating individual molecules, evolve each electronic
+# state's orientation distribution, f_s(n, t), as a truncated expansion
+# in (real, orthonormal) spherical harmonics. Every polarization
+# observable we measure only depends on low-order moments of these
+# distributions (e.g. the x channel sees <x^2>, which only has degree
+# 0 and 2 components), so we get noise-free expected photon counts in
+# a fraction of a second, rather than Monte Carlo estimates over 2e7
+# molecules and 10 repetitions.
+#
+# Between pulses, everything is linear: rotational diffusion decays the
+# degree-l coefficients at a rate l(l+1)/(2*rot_diffusion_time), and
+# spontaneous transitions move population between states (without
+# changing its orientation) at rates probability/lifetime. These two
+# commute, so we can step any amount of time exactly, with one matrix
+# exponential of the (tiny) states x states rate matrix.
+#
+# Pulses are the one nonlinear, non-band-limited part: the probability
+# of photoselection, 1 - 2**(-intensity * cos^2), multiplies the
+# distribution. We do that multiplication on a quadrature grid and
+# project the result back onto the harmonics up to 'max_degree'; that
+# truncation is the only approximation. Raise 'max_degree' for very
+# intense (saturating) pulses.
+import numpy
+
+from rotational_diffusion.src.fluorophore import PossibleStates
+
+
+class SpectralFluorophoreCollection:
+    """
+    The expected behaviour of a FluorophoreCollection, computed
+    deterministically. It accepts the same scheme calls
+    (phototransition, time_evolve, delete_fluorophores_in_state), but
+    instead of recording individual transitions, it gives expected
+    counts (see get_expected_counts).
+
+    Parameters:
+    num_molecules (float): Number of molecules (counts scale with it)
+    rot_diffusion_time (float): Rotational diffusion time, the same for every molecule
+    state_info (PossibleStates): The electronic states, as for FluorophoreCollection
+    orientation_initial (str): 'uniform' or 'polar' (everybody at the north pole)
+    state_initial (int or str): The state everybody starts in
+    max_degree (int): Highest degree of spherical harmonic we keep
+    """
+    def __init__(
+            self,
+            num_molecules,
+            rot_diffusion_time,
+            state_info: PossibleStates,
+            orientation_initial='uniform',
+            state_initial=0,
+            max_degree=16,
+    ):
+        assert num_molecules > 0
+        assert numpy.size(rot_diffusion_time) == 1  # One rot_diffusion_time for everybody
+        assert float(numpy.squeeze(rot_diffusion_time)) > 0
+        assert isinstance(state_info, PossibleStates)
+        assert state_initial in state_info
+        assert orientation_initial in ('uniform', 'polar')
+        assert max_degree >= 2  # The polarization observables are degree 2
+        self.num_molecules = num_molecules
+        self.rot_diffusion_time = float(numpy.squeeze(rot_diffusion_time))
+        self.state_info = state_info
+        self.max_degree = int(max_degree)
+        self.t = 0
+        # Counts are already expected values; there are no molecules to weigh:
+        self.weighted = False
+
+        # A product Gauss-Legendre (in cos(theta)) x uniform (in phi)
+        # quadrature grid, fine enough to project products of degree
+        # 2*max_degree exactly:
+        n_th, n_ph = self.max_degree + 2, 2 * self.max_degree + 4
+        cos_th, w_th = numpy.polynomial.legendre.leggauss(n_th)
+        phi = numpy.arange(n_ph) * 2 * numpy.pi / n_ph
+        cos_th, phi = [a.ravel() for a in numpy.meshgrid(cos_th, phi, indexing='ij')]
+        self._weights = numpy.repeat(w_th, n_ph) * 2 * numpy.pi / n_ph
+        sin_th = numpy.sqrt(1 - cos_th**2)
+        self._xyz = numpy.stack((sin_th * numpy.cos(phi), sin_th * numpy.sin(phi), cos_th))
+        self._degree, self._harmonics = _real_harmonics(self.max_degree, cos_th, phi)
+        # Projections of x^2, y^2, z^2 (degrees 0 and 2 only):
+        self._xyz2 = self._project(self._xyz**2)
+
+        # Kinetics: d(population)/dt = rates @ population
+        num_states = len(state_info.dict)
+        self._rates = numpy.zeros((num_states, num_states))
+        for state in state_info.dict.values():
+            if numpy.isinf(state.lifetime):
+                continue
+            final_states, _ = state_info.get_state_num_and_lifetime(state.transition_states)
+            self._rates[state.state_num, state.state_num] -= 1 / state.lifetime
+            for f, p in zip(final_states, state.probabilities):
+                self._rates[f, state.state_num] += p / state.lifetime
+        # Diffusive decay rate of each coefficient:
+        self._decay = self._degree * (self._degree + 1) / (2 * self.rot_diffusion_time)
+
+        # The state of the system: one row of coefficients per state,
+        # normalized so that the total population is 1.
+        self.coefficients = numpy.zeros((num_states, len(self._degree)))
+        s = state_info[state_initial].state_num
+        if orientation_initial == 'uniform':
+            self.coefficients[s, 0] = 1 / numpy.sqrt(4 * numpy.pi)
+        else:  # A delta function at the north pole, truncated
+            self.coefficients[s] = _real_harmonics(
+                self.max_degree, numpy.ones(1), numpy.zeros(1))[1][:, 0]
+        # Each time_evolve records (start time, duration, coefficients
+        # at the start), which is all we need to integrate emission
+        # over any time window later:
+        self._segments = []
+
+    def _project(self, values):
+        """Harmonic coefficients of function(s) sampled on our grid."""
+        return (values * self._weights) @ self._harmonics.T
+
+    def _synthesize(self, coefficients):
+        return coefficients @ self._harmonics
+
+    def _propagate(self, coefficients, dt, decay=None):
+        decay = self._decay if decay is None else decay
+        return _expm(self._rates * dt) @ coefficients * numpy.exp(-decay * dt)
+
+    @property
+    def populations(self):
+        """Expected number of molecules in each state (deleted ones don't count)."""
+        return self.num_molecules * numpy.sqrt(4 * numpy.pi) * self.coefficients[:, 0]
+
+    @property
+    def num_alive(self):
+        """Expected number of molecules that haven't been deleted."""
+        return self.populations.sum()
+
+    def phototransition(
+        self,
+        initial_state,  # Integer or string
+        final_states,  # Integer/string or iterable of integers/strings
+        state_probabilities=None,  # None, or array-like of floats
+        intensity=1,  # Saturation units
+        polarization_xyz=(0, 0, 1),  # Only the direction matters
+    ):
+        # Input sanitization, like FluorophoreCollection.phototransition
+        assert initial_state in self.state_info
+        initial_state = self.state_info[initial_state].state_num
+        final_states, _ = self.state_info.get_state_num_and_lifetime(final_states)
+        if final_states.shape == (1,):
+            assert state_probabilities is None
+            state_probabilities = numpy.ones(1)
+        else:
+            state_probabilities = numpy.asarray(state_probabilities, 'float')
+            assert state_probabilities.shape == final_states.shape
+            assert numpy.all(state_probabilities > 0)
+            state_probabilities = state_probabilities / state_probabilities.sum()
+        assert intensity > 0
+        polarization_xyz = numpy.asarray(polarization_xyz, dtype='float')
+        assert polarization_xyz.shape == (3,)
+        polarization_xyz /= numpy.linalg.norm(polarization_xyz)
+
+        # The photoselected part of the initial state's distribution,
+        # projected back onto our harmonics:
+        effective_intensity = intensity * (polarization_xyz @ self._xyz)**2
+        selection_prob = 1 - 2**(-effective_intensity)
+        selected = self._project(
+            self._synthesize(self.coefficients[initial_state]) * selection_prob)
+        self.coefficients[initial_state] -= selected
+        for f, p in zip(final_states, state_probabilities):
+            self.coefficients[f] += p * selected
+
+    def time_evolve(self, delta_t):
+        assert delta_t > 0
+        self._segments.append((self.t, delta_t, self.coefficients.copy()))
+        self.coefficients = self._propagate(self.coefficients, delta_t)
+        self.t += delta_t
+
+    def delete_fluorophores_in_state(self, state):
+        assert state in self.state_info
+        self.coefficients[self.state_info[state].state_num] = 0
+
+    def get_expected_counts(self, initial_state, final_state, collection_times=None):
+        """
+        Expected number of spontaneous transitions from 'initial_state'
+        to 'final_state', and the expected photons a polarizing beam
+        splitter would send to its x and y channels (each transition
+        goes to the x channel with probability x^2, like
+        get_detector_counts in the get_figures scripts).
+
+        Parameters:
+        initial_state, final_state (int or str): The transition to count
+        collection_times (tuple): (start, stop) time window; default is everything so far
+
+        Returns:
+        tuple: (transitions, photons_x, photons_y), floats
+        """
+        assert initial_state in self.state_info
+        assert final_state in self.state_info
+        i = self.state_info[initial_state].state_num
+        f = self.state_info[final_state].state_num
+        lifetime = self.state_info[i].lifetime
+        final_states, _ = self.state_info.get_state_num_and_lifetime(
+            self.state_info[i].transition_states)
+        rate = self.state_info[i].probabilities[final_states == f].sum() / lifetime
+        start, stop = (-numpy.inf, numpy.inf) if collection_times is None else collection_times
+        # Integrate the degree 0 and 2 coefficients (all that x^2 and y^2
+        # see) of the initial state over the window, segment by segment:
+        low = self._degree <= 2
+        degree, decay = self._degree[low], self._decay[low]
+        integral = numpy.zeros(low.sum())
+        for t0, dt, coefficients in self._segments:
+            a, b = max(start, t0), min(stop, t0 + dt)
+            if b <= a or rate == 0:
+                continue
+            c = self._propagate(coefficients[:, low], a - t0, decay)
+            for l in (0, 2):
+                k = degree == l
+                a_l = self._rates - decay[k][0] * numpy.eye(len(c))
+                integral[k] += (_integrated_expm(a_l, b - a) @ c[:, k])[i]
+        scale = self.num_molecules * rate
+        transitions = scale * numpy.sqrt(4 * numpy.pi) * integral[0]
+        photons_x, photons_y = scale * (self._xyz2[:2, low] @ integral)
+        return transitions, photons_x, photons_y
+
+
+def _real_harmonics(max_degree, cos_th, phi):
+    """
+    Real, orthonormal spherical harmonics up to 'max_degree'.
+
+    Returns:
+    tuple: (degree, harmonics); harmonics[k] is the k'th harmonic at
+           each point (cos_th, phi), and degree[k] is its degree. Each
+           degree l comes in order m = -l...l; the first is Y_00.
+    """
+    sin_th = numpy.sqrt(numpy.clip(1 - cos_th**2, 0, None))
+    # Normalized associated Legendre functions, by the usual stable recursions:
+    p = {(0, 0): numpy.full_like(cos_th, 1 / numpy.sqrt(4 * numpy.pi))}
+    for m in range(1, max_degree + 1):
+        p[m, m] = numpy.sqrt((2*m + 1) / (2*m)) * sin_th * p[m - 1, m - 1]
+    for m in range(max_degree):
+        p[m + 1, m] = numpy.sqrt(2*m + 3) * cos_th * p[m, m]
+    for m in range(max_degree + 1):
+        for l in range(m + 2, max_degree + 1):
+            a = numpy.sqrt((4*l*l - 1) / (l*l - m*m))
+            b = numpy.sqrt(((l - 1)**2 - m*m) / (4*(l - 1)**2 - 1))
+            p[l, m] = a * (cos_th * p[l - 1, m] - b * p[l - 2, m])
+    degree, harmonics = [], []
+    for l in range(max_degree + 1):
+        for m in range(-l, l + 1):
+            degree.append(l)
+            if m < 0:
+                harmonics.append(numpy.sqrt(2) * p[l, -m] * numpy.sin(-m * phi))
+            elif m == 0:
+                harmonics.append(p[l, 0])
+            else:
+                harmonics.append(numpy.sqrt(2) * p[l, m] * numpy.cos(m * phi))
+    return numpy.array(degree), numpy.array(harmonics)
+
+
+def _expm(a):
+    """Matrix exponential, by scaling and squaring a Taylor series.
+    Our matrices are (number of states)^2, so this is plenty."""
+    norm = numpy.abs(a).sum(axis=0).max()
+    squarings = max(0, int(numpy.ceil(numpy.log2(norm / 0.5)))) if norm > 0 else 0
+    a = a / 2**squarings
+    result = term = numpy.eye(len(a))
+    for k in range(1, 20):
+        term = term @ a / k
+        result = result + term
+    for _ in range(squarings):
+        result = result @ result
+    return result
+
+
+def _integrated_expm(a, t):
+    """The integral of expm(a*s) for s from 0 to t (Van Loan's trick)."""
+    n = len(a)
+    augmented = numpy.zeros((2*n, 2*n))
+    augmented[:n, :n] = a
+    augmented[:n, n:] = numpy.eye(n)
+    return _expm(augmented * t)[:n, n:]
@@ -1,5 +1,5 @@
 import os.path
-from rotational_diffusion.src import np
+from rotational_diffusion.src.backends import namespace, to_host
 import matplotlib.pyplot as plt
 import numpy
 plt.ioff()
@@ -57,19 +57,14 @@ def save_frame(molecule_properties, ids,
     alpha_2 = 0.25  # singlet state opacity
 
     # Retrieve desired fluorophore orientations
-    idxs = np.where(np.isin(molecule_properties.fluorophore_holder.id, ids))
+    xp = namespace(molecule_properties.fluorophore_holder.id)
+    idxs = xp.where(xp.isin(molecule_properties.fluorophore_holder.id, xp.asarray(ids)))
     o = molecule_properties.fluorophore_holder.orientations
     x, y, z = o.x[idxs], o.y[idxs], o.z[idxs]
     states_vec = molecule_properties.fluorophore_holder.states[idxs]
 
-    # Try getting properties from GPU if available
-    try:  # needed if on GPU
-        x = x.get()
-        y = y.get()
-        z = z.get()
-        states_vec = states_vec.get()
-    except (TypeError, AttributeError):  # gets a TypeError on CPU. There's probably a smarter way to do this, but this works for now.
-        pass
+    # Matplotlib needs them on the host
+    x, y, z, states_vec = map(to_host, (x, y, z, states_vec))
 
     # Initialize figure
     fig = plt.figure(figsize=(10, 10), frameon=False)
@@ -164,12 +159,10 @@ def get_ids_to_track(fluorophores, states, max_molecules):
     if states is not None:
         if not isinstance(states, list):
             states = [states]
-        all_wanted_ids = np.array([])
+        xp = namespace(fluorophores.id)
+        all_wanted_ids = xp.array([])
         for state in states:
-            all_wanted_ids = np.append(
-                all_wanted_ids,
-                fluorophores.id[fluorophores.states == fluorophores.state_info[state].state_num]
-            )
+            all_wanted_ids = xp.append(all_wanted_ids, fluorophores.get_ids_for_state(state))
     else:
         all_wanted_ids = fluorophores.id
     max_molecules = int(max_molecules)
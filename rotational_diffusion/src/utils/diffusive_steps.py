@@ -1,8 +1,8 @@
-from rotational_diffusion.src.utils import general
-from rotational_diffusion.src import np
+from rotational_diffusion.src.backends import namespace
+from rotational_diffusion.src.utils import general, propagator_tables
 
 
-def ghosh_propagator(step_sizes):
+def ghosh_propagator(step_sizes, rng=None):
     """
     Draw random angular displacements from Ghosh propagator for diffusion on a sphere.
 
@@ -12,16 +12,18 @@ def ghosh_propagator(step_sizes):
 
     Parameters:
     step_sizes (np.ndarray): 1D array of nonnegative floats representing 'sigma' in the equation
+    rng (np.random.Generator): Random number generator to draw from; default is np.random
 
     Returns:
     np.ndarray: 1D array with same shape as 'step_sizes', where each entry is a random
                 number drawn from a distribution determined by the corresponding entry of 'step_sizes'.
     """
-
-    min_step_sizes = np.min(step_sizes)
+    xp = namespace(step_sizes)
+    rng = xp.random if rng is None else rng
+    min_step_sizes = xp.min(step_sizes)
     assert min_step_sizes >= 0
     if min_step_sizes == 0:
-        step_sizes = np.clip(step_sizes, a_min=1e-12, a_max=None)
+        step_sizes = xp.clip(step_sizes, a_min=1e-12, a_max=None)
     # Iteratively populate the result vector:
     first_iteration = True
     while True:
@@ -30,19 +32,19 @@ def ghosh_propagator(step_sizes):
         # Draw from a truncated non-normalized version of the Gaussian
         # propagator as an upper bound for rejection sampling. Don't
         # bother drawing values that will exceed pi.
-        will_draw_pi = np.exp(-(np.pi / steps)**2)
-        candidates = steps * np.sqrt(-np.log(
-            np.random.uniform(will_draw_pi, 1, len(steps))))
+        will_draw_pi = xp.exp(-(xp.pi / steps)**2)
+        candidates = steps * xp.sqrt(-xp.log(
+            rng.uniform(will_draw_pi, 1, len(steps))))
         # To convert draws from our upper bound distribution to our desired
         # distribution, reject samples stochastically by the ratio of the
         # desired distribution to the upper bound distribution,
         # which is sqrt(sin(x)/x).
-        rejected = (np.random.uniform(0, 1, candidates.shape) >
-                    np.sqrt(np.sin(candidates) / candidates))
+        rejected = (rng.uniform(0, 1, candidates.shape) >
+                    xp.sqrt(xp.sin(candidates) / candidates))
         # Update results
         if first_iteration:
             result = candidates
-            tbd = np.nonzero(rejected)[0]  # Coordinates of unset results
+            tbd = xp.nonzero(rejected)[0]  # Coordinates of unset results
             first_iteration = False
         else:
             result[tbd] = candidates
@@ -52,7 +54,7 @@ def ghosh_propagator(step_sizes):
     return result
 
 
-def gaussian_propagator(step_sizes):
+def gaussian_propagator(step_sizes, rng=None):
     """
     Draw random angular displacements from Gaussian propagator for diffusion on a sphere.
 
@@ -61,80 +63,188 @@ def gaussian_propagator(step_sizes):
 
     Parameters:
     step_sizes (np.ndarray): 1D array of nonnegative floats representing 'sigma' in the equation
+    rng (np.random.Generator): Random number generator to draw from; default is np.random
 
     Returns:
     np.ndarray: 1D array with same shape as 'step_sizes', where each entry is a random
                 number drawn from a distribution determined by the corresponding entry of 'step_sizes'.
     """
-
+    xp = namespace(step_sizes)
+    rng = xp.random if rng is None else rng
     # Calculate draws via inverse transform sampling.
-    result = step_sizes * np.sqrt(-np.log(np.random.uniform(0, 1, len(step_sizes))))
+    result = step_sizes * xp.sqrt(-xp.log(rng.uniform(0, 1, len(step_sizes))))
     return result
 
 
-def diffusive_step(x, y, z, normalized_time_step, propagator='ghosh'):
+def ghosh_table_propagator(step_sizes, rng=None):
+    """
+    Draw random angular displacements from Ghosh propagator, by table lookup.
+
+    Same distribution as ghosh_propagator, but instead of rejection sampling
+    (an open-ended loop of retries), we draw in a single pass by inverse
+    transform sampling from a precomputed table of the inverse cumulative
+    distribution. The table is built once and cached on disk; its 'cdf_error'
+    attribute bounds how far the tabulated distribution can be from the one
+    drawn by ghosh_propagator. Steps too large for the table (far beyond
+    the safe step size) fall back to rejection sampling.
+
+    Parameters:
+    step_sizes (np.ndarray): 1D array of nonnegative floats representing 'sigma' in the equation
+    rng (np.random.Generator): Random number generator to draw from; default is np.random
+
+    Returns:
+    np.ndarray: 1D array with same shape as 'step_sizes', where each entry is a random
+                number drawn from a distribution determined by the corresponding entry of 'step_sizes'.
+    """
+    xp = namespace(step_sizes)
+    rng = xp.random if rng is None else rng
+    table = propagator_tables.ghosh_table()
+    # Inverse transform sampling, in the table's quantile coordinates:
+    w = xp.sqrt(-xp.log(rng.uniform(0, 1, len(step_sizes))))
+    sigma = _single_step_size(step_sizes)
+    if sigma is not None:
+        return table(sigma, w) if sigma <= table.sigma_max else ghosh_propagator(step_sizes, rng)
+    result = table(step_sizes, w)
+    large = step_sizes > table.sigma_max
+    if xp.any(large):
+        result[large] = ghosh_propagator(step_sizes[large], rng)
+    return result
+
+
+def exact_propagator(step_sizes, rng=None):
+    """
+    Draw random angular displacements from the exact propagator for diffusion on a sphere.
+
+    The exact propagator is the heat kernel on the sphere, a Legendre series
+    in cos(theta). We invert its cumulative distribution once, on a grid of
+    step sizes, and then draw by table lookup, so any step size costs the same.
+    Very small steps use the Ghosh propagator, which is exact to within the
+    table's tolerance there, and very large steps scramble orientations
+    completely.
+
+    Parameters:
+    step_sizes (np.ndarray): 1D array of nonnegative floats representing 'sigma' in the equation
+    rng (np.random.Generator): Random number generator to draw from; default is np.random
+
+    Returns:
+    np.ndarray: 1D array with same shape as 'step_sizes', where each entry is a random
+                number drawn from a distribution determined by the corresponding entry of 'step_sizes'.
+    """
+    xp = namespace(step_sizes)
+    rng = xp.random if rng is None else rng
+    table = propagator_tables.heat_kernel_table()
+    sigma = _single_step_size(step_sizes)
+    if sigma is not None and sigma < table.sigma_min:
+        return ghosh_propagator(step_sizes, rng)
+    if sigma is not None and sigma > table.sigma_max:
+        return xp.arccos(rng.uniform(-1, 1, len(step_sizes)))
+    # Inverse transform sampling, in the table's quantile coordinates:
+    w = xp.sqrt(-xp.log(rng.uniform(0, 1, len(step_sizes))))
+    if sigma is not None:
+        return table(sigma, w)
+    small = step_sizes < table.sigma_min
+    large = step_sizes > table.sigma_max
+    result = table(step_sizes, w)
+    if xp.any(small):
+        result[small] = ghosh_propagator(step_sizes[small], rng)
+    if xp.any(large):  # Uniformly distributed on the sphere
+        result[large] = xp.arccos(rng.uniform(-1, 1, int(xp.count_nonzero(large))))
+    return result
+
+
+def _single_step_size(step_sizes):
+    """If every entry of 'step_sizes' was broadcast from one value (like
+    diffusive_step does for scalar time steps), return that value."""
+    if step_sizes.strides == (0,):
+        return float(step_sizes[0])
+    return None
+
+
+def diffusive_step(x, y, z, normalized_time_step, propagator='ghosh', rng=None):
     """
     Perform a diffusive step on the sphere.
 
     Parameters:
     x, y, z (np.ndarray): 1D arrays representing 3D Cartesian coordinates
     normalized_time_step (float): Normalized time step value
-    propagator (str): Type of propagator to use ('ghosh' or 'gaussian')
+    propagator (str): Type of propagator to use (a key of 'propagators')
+    rng (np.random.Generator): Random number generator to draw from; default is np.random
 
     Returns:
     tuple: x, y, z after diffusive step
     """
+    xp = namespace(x, y, z, normalized_time_step)
+    rng = xp.random if rng is None else rng
     assert len(x) == len(y) == len(z)
-    angle_step = np.sqrt(2*normalized_time_step)
+    angle_step = xp.sqrt(2*normalized_time_step)
     assert angle_step.shape in ((), (1,), x.shape)
-    angle_step = np.broadcast_to(angle_step, x.shape)
-    assert propagator in ('ghosh', 'gaussian')
-    prop = ghosh_propagator if propagator == 'ghosh' else gaussian_propagator
-    theta_d = prop(angle_step)
-    phi_d = np.random.uniform(0, 2*np.pi, len(angle_step))
+    angle_step = xp.broadcast_to(angle_step, x.shape)
+    assert propagator in propagators
+    prop = propagators[propagator]
+    theta_d = prop(angle_step, rng)
+    phi_d = rng.uniform(0, 2*xp.pi, len(angle_step))
     return general.polar_displacement(x, y, z, theta_d, phi_d)
 
 
+propagators = {
+    'ghosh': ghosh_propagator,
+    'ghosh_table': ghosh_table_propagator,
+    'gaussian': gaussian_propagator,
+    'exact': exact_propagator,
+}
+
+
 def safe_diffusive_step(
     x, y, z,
     normalized_time_step,
     max_safe_step=0.5,  # Don't count on this, could be wrong
+    propagator='ghosh',
+    rng=None,
 ):
     """
     Perform a diffusive step on the sphere with a 'safe' maximum step size.
 
+    The 'exact' propagator is accurate at any step size, so it skips
+    the subdivision and takes a single step.
+
     Parameters:
     x, y, z (np.ndarray): 1D arrays representing 3D Cartesian coordinates
     normalized_time_step (float): Normalized time step value
     max_safe_step (float): Maximum safe step size. Default is 0.5, but this could be inaccurate.
+    propagator (str): Type of propagator to use (a key of 'propagators')
+    rng (np.random.Generator): Random number generator to draw from; default is np.random
 
     Returns:
     tuple: x, y, z after safe diffusive step
     """
+    xp = namespace(x, y, z, normalized_time_step)
+    if propagator == 'exact':
+        return diffusive_step(x, y, z, normalized_time_step, propagator, rng)
 
-    num_steps, remainder = np.divmod(normalized_time_step, max_safe_step)
+    num_steps, remainder = xp.divmod(normalized_time_step, max_safe_step)
     num_steps = num_steps.astype('uint64')  # Always an integer
-    num_steps_min = np.amin(num_steps)
-    num_steps_max = np.amax(num_steps)
+    num_steps_min = xp.amin(num_steps)
+    num_steps_max = xp.amax(num_steps)
     if num_steps_min == num_steps_max:  # Scalar time step
         for _ in range(int(num_steps_max)):
-            x, y, z = diffusive_step(x, y, z, max_safe_step)
+            x, y, z = diffusive_step(x, y, z, max_safe_step, propagator, rng)
     else:  # Vector time step
         assert len(normalized_time_step) == len(x)
-        t_is_sorted = np.all(np.diff(normalized_time_step) >= 0)
-        if not t_is_sorted:  # Sorted xyz makes selecting unfinished stuff fast
-            idx = np.argsort(num_steps)
-            x, y, z = x[idx], y[idx], z[idx]
-            num_steps = num_steps[idx]
+        t_is_sorted = xp.all(xp.diff(normalized_time_step) >= 0)
+        # Sorted step counts make selecting unfinished stuff fast. If
+        # they aren't sorted already, we select via a sorting index
+        # instead, so xyz stay in the caller's order:
+        idx = None if t_is_sorted else xp.argsort(num_steps)
+        num_steps = num_steps if idx is None else num_steps[idx]
         which_step = 1
         while True:
-            first_unfinished = np.searchsorted(num_steps, np.array(which_step))
+            first_unfinished = xp.searchsorted(num_steps, xp.array(which_step))
             if first_unfinished == len(num_steps): # We're done taking steps
                 break
-            s = slice(first_unfinished, None)
-            x[s], y[s], z[s] = diffusive_step(x[s], y[s], z[s], max_safe_step)
+            s = slice(first_unfinished, None) if idx is None else idx[first_unfinished:]
+            x[s], y[s], z[s] = diffusive_step(x[s], y[s], z[s], max_safe_step, propagator, rng)
             which_step += 1
     # Finally, take our 'remainder' step:
-    if np.amax(remainder) > 0:
-        x, y, z = diffusive_step(x, y, z, remainder)
+    if xp.amax(remainder) > 0:
+        x, y, z = diffusive_step(x, y, z, remainder, propagator, rng)
     return x, y, z
@@ -0,0 +1,170 @@
+## Size-aware dispatch
+# Which way of doing an operation is fastest depends on how many
+# molecules it touches. Threads and compiled kernels have fixed
+# overheads that only pay off for big arrays, and a population that
+# starts at 2e7 molecules is often down to 1e5 after the first round of
+# deletions. Rather than guess where the crossovers are, we time each
+# implementation once, at a ladder of sizes, and remember which one won
+# at each size. Calibrations are kept in a small JSON file, keyed by the
+# operation and by the machine, so each machine only calibrates once.
+#
+# The cache lives in ~/.cache/rotational_diffusion/calibration.json,
+# unless you point ROTATIONAL_DIFFUSION_CALIBRATION somewhere else.
+# Delete it (or call calibrate()) to recalibrate, e.g. after a hardware
+# or library upgrade that the key doesn't capture.
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+
+import numpy
+
+try:
+    import numba
+except ModuleNotFoundError:
+    numba = None
+
+sizes = tuple(4**k for k in range(3, 11))  # 64 to ~1e6 molecules
+
+_dispatchers = {}  # One per key, shared by everybody
+
+
+def cache_path():
+    """Where calibrations live. Override with the
+    ROTATIONAL_DIFFUSION_CALIBRATION environment variable."""
+    return os.environ.get(
+        'ROTATIONAL_DIFFUSION_CALIBRATION',
+        os.path.join(os.path.expanduser('~'), '.cache', 'rotational_diffusion', 'calibration.json'))
+
+
+class Dispatcher:
+    """
+    Picks the fastest of several implementations of one operation, for
+    a given number of items.
+
+    Parameters:
+    key (str): Names the operation, and anything else that affects its
+               timings (propagator, precision...), in the cache
+    implementations (dict): For each implementation's name, a function
+                            prepare(n) that sets up a problem of 'n'
+                            items, and returns a function (of no
+                            arguments) that solves it once; that's what
+                            we time
+    sizes (tuple of int): Sizes to time each implementation at
+    repeats (int): Number of timings per size and implementation; we keep the best
+    path (str or callable): JSON file to keep calibrations in, or None to
+                            not keep them; by default cache_path(), looked
+                            up every time we read or write the cache
+
+    Attributes:
+    table (list): (size, name) of the fastest implementation at each
+                  calibrated size, or None until we've calibrated
+    """
+    def __init__(self, key, implementations, sizes=sizes, repeats=3, path=cache_path):
+        assert len(implementations) >= 1
+        assert len(sizes) >= 1
+        self.key = key
+        self.implementations = dict(implementations)
+        self.sizes = tuple(sorted(int(n) for n in sizes))
+        self.repeats = int(repeats)
+        self.path = path
+        self.table = None
+
+    def _cache_key(self):
+        # Calibrations don't transfer between machines or library versions:
+        machine = (platform.machine(), platform.processor(), os.cpu_count(),
+                   platform.python_version(), numpy.__version__,
+                   None if numba is None else numba.__version__)
+        return '|'.join(map(str, (self.key, sorted(self.implementations)) + machine))
+
+    def _path(self):
+        # Not resolved until we need it, so setting the environment
+        # variable after import (e.g. in a worker process) still counts:
+        return self.path() if callable(self.path) else self.path
+
+    def _load(self):
+        path = self._path()
+        if path is None or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}  # Unreadable; we'll just recalibrate
+
+    def _save(self):
+        path = self._path()
+        if path is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            cache = self._load()
+            cache[self._cache_key()] = self.table
+            # Write a new file and swap it in, so a reader never sees half a file:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.getLogger(__name__).warning(
+                "Couldn't save calibration to %s (%s); it'll be redone next time.", path, e)
+
+    def calibrate(self):
+        """Time every implementation at every size, and save the results."""
+        logging.getLogger(__name__).info("Calibrating %s...", self.key)
+        # Benchmarks draw random numbers too, but they shouldn't change
+        # what a seeded simulation draws next:
+        state = numpy.random.get_state()
+        try:
+            self.table = []
+            for n in self.sizes:
+                timings = {}
+                for name, prepare in self.implementations.items():
+                    run = prepare(n)
+                    best = numpy.inf
+                    for _ in range(self.repeats):
+                        start = time.perf_counter()
+                        run()
+                        best = min(best, time.perf_counter() - start)
+                    timings[name] = best
+                self.table.append((n, min(timings, key=timings.get)))
+        finally:
+            numpy.random.set_state(state)
+        self._save()
+        return self.table
+
+    def choose(self, n):
+        """The name of the fastest implementation for 'n' items."""
+        if len(self.implementations) == 1:
+            return next(iter(self.implementations))  # Nothing to choose from
+        if self.table is None:
+            table = self._load().get(self._cache_key())
+            if table is None:
+                table = self.calibrate()
+            self.table = [(int(size), name) for size, name in table]
+        # The winner at the largest calibrated size that's <= n (or at
+        # the smallest size, for tiny n):
+        choice = self.table[0][1]
+        for size, name in self.table:
+            if size > n:
+                break
+            choice = name
+        return choice
+
+    @property
+    def thresholds(self):
+        """(size, name): the sizes where the fastest implementation changes."""
+        if self.table is None:
+            return None
+        return [(size, name) for i, (size, name) in enumerate(self.table)
+                if i == 0 or name != self.table[i - 1][1]]
+
+
+def get(key, implementations):
+    """A (shared) Dispatcher for 'key', created with 'implementations'
+    the first time anybody asks for it."""
+    if key not in _dispatchers:
+        _dispatchers[key] = Dispatcher(key, implementations)
+    return _dispatchers[key]
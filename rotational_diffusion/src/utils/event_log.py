@@ -0,0 +1,409 @@
+## Transition event log
+# We record the orientation and time of every spontaneous transition,
+# to simulate measurements later. Appending each wave of transitions
+# as a new small array to a list means tens of thousands of tiny arrays
+# in a long photoswitching run, and every query joins them all up and
+# scans them for one (initial state, final state) pair.
+#
+# Instead, the log keeps one set of growable columns per pair: each
+# column is preallocated, and doubles its capacity when it fills up, so
+# appending a wave is one copy per column (amortized), and a query for
+# a pair is a slice of its columns, with no copying or scanning.
+#
+# Most schemes only measure one transition, in one time window, and
+# don't need every field. Subscriptions say which pairs, windows and
+# fields to keep; once there are any, everything else is dropped
+# before it's even gathered (see FluorophoreCollection.subscribe).
+#
+# A long acquisition can still record more events than fit in memory.
+# Given a directory, the log keeps only a fixed-size buffer per pair in
+# memory, and writes it out as a new .npy segment per field whenever it
+# fills up. Segments are never modified once they're written, they're
+# read back memory-mapped, and their names say what's in them, so a
+# log can be reopened (EventLog.open) after the process that wrote it
+# is long gone.
+import copy
+import os
+import re
+import shutil
+import tempfile
+
+from rotational_diffusion.src import backends
+from rotational_diffusion.src.backends import namespace
+import numpy
+
+
+class EventColumns:
+    """
+    Named, growable 1D columns of equal length, one row per event.
+
+    Parameters:
+    dtypes (dict): Column names and their dtypes
+    backend (None, str, module or Backend): Where to allocate the columns (see backends.get)
+    capacity (int): Initial number of rows to allocate
+    """
+    def __init__(self, dtypes, backend=None, capacity=1024):
+        self.dtypes = {name: numpy.dtype(dtype) for name, dtype in dtypes.items()}
+        self.backend = backends.get(backend)  # Not the module, so we can be copied
+        xp = self.backend.xp
+        self.n = 0
+        self._columns = {name: xp.empty(int(capacity), dtype)
+                         for name, dtype in self.dtypes.items()}
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def capacity(self):
+        return len(next(iter(self._columns.values())))
+
+    def __getitem__(self, name):
+        return self._columns[name][:self.n]  # A view, not a copy
+
+    def append(self, columns):
+        """Append a row for each entry of 'columns' (a dict of arrays of
+        equal length, with the same names as ours)."""
+        k = len(next(iter(columns.values())))
+        if self.n + k > self.capacity:
+            self._grow(self.n + k)
+        for name, column in self._columns.items():
+            column[self.n:self.n + k] = columns[name]
+        self.n += k
+
+    def _grow(self, needed):
+        capacity = max(self.capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        for name, column in self._columns.items():
+            grown = self.backend.xp.empty(capacity, column.dtype)
+            grown[:self.n] = column[:self.n]
+            self._columns[name] = grown
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns.values())
+
+
+class SpillingEventColumns:
+    """
+    Like EventColumns, but only 'rows' events are kept in memory: when
+    they fill up, each column is written to 'directory' as a new .npy
+    segment, named '<name>.<column>.<segment number>.npy'. Host only.
+
+    Parameters:
+    dtypes (dict): Column names and their dtypes
+    directory (str): Where to write segments
+    name (str): Prefix of our segments' names
+    rows (int): Number of events per segment
+
+    Two logs spilling to the same directory would collide, so writing
+    never overwrites a segment: give each log its own directory (copies
+    of an EventLog get their own; see EventLog.__deepcopy__).
+    """
+    def __init__(self, dtypes, directory, name, rows=2**20):
+        assert rows >= 1
+        self.dtypes = {k: numpy.dtype(dtype) for k, dtype in dtypes.items()}
+        self.directory = directory
+        self.name = name
+        self.rows = int(rows)
+        # Grows (up to about 'rows') as it fills, like any EventColumns:
+        self._buffer = EventColumns(self.dtypes, 'numpy', capacity=min(self.rows, 1024))
+        self._segments = []  # One dict of memory maps per segment
+
+    def __len__(self):
+        return sum(len(next(iter(s.values()))) for s in self._segments) + len(self._buffer)
+
+    def __getitem__(self, name):
+        # Careful: unless we've only got one segment, this reads every
+        # segment into memory. Go through segments() to avoid that.
+        parts = [s[name] for s in self._segments]
+        if len(self._buffer) > 0:
+            parts.append(self._buffer[name].copy())  # The buffer gets reused
+        if len(parts) == 1:
+            return parts[0]  # Zero-copy, if it's a segment
+        return numpy.concatenate([numpy.zeros(0, self.dtypes[name])] + parts)
+
+    def segments(self):
+        """Iterate over our events, one segment (a dict of memory maps,
+        or of arrays for what's still in memory) at a time."""
+        yield from self._segments
+        if len(self._buffer) > 0:
+            yield {k: self._buffer[k] for k in self.dtypes}
+
+    def append(self, columns):
+        """Like EventColumns.append; full buffers are written out."""
+        k = len(next(iter(columns.values())))
+        start = 0
+        while start < k:
+            stop = min(k, start + self.rows - len(self._buffer))
+            self._buffer.append({name: backends.to_host(columns[name][start:stop])
+                                 for name in self.dtypes})
+            if len(self._buffer) == self.rows:
+                self.flush()
+            start = stop
+
+    def flush(self):
+        """Write whatever's in memory out as a (possibly short) segment."""
+        if len(self._buffer) == 0:
+            return None
+        segment = {}
+        for k in self.dtypes:
+            path = self._path(k, len(self._segments))
+            with open(path, 'xb') as f:  # Never overwrite anybody's segments
+                numpy.save(f, self._buffer[k])
+            segment[k] = numpy.load(path, mmap_mode='r')
+        self._segments.append(segment)
+        self._buffer.n = 0
+
+    def _path(self, name, n):
+        return os.path.join(self.directory, f"{self.name}.{name}.{n:06d}.npy")
+
+    def copy_to(self, directory):
+        """A copy of us that spills to 'directory', with copies of our
+        segments there."""
+        result = SpillingEventColumns(self.dtypes, directory, self.name, self.rows)
+        result._buffer = copy.deepcopy(self._buffer)
+        for n, segment in enumerate(self._segments):
+            copied = {}
+            for k, column in segment.items():
+                shutil.copyfile(column.filename, result._path(k, n))
+                copied[k] = numpy.load(result._path(k, n), mmap_mode='r')
+            result._segments.append(copied)
+        return result
+
+    def nbytes(self):
+        """Memory we hold (segments live on disk)."""
+        return self._buffer.nbytes()
+
+
+class EventLog:
+    """
+    Transition events, partitioned by (initial state, final state), each
+    partition in its own EventColumns.
+
+    Parameters:
+    dtypes (dict): The fields we can record for each event, and their
+                   dtypes (e.g. {'x': 'float32', ..., 't': 'float64'})
+    backend (None, str, module or Backend): Where to keep the events (see backends.get)
+    directory (str): If given, spill events to .npy segments in this
+                     (existing) directory, keeping only 'spill_rows'
+                     events per pair in memory. Host only.
+    spill_rows (int): Number of events per segment
+
+    Attributes:
+    subscriptions (dict): (initial state, final state): (windows, fields).
+                          'windows' is a list of (start, stop) times, or
+                          None for all times. Empty means keep everything.
+    """
+    def __init__(self, dtypes, backend=None, directory=None, spill_rows=2**20):
+        self.dtypes = dict(dtypes)
+        self.backend = backends.get(backend)
+        assert directory is None or self.backend.is_host  # Memory maps live on the host
+        assert directory is None or os.path.isdir(directory)
+        self.directory = directory
+        self.spill_rows = spill_rows
+        self._pairs = {}  # (initial state, final state): EventColumns
+        self.subscriptions = {}
+
+    @classmethod
+    def open(cls, directory, spill_rows=2**20):
+        """
+        Reopen the log that spilled to 'directory' (e.g. from a previous
+        run), from its segments' names. Only what was written out is
+        there; see flush. New events are appended as new segments.
+        """
+        segment_name = re.compile(r'^(\d+)-(\d+)\.(\w+)\.(\d+)\.npy$')
+        found = {}  # (initial state, final state): {field: [path per segment]}
+        for filename in sorted(os.listdir(directory)):
+            match = segment_name.match(filename)
+            if match is None:
+                continue
+            i, f, field, n = match.groups()
+            found.setdefault((int(i), int(f)), {}).setdefault(field, []).append(
+                (int(n), os.path.join(directory, filename)))
+        dtypes = {}
+        for fields in found.values():
+            for field, paths in fields.items():
+                dtypes.setdefault(field, numpy.load(paths[0][1], mmap_mode='r').dtype)
+        log = cls(dtypes, 'numpy', directory, spill_rows)
+        for key, fields in found.items():
+            columns = log._pairs[key] = SpillingEventColumns(
+                {k: dtypes[k] for k in fields}, directory, f"{key[0]}-{key[1]}", spill_rows)
+            numbers = [sorted(n for n, _ in paths) for paths in fields.values()]
+            assert all(n == list(range(len(n))) for n in numbers), f"Segments missing for {key}"
+            assert len(set(map(len, numbers))) == 1, f"Some fields of {key} are missing segments"
+            for n in range(len(numbers[0])):
+                columns._segments.append({k: numpy.load(dict(paths)[n], mmap_mode='r')
+                                          for k, paths in fields.items()})
+        return log
+
+    def __deepcopy__(self, memo):
+        # A copy spilling to our directory would collide with our
+        # segments (e.g. the get_figures scripts copy their collection
+        # for each repetition), so it gets a new subdirectory of it:
+        result = self.__class__.__new__(self.__class__)
+        memo[id(self)] = result
+        for k, v in self.__dict__.items():
+            if k != '_pairs':
+                setattr(result, k, copy.deepcopy(v, memo))
+        if self.directory is None:
+            result._pairs = copy.deepcopy(self._pairs, memo)
+        else:
+            result.directory = tempfile.mkdtemp(prefix='copy-', dir=self.directory)
+            result._pairs = {key: columns.copy_to(result.directory)
+                             for key, columns in self._pairs.items()}
+        return result
+
+    def flush(self):
+        """Write every event still in memory to disk (if we spill)."""
+        if self.directory is None:
+            return None
+        for columns in self._pairs.values():
+            columns.flush()
+
+    def subscribe(self, initial_state, final_state, windows=None, fields=None):
+        """
+        Keep the events of one (initial state, final state) pair, if
+        they happen in one of 'windows' (a list of (start, stop) times,
+        inclusive; None for all times), and only their 'fields' (None
+        for all of them). Subscribing to a pair again adds to its
+        windows and fields.
+        """
+        fields = tuple(self.dtypes) if fields is None else tuple(fields)
+        assert len(fields) > 0
+        assert all(f in self.dtypes for f in fields), f"We can only record {tuple(self.dtypes)}"
+        key = (int(initial_state), int(final_state))
+        assert self.subscriptions or not self._pairs, "Subscribe before recording any events"
+        assert key not in self._pairs or set(fields) <= set(self._pairs[key].dtypes), (
+            "Can't add fields to a pair we've already recorded")
+        if key in self.subscriptions:
+            old_windows, old_fields = self.subscriptions[key]
+            windows = None if None in (old_windows, windows) else old_windows + list(windows)
+            fields = old_fields + tuple(f for f in fields if f not in old_fields)
+        else:
+            windows = None if windows is None else list(windows)
+        for start, stop in windows or ():
+            assert start <= stop
+        # Keep fields in our order, so every pair's columns line up:
+        self.subscriptions[key] = (windows, tuple(f for f in self.dtypes if f in fields))
+
+    @property
+    def fields(self):
+        """Every field that somebody wants."""
+        if not self.subscriptions:
+            return tuple(self.dtypes)
+        wanted = set(f for _, fields in self.subscriptions.values() for f in fields)
+        return tuple(f for f in self.dtypes if f in wanted)
+
+    def wanted(self, initial_states, final_states, t):
+        """
+        Which of a wave of events (state numbers and times) should we
+        keep? A boolean mask, or None for all of them.
+        """
+        if not self.subscriptions:
+            return None
+        xp = namespace(initial_states)
+        keep = xp.zeros(len(initial_states), dtype=bool)
+        for (i, f), (windows, _) in self.subscriptions.items():
+            pair = (initial_states == i) & (final_states == f)
+            if windows is not None:
+                in_window = xp.zeros(len(t), dtype=bool)
+                for start, stop in windows:
+                    in_window |= (t >= start) & (t <= stop)
+                pair &= in_window
+            keep |= pair
+        return keep
+
+    def __len__(self):
+        """Total number of events."""
+        return sum(len(columns) for columns in self._pairs.values())
+
+    def pairs(self):
+        """The (initial state, final state) pairs we've got events for."""
+        return sorted(self._pairs)
+
+    def append(self, initial_states, final_states, columns):
+        """
+        Append a wave of events.
+
+        Parameters:
+        initial_states, final_states (array): State numbers of each event
+        columns (dict): For each of our fields, an array with a value per event
+        """
+        xp = namespace(initial_states)
+        if len(initial_states) == 0:
+            return None
+        # Group the events by pair (stably, so each pair stays in time order):
+        pair = initial_states.astype('int64') * 256 + final_states
+        first = pair[0]
+        if bool(xp.all(pair == first)):  # Usually, everybody's in one pair
+            self._append((int(first) // 256, int(first) % 256), columns)
+            return None
+        order = xp.argsort(pair, kind='stable')
+        pair = pair[order]
+        unique, starts = xp.unique(pair, return_index=True)
+        bounds = starts.tolist() + [len(pair)]
+        for p, start, stop in zip(unique.tolist(), bounds[:-1], bounds[1:]):
+            idx = order[start:stop]
+            key = (p // 256, p % 256)
+            self._append(key, {k: columns[k][idx] for k in self._fields(key)})
+
+    def _append(self, key, columns):
+        if key not in self._pairs:
+            dtypes = {k: self.dtypes[k] for k in self._fields(key)}
+            if self.directory is None:
+                self._pairs[key] = EventColumns(dtypes, self.backend)
+            else:
+                self._pairs[key] = SpillingEventColumns(
+                    dtypes, self.directory, f"{key[0]}-{key[1]}", self.spill_rows)
+        self._pairs[key].append(columns)
+
+    def _fields(self, key):
+        """The fields we keep for a pair."""
+        if key in self.subscriptions:
+            return self.subscriptions[key][1]
+        return tuple(self.dtypes)
+
+    def get(self, initial_state, final_state):
+        """The events of one (initial state, final state) pair: a dict of
+        views of each field we kept (empty arrays if there aren't any).
+        If we spill, a pair with several segments is read into memory;
+        use segments() to go through it a piece at a time instead."""
+        key = (int(initial_state), int(final_state))
+        columns = self._pairs.get(key)
+        if columns is None:
+            return {k: self.backend.xp.zeros(0, self.dtypes[k]) for k in self._fields(key)}
+        return {k: columns[k] for k in columns.dtypes}
+
+    def segments(self, initial_state, final_state):
+        """
+        Iterate over the events of one pair a piece at a time: a dict of
+        memory-mapped columns per spilled segment (so gating a huge run
+        doesn't copy it into memory), or just get() if we don't spill.
+        """
+        columns = self._pairs.get((int(initial_state), int(final_state)))
+        if isinstance(columns, SpillingEventColumns):
+            yield from columns.segments()
+        else:
+            yield self.get(initial_state, final_state)
+
+    def to_dict(self):
+        """
+        Every event, in the old 'transition_events' layout: one array
+        per field, plus 'initial_state' and 'final_state', joined up
+        pair by pair (so in time order within each pair only).
+        """
+        xp = self.backend.xp
+        keys = self.pairs()
+        # Fields some pairs didn't keep are left out:
+        fields = [k for k in self.dtypes if all(k in self._pairs[p].dtypes for p in keys)]
+        events = {k: xp.concatenate([xp.zeros(0, self.dtypes[k])] + [self._pairs[p][k] for p in keys])
+                  for k in fields}
+        for i, k in enumerate(('initial_state', 'final_state')):
+            events[k] = xp.concatenate([xp.zeros(0, 'uint8')] + [
+                xp.full(len(self._pairs[p]), p[i], dtype='uint8') for p in keys])
+        return events
+
+    def nbytes(self):
+        """Memory allocated for events (including room to grow; not
+        counting spilled segments)."""
+        return sum(columns.nbytes() for columns in self._pairs.values())
@@ -1,4 +1,4 @@
-from rotational_diffusion.src import np
+from rotational_diffusion.src.backends import namespace
 import numpy
 
 
@@ -26,19 +26,20 @@ def sin_cos(radians, method='sqrt'):
     cos : ndarray
         Cosine of the input angles.
     """
-    radians = np.atleast_1d(radians)
+    xp = namespace(radians)
+    radians = xp.atleast_1d(radians)
     assert method in ('direct', 'sqrt', '0,2pi', '0,pi')
-    cos = np.cos(radians)
+    cos = xp.cos(radians)
 
     if method == 'direct':  # Simple and obvious
-        sin = np.sin(radians)
+        sin = xp.sin(radians)
     else:  # |sin| = np.sqrt(1 - cos*cos)
-        sin = np.sqrt(1 - cos*cos)
+        sin = xp.sqrt(1 - cos*cos)
 
     if method == 'sqrt':  # Handle arbitrary values of 'radians'
-        sin[np.pi - (radians % (2*np.pi)) < 0] *= -1
+        sin[xp.pi - (radians % (2*xp.pi)) < 0] *= -1
     elif method == '0,2pi':  # Assume 0 < radians < 2pi, no mod
-        sin[np.pi - (radians            ) < 0] *= -1
+        sin[xp.pi - (radians            ) < 0] *= -1
     elif method == '0,pi':  # Assume 0 < radians < pi, no negation
         pass
     return sin, cos
@@ -65,7 +66,10 @@ def polar_displacement(x, y, z, theta_d, phi_d, method='accurate', norm=True):
     phi_d : ndarray
         Spherical displacement (direction of movement).
     method : str, optional
-        Method to perform the displacement. It could be 'naive' or 'accurate'. Default is 'accurate'.
+        Method to perform the displacement. It could be 'naive', 'accurate' or 'tangent'.
+        Default is 'accurate'. 'tangent' displaces along a different (but
+        equally valid) tangent direction for the same phi_d, so it matches the
+        other methods in distribution, not draw-for-draw.
     norm : bool, optional
         If True, normalizes the final displacement vectors. Default is True.
 
@@ -78,8 +82,17 @@ def polar_displacement(x, y, z, theta_d, phi_d, method='accurate', norm=True):
     z_f : ndarray
         Updated z-coordinates.
     """
-    assert method in ('naive', 'accurate')
+    xp = namespace(x, y, z, theta_d)
+    assert method in ('naive', 'accurate', 'tangent')
     x_d, y_d, z_d = to_xyz(theta_d, phi_d)
+    if method == 'tangent':
+        x_f, y_f, z_f = _tangent_displacement(x, y, z, x_d, y_d, z_d)
+        if norm:
+            r = xp.sqrt(x_f*x_f + y_f*y_f + z_f*z_f)
+            x_f /= r
+            y_f /= r
+            z_f /= r
+        return x_f, y_f, z_f
     # Since the particles aren't (generally) at the north pole, we
     # have to rotate back to each particle's actual position. We'll
     # do this via a rotation matrix calculated as described in:
@@ -110,7 +123,7 @@ def polar_displacement(x, y, z, theta_d, phi_d, method='accurate', norm=True):
         # x*y/(1+z) = (1-z) * sin(phi)*cos(phi)
         unstable = z < (-1 + 5e-2) # Not sure where instability kicks in...
         x_u, y_u, z_u = x[unstable], y[unstable], z[unstable]
-        phi_u = np.arctan2(y_u, x_u)
+        phi_u = xp.arctan2(y_u, x_u)
         sin_ph_u, cos_ph_u = sin_cos(phi_u)
         xy_ovr_1pz[unstable] = (1 - z_u) * sin_ph_u * cos_ph_u
         yy_ovr_1pz[unstable] = (1 - z_u) * sin_ph_u * sin_ph_u
@@ -120,13 +133,58 @@ def polar_displacement(x, y, z, theta_d, phi_d, method='accurate', norm=True):
         y_f = x_d*(   -xy_ovr_1pz) + y_d*(z + xx_ovr_1pz) + z_d*(y)
         z_f = x_d*(    -x        ) + y_d*(    -y        ) + z_d*(z)
     if norm:
-        r = np.sqrt(x_f*x_f + y_f*y_f + z_f*z_f)
+        r = xp.sqrt(x_f*x_f + y_f*y_f + z_f*z_f)
         x_f /= r
         y_f /= r
         z_f /= r
     return x_f, y_f, z_f
 
 
+def _tangent_displacement(x, y, z, x_d, y_d, z_d):
+    # Build an orthonormal tangent frame (e1, e2) at each position, as in:
+    #  doi.org/10.1080/2165347X.2017.1320296 (Duff et al.)
+    #  "Building an Orthonormal Basis, Revisited"
+    # and step along cos(phi_d)*e1 + sin(phi_d)*e2. The only division
+    # is by (sign(z) + z), which is at least 1 in magnitude, so this is
+    # stable everywhere, with no masked special cases.
+    # Written with in-place operations (like to_xyz 'ugly'), since
+    # we're limited by memory traffic, not arithmetic. We scribble on
+    # x_d, y_d, z_d, which the caller doesn't need afterwards.
+    xp = namespace(x, y, z)
+    s = xp.copysign(1, z)
+    a = s + z
+    xp.divide(-1, a, out=a)
+    b = x * y
+    b *= a
+    # e1 = (1 + s*x*x*a, s*b, -s*x), e2 = (b, s + y*y*a, -y)
+    e = x * x
+    e *= a
+    e *= s
+    e += 1
+    x_f = x_d * e
+    tmp = y_d * b
+    x_f += tmp
+    xp.multiply(z_d, x, out=tmp)
+    x_f += tmp
+    xp.multiply(y, y, out=e)
+    e *= a
+    e += s
+    y_f = y_d * e
+    b *= s
+    b *= x_d
+    y_f += b
+    xp.multiply(z_d, y, out=tmp)
+    y_f += tmp
+    xp.multiply(s, x, out=s)
+    s *= x_d
+    xp.multiply(y, y_d, out=tmp)
+    z_f = z_d
+    z_f *= z
+    z_f -= s
+    z_f -= tmp
+    return x_f, y_f, z_f
+
+
 def to_xyz(theta, phi, method='ugly'):
     """
     Converts spherical polar angles to unit-length Cartesian coordinates.
@@ -149,6 +207,7 @@ def to_xyz(theta, phi, method='ugly'):
     z : ndarray
         z-coordinate.
     """
+    xp = namespace(theta, phi)
     assert method in ('ugly', 'direct')
     sin_th, cos_th = sin_cos(theta, method='0,pi')
     sin_ph, cos_ph = sin_cos(phi, method='0,2pi')
@@ -157,8 +216,8 @@ def to_xyz(theta, phi, method='ugly'):
         y = sin_th * sin_ph
         z = cos_th
     elif method == 'ugly':  # An uglier method with less memory allocation
-        np.multiply(sin_th, cos_ph, out=cos_ph)
-        np.multiply(sin_th, sin_ph, out=sin_ph)
+        xp.multiply(sin_th, cos_ph, out=cos_ph)
+        xp.multiply(sin_th, sin_ph, out=sin_ph)
         x = cos_ph
         y = sin_ph
         z = cos_th
@@ -0,0 +1,99 @@
+from rotational_diffusion.src import backends
+import numpy
+
+
+class MoleculeStore:
+    """
+    Per-molecule arrays ("columns", e.g. x, y, z, t, states), stored as a
+    structure of arrays carved out of one contiguous buffer.
+
+    Molecules never move around inside the store. Code that wants to
+    visit molecules in some order (e.g. sorted by time step) keeps a
+    permutation index, 'order', instead of physically reordering every
+    column; reordering costs one integer array instead of a gather per
+    column. Deleting molecules compacts the columns in place, so the
+    buffer is allocated exactly once.
+
+    Parameters:
+    num_molecules (int): Number of molecules (rows) in the store
+    columns (dict): Column names and their dtypes
+    buffer (array): Optional preallocated 1D uint8 buffer to carve the
+                    columns out of, at least 'nbytes(...)' long
+    xp (module): Array namespace to allocate the buffer in, if we allocate
+                 it; default is the default backend's
+
+    Attributes:
+    n (int): Current number of molecules
+    order (array or None): Optional permutation index; None means
+                           "in storage order"
+    """
+    alignment = 64  # Bytes; keeps every column cache-line aligned
+
+    def __init__(self, num_molecules, columns, buffer=None, xp=None):
+        self.n = int(num_molecules)
+        self.capacity = self.n
+        self.dtypes = {name: numpy.dtype(dtype) for name, dtype in columns.items()}
+        self.offsets = {}
+        offset = 0
+        for name, dtype in self.dtypes.items():
+            self.offsets[name] = offset
+            offset += self._aligned(self.capacity * dtype.itemsize)
+        if buffer is None:
+            xp = backends.default().xp if xp is None else xp
+            buffer = xp.empty(max(offset, 1), 'uint8')
+        assert buffer.dtype == numpy.dtype('uint8') and buffer.size >= offset
+        self.buffer = buffer
+        self.order = None
+        self._carve()
+
+    @classmethod
+    def nbytes(cls, num_molecules, columns):
+        """Buffer size needed for a store of this shape."""
+        return sum(cls._aligned(int(num_molecules) * numpy.dtype(dtype).itemsize)
+                   for dtype in columns.values())
+
+    @classmethod
+    def _aligned(cls, nbytes):
+        return -(-nbytes // cls.alignment) * cls.alignment
+
+    def _carve(self):
+        self._columns = {}
+        for name, dtype in self.dtypes.items():
+            start = self.offsets[name]
+            stop = start + self.capacity * dtype.itemsize
+            self._columns[name] = self.buffer[start:stop].view(dtype)
+
+    def __getitem__(self, name):
+        return self._columns[name][:self.n]
+
+    def __setitem__(self, name, value):
+        self._columns[name][:self.n] = value
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def reorder(self, idx):
+        """Compose a permutation onto the current order, without moving any data."""
+        self.order = idx if self.order is None else self.order[idx]
+        return self.order
+
+    def keep(self, which):
+        """Delete every molecule not in 'which' (a boolean mask or sorted
+        indices), compacting every column in place."""
+        for name in self.dtypes:
+            column = self._columns[name]
+            kept = column[:self.n][which]
+            column[:len(kept)] = kept
+        self.n = len(kept) if self.dtypes else 0
+        self.order = None  # Stale; slots have moved
+
+    # Copying/pickling a store copies its buffer once, and re-carves
+    # the columns out of the copy, so they still share it.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_columns']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._carve()
@@ -0,0 +1,325 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+
+from rotational_diffusion.src.backends import namespace
+import numpy
+
+
+class InverseCDFTable:
+    """
+    A tabulated inverse cumulative distribution function for angular
+    displacements on a sphere, covering a range of step sizes 'sigma'.
+
+    Each row of the table holds theta/scale(sigma) as a function of
+    w = sqrt(-log(1 - u)), where u is the cumulative probability. In
+    these coordinates a Gaussian propagator is a straight line
+    (theta = sigma * w), so the propagators we care about are smooth
+    and cheap to interpolate, even in the tails. The scale grows like
+    sigma for small steps and saturates for large steps, where
+    displacements stop growing because they can't exceed pi.
+
+    Tables are slow-ish to build, so if you give them a 'name' they're
+    cached on disk (see cache_dir()) and reused by later processes.
+
+    Parameters:
+    survival (callable): survival(theta, sigma) returns P(displacement > theta)
+                         for 1D numpy arrays of theta and a scalar sigma
+    sigma_min, sigma_max (float): Range of step sizes covered by the table
+    num_sigma (int): Number of log-spaced step sizes to tabulate
+    num_w (int): Number of quantiles to tabulate for each step size
+    num_theta (int): Number of angles used to evaluate 'survival' per step size
+    w_max (float): Largest tabulated quantile coordinate. The default covers
+                   every uniform draw larger than ~1e-16.
+    name (str): Name for the on-disk cache, or None to skip caching
+
+    Attributes:
+    cdf_error (float): Largest difference between the cumulative probability
+                       of a tabulated draw and the true cumulative
+                       probability, measured halfway between grid points.
+                       This bounds the Kolmogorov-Smirnov distance to the
+                       true distribution, i.e. to a rejection sampler.
+    """
+    version = 1  # Bump this to invalidate old cache files
+
+    def __init__(
+            self,
+            survival,
+            sigma_min,
+            sigma_max,
+            num_sigma=256,
+            num_w=512,
+            num_theta=8192,
+            w_max=6,
+            name=None,
+    ):
+        assert 0 < sigma_min < sigma_max
+        self.sigma_min = sigma_min
+        self.sigma_max = sigma_max
+        self.log_sigma_min = numpy.log(sigma_min)
+        self.d_log_sigma = (numpy.log(sigma_max) - self.log_sigma_min) / (num_sigma - 1)
+        self.num_sigma = num_sigma
+        self.num_w = num_w
+        self.num_theta = num_theta
+        self.dw = w_max / (num_w - 1)
+        self.w_max = w_max
+
+        path = None
+        if name is not None:
+            key = repr((self.version, sigma_min, sigma_max, num_sigma, num_w, num_theta, w_max))
+            key = hashlib.sha1(key.encode()).hexdigest()[:12]
+            path = os.path.join(cache_dir(), f'{name}_{key}.npz')
+        table = None if path is None else self._load(path)
+        if table is None:
+            # Build on the host; copies for other backends are made as
+            # they're needed (see _on()):
+            table = self._build(survival)
+            self.cdf_error = self._measure_error(survival, table.ravel())
+            if path is not None:
+                self._save(path, table)
+        self.table = table.ravel()
+        self.slope = self._slope(numpy, self.table)
+        self._copies = {numpy: (self.table, self.slope)}
+
+    def _load(self, path):
+        """The cached table (setting cdf_error), or None if there isn't a readable one."""
+        try:
+            with numpy.load(path) as cached:
+                table, self.cdf_error = cached['table'], float(cached['cdf_error'])
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None  # Missing or unreadable; we'll just rebuild it
+        return table
+
+    def _save(self, path, table):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write a new file and swap it in, so other processes (e.g.
+            # sharded workers) never read half a file:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    numpy.savez(f, table=table, cdf_error=self.cdf_error)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError:
+            pass  # No writable cache; we'll just rebuild next time
+
+    def _on(self, xp):
+        """The table and its slope, in array namespace 'xp'."""
+        if xp not in self._copies:
+            self._copies[xp] = (xp.asarray(self.table), xp.asarray(self.slope))
+        return self._copies[xp]
+
+    def _build(self, survival):
+        sigmas = numpy.geomspace(self.sigma_min, self.sigma_max, self.num_sigma)
+        w = numpy.linspace(0, self.w_max, self.num_w)
+        table = numpy.empty((self.num_sigma, self.num_w), 'float64')
+        for i, sigma in enumerate(sigmas):
+            table[i] = self._invert(survival, sigma, w) / self._scale(sigma)
+        return table
+
+    def _invert(self, survival, sigma, w):
+        # Beyond ~(w_max + 1)*sigma, any reasonable propagator has a
+        # survival probability far below our smallest quantile, so we
+        # don't waste grid points out there.
+        theta = numpy.linspace(0, min(numpy.pi, (self.w_max + 1) * sigma), self.num_theta)
+        s = numpy.clip(survival(theta, sigma), 0, 1)
+        s = numpy.minimum.accumulate(s)  # Enforce monotonicity despite roundoff
+        with numpy.errstate(divide='ignore'):
+            w_of_theta = numpy.sqrt(-numpy.log(s))
+        # numpy.interp needs strictly increasing coordinates; drop the
+        # flat (saturated) parts of the curve.
+        finite = numpy.isfinite(w_of_theta)
+        w_of_theta, theta = w_of_theta[finite], theta[finite]
+        keep = numpy.concatenate(([True], numpy.diff(w_of_theta) > 0))
+        return numpy.interp(w, w_of_theta[keep], theta[keep])
+
+    def _measure_error(self, survival, table):
+        # Halfway between grid points is where interpolation is worst:
+        log_sigmas = self.log_sigma_min + (numpy.arange(self.num_sigma - 1) + 0.5) * self.d_log_sigma
+        w = (numpy.arange(self.num_w - 1) + 0.5) * self.dw
+        slope = self._slope(numpy, table)
+        error = 0
+        for sigma in numpy.exp(log_sigmas):
+            theta = self._lookup(numpy, table, slope, numpy.full_like(w, sigma), w)
+            error = max(error, numpy.abs(survival(theta, sigma) - numpy.exp(-w*w)).max())
+        return float(error)
+
+    @staticmethod
+    def _slope(xp, table):
+        # Along w. It's junk at the end of each row, but we never look there.
+        return xp.diff(table, append=table[-1:])
+
+    @staticmethod
+    def _scale(sigma):
+        return sigma / (1 + sigma*sigma / 4)**0.5
+
+    def _lookup(self, xp, table, slope, sigma, w):
+        # Written with in-place operations, since this is a hot loop and
+        # we're usually limited by memory bandwidth.
+        a = xp.clip(sigma, self.sigma_min, self.sigma_max)
+        xp.log(a, out=a)
+        a -= self.log_sigma_min
+        a *= 1 / self.d_log_sigma
+        xp.clip(a, 0, self.num_sigma - 1.000001, out=a)
+        k = a.astype('int64')
+        a -= k
+        k *= self.num_w
+        b = w * (1 / self.dw)
+        xp.clip(b, 0, self.num_w - 1.000001, out=b)
+        j = b.astype('int64')
+        b -= j
+        k += j
+        r = slope[k]
+        r *= b
+        r += table[k]
+        k += self.num_w
+        r1 = slope[k]
+        r1 *= b
+        r1 += table[k]
+        r1 -= r
+        r1 *= a
+        r += r1
+        # Below sigma_min the shape is frozen, so we keep scaling:
+        r *= self._scale(xp.minimum(sigma, self.sigma_max))
+        return r
+
+    def _lookup_row(self, sigma, w):
+        # Every draw shares one step size (the common case), so we
+        # interpolate a single row of the table once, then each draw
+        # is a 1D lookup. Fewer temporaries, fewer gathers.
+        xp = namespace(w)
+        fi = (numpy.log(numpy.clip(sigma, self.sigma_min, self.sigma_max)) - self.log_sigma_min) / self.d_log_sigma
+        i = min(int(fi), self.num_sigma - 2)
+        a = fi - i
+        t = self._on(xp)[0]  # Local nickname
+        row = (1 - a) * t[i*self.num_w:(i+1)*self.num_w] + a * t[(i+1)*self.num_w:(i+2)*self.num_w]
+        row *= self._scale(min(sigma, self.sigma_max))
+        slope = self._slope(xp, row)
+        fj = w * (1 / self.dw)  # A new array we can scribble on
+        xp.clip(fj, 0, self.num_w - 1.000001, out=fj)
+        j = fj.astype('int64')
+        fj -= j
+        r = slope[j]
+        r *= fj
+        r += row[j]
+        return r
+
+    def __call__(self, sigma, w):
+        """
+        Look up displacements by bilinear interpolation.
+
+        Parameters:
+        sigma (float or array): Positive step size(s), at most sigma_max.
+                                A float means every draw shares one step size.
+        w (array): 1D array of quantile coordinates sqrt(-log(1 - u)), in any backend
+
+        Returns:
+        array: 1D array of angular displacements, in the same backend as 'w'
+        """
+        if numpy.ndim(sigma) == 0:
+            return self._lookup_row(float(sigma), w)
+        xp = namespace(sigma, w)
+        return self._lookup(xp, *self._on(xp), sigma, w)
+
+
+def cache_dir():
+    """Where tabulated propagators live between processes. Override
+    with the ROTATIONAL_DIFFUSION_CACHE environment variable."""
+    return os.environ.get(
+        'ROTATIONAL_DIFFUSION_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'rotational_diffusion'))
+
+
+def heat_kernel_survival(theta, sigma, tolerance=1e-17):
+    """
+    Probability that a molecule diffusing on a sphere turns by more than
+    'theta', after a step of size 'sigma'.
+
+    This is the exact propagator, i.e. the heat kernel on the sphere
+    written as a Legendre series in cos(theta), integrated over angle:
+
+    P(displacement > theta) = (1 + c)/2 + sum_l>=1 exp(-l(l+1)Dt) (P_l+1(c) - P_l-1(c))/2
+
+    with c = cos(theta) and Dt = sigma**2 / 4, matching the
+    convention of the Gaussian and Ghosh propagators.
+
+    Parameters:
+    theta (numpy.ndarray): 1D array of angles between 0 and pi
+    sigma (float): Step size
+    tolerance (float): Terms smaller than this are dropped from the series
+
+    Returns:
+    numpy.ndarray: 1D array of survival probabilities
+    """
+    dt = sigma**2 / 4
+    c = numpy.cos(theta)
+    result = (1 + c) / 2
+    p_prev, p = numpy.ones_like(c), c  # P_0, P_1
+    l = 1
+    while True:
+        decay = numpy.exp(-l * (l + 1) * dt)
+        if decay < tolerance:
+            break
+        p_next = ((2*l + 1) * c * p - l * p_prev) / (l + 1)  # Bonnet's recursion
+        result += decay * (p_next - p_prev) / 2
+        p_prev, p = p, p_next
+        l += 1
+    return result
+
+
+def ghosh_survival(theta, sigma, num_points=2**14):
+    """
+    Probability that a draw from the Ghosh propagator (arXiv:1303.1278)
+    exceeds 'theta', for a step of size 'sigma'.
+
+    The Ghosh density sqrt(theta*sin(theta))*exp(-theta**2/sigma**2)
+    (0 < theta < pi) has no closed-form integral, so we integrate it
+    numerically on a fine grid and interpolate.
+
+    Parameters:
+    theta (numpy.ndarray): 1D array of angles between 0 and pi
+    sigma (float): Step size
+    num_points (int): Number of grid points for the numerical integral
+
+    Returns:
+    numpy.ndarray: 1D array of survival probabilities
+    """
+    grid = numpy.linspace(0, min(numpy.pi, 8 * sigma), num_points)
+    density = numpy.sqrt(grid * numpy.sin(grid)) * numpy.exp(-(grid / sigma)**2)
+    # Integrate from the top down, so small tail probabilities don't
+    # get swamped by roundoff:
+    areas = (density[1:] + density[:-1]) / 2 * numpy.diff(grid)
+    tail = numpy.concatenate((numpy.cumsum(areas[::-1])[::-1], [0]))
+    return numpy.interp(theta, grid, tail / tail[0], right=0)
+
+
+_tables = {}  # Built (or loaded from disk) at most once per process
+
+
+def heat_kernel_table():
+    """
+    Inverse-CDF table for the exact propagator. Below 'sigma_min' the
+    Ghosh propagator is already exact to within our tolerance; above
+    'sigma_max' orientations are completely scrambled.
+    """
+    if 'heat_kernel' not in _tables:
+        _tables['heat_kernel'] = InverseCDFTable(
+            heat_kernel_survival, sigma_min=0.1, sigma_max=9, name='heat_kernel')
+    return _tables['heat_kernel']
+
+
+def ghosh_table():
+    """
+    Inverse-CDF table for the Ghosh propagator. Below 'sigma_min' the
+    shape of the propagator no longer changes, so the table's scale
+    handles smaller steps too. Above 'sigma_max' (well beyond the safe
+    step size) callers should fall back to rejection sampling.
+    """
+    if 'ghosh' not in _tables:
+        _tables['ghosh'] = InverseCDFTable(
+            ghosh_survival, sigma_min=1e-3, sigma_max=4, name='ghosh')
+    return _tables['ghosh']
@@ -0,0 +1,179 @@
+## Bulk random numbers
+# Each diffusive step makes several small calls into the random number
+# generator (uniforms for the propagator's rejection sampling, for phi,
+# exponentials for new transition times...), and each call allocates a
+# new array. When there are many short steps (e.g. 50,000 periods of a
+# photoswitching scheme) that overhead adds up. A RandomPool draws
+# uniforms and exponentials in big blocks instead, and hands out slices
+# of them; it can also draw the next block on a background thread while
+# we use the current one.
+#
+# A RandomPool has the numpy.random API we use (uniform, random,
+# exponential, choice...), so it can be passed anywhere a generator can,
+# e.g. FluorophoreCollection(..., rng=RandomPool(seed, prefetch=True)).
+# Nothing draws from a pool unless you pass it like that; the engines
+# just draw from whatever 'rng' they're given.
+# Slices are transformed in place and never handed out twice, and used
+# blocks are left alone (not refilled), so every array we return stays
+# valid for as long as you hold on to it.
+from concurrent.futures import ThreadPoolExecutor
+
+from rotational_diffusion.src import backends
+from rotational_diffusion.src.backends import namespace
+import numpy
+
+_prefetcher = None  # One background thread, shared by every pool
+
+
+def _prefetch(function, *args):
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = ThreadPoolExecutor(1, thread_name_prefix='random-prefetch')
+    return _prefetcher.submit(function, *args)
+
+
+class RandomPool:
+    """
+    A random number generator that draws uniforms and exponentials in
+    blocks of 'block_size', and hands out slices of them.
+
+    Draws bigger than a block go straight to the underlying generator.
+    A pool draws the same numbers every time for the same seed and the
+    same sequence of calls, but not the same numbers as its underlying
+    generator would on its own, and not the same numbers with and
+    without 'prefetch'. Engines only draw from a pool's slices if you
+    pass it to them as their 'rng' (see Orientations).
+
+    A prefetching pool draws from its generator on a background thread,
+    whenever it likes, so nobody else may draw from that generator
+    meanwhile, or the order of everybody's draws (and so the numbers)
+    would depend on timing. So with prefetch=True, the shared stream
+    (rng=None, or np.random itself) is only used once, to seed a
+    private generator for the pool; if you pass a generator of your
+    own, don't draw from it while the pool is in use.
+
+    Parameters:
+    rng (None, int, np.random.SeedSequence or generator): The underlying
+        generator, resolved like Backend.rng (None is np.random)
+    block_size (int): Number of draws per block, for each distribution
+    prefetch (bool): Draw the next block on a background thread?
+    backend (None, str or Backend): Which backend's generators to use
+                                    (see backends.get)
+    """
+    _kinds = ('random', 'standard_exponential')
+
+    def __init__(self, rng=None, block_size=2**20, prefetch=False, backend=None):
+        assert block_size >= 1
+        backend = backends.get(backend)
+        self.rng = backend.rng(rng)
+        if prefetch and self.rng is backend.random:  # Shared; see above
+            self.rng = backend.generator(backends.draw_seed(self.rng))
+        self.block_size = int(block_size)
+        self.prefetch = prefetch
+        # For each kind: the current block, how much of it we've used,
+        # and the next block (or a future of it, while it's prefetched)
+        self._blocks = {kind: None for kind in self._kinds}
+        self._used = {kind: 0 for kind in self._kinds}
+        self._next = {kind: None for kind in self._kinds}
+
+    def _draw_block(self, kind):
+        return getattr(self.rng, kind)(size=self.block_size)
+
+    def _wait(self):
+        # Draws must come out of the underlying generator in a fixed
+        # order, so finish the block being drawn in the background
+        # before drawing anything else from it:
+        for kind, block in self._next.items():
+            if block is not None and not hasattr(block, 'shape'):  # A future
+                self._next[kind] = block.result()
+
+    def _take(self, kind, n):
+        """'n' fresh draws of 'kind' (a 1D array we're free to modify)."""
+        if n > self.block_size:
+            self._wait()
+            return getattr(self.rng, kind)(size=n)
+        if self._blocks[kind] is None or self._used[kind] + n > self.block_size:
+            # Leave the rest of the old block (it might have slices in
+            # use) and move on to a new one:
+            block = self._next[kind]
+            if block is None:
+                self._wait()
+                block = self._draw_block(kind)
+            elif not hasattr(block, 'shape'):
+                block = block.result()
+            self._blocks[kind], self._used[kind], self._next[kind] = block, 0, None
+            if self.prefetch:
+                self._wait()
+                self._next[kind] = _prefetch(self._draw_block, kind)
+        start = self._used[kind]
+        self._used[kind] += n
+        return self._blocks[kind][start:start + n]
+
+    @staticmethod
+    def _shape(size, *params):
+        if size is None:
+            return numpy.broadcast_shapes(*(numpy.shape(p) for p in params))
+        return (size,) if numpy.ndim(size) == 0 else tuple(size)
+
+    def _draws(self, kind, shape):
+        x = self._take(kind, int(numpy.prod(shape, dtype='int64'))).reshape(shape)
+        return x if shape != () else x[()]  # Scalars for scalar calls, like numpy
+
+    def random(self, size=None):
+        """Uniform on [0, 1), like np.random.random."""
+        return self._draws('random', self._shape(size))
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        """Like np.random.uniform."""
+        shape = self._shape(size, low, high)
+        u = self._draws('random', shape)
+        if shape == ():
+            return low + (high - low) * u
+        u *= high - low  # In place; nobody else has this slice
+        u += low
+        return u
+
+    def standard_exponential(self, size=None):
+        return self._draws('standard_exponential', self._shape(size))
+
+    def exponential(self, scale=1.0, size=None):
+        """Like np.random.exponential."""
+        shape = self._shape(size, scale)
+        e = self._draws('standard_exponential', shape)
+        if shape == ():
+            return scale * e
+        e *= scale
+        return e
+
+    def choice(self, a, size=None, replace=True, p=None):
+        """Like np.random.choice; sampling without replacement goes
+        straight to the underlying generator."""
+        if not replace:
+            self._wait()
+            return self.rng.choice(a, size, replace, p)
+        n = a if numpy.ndim(a) == 0 else len(a)
+        u = self.random(size)
+        xp = namespace(u)
+        if p is None:
+            idx = xp.floor(u * n).astype('int64')
+        else:
+            cdf = xp.cumsum(xp.asarray(p, dtype='float64'))
+            idx = xp.searchsorted(cdf / cdf[-1], u, 'right')
+        idx = xp.minimum(idx, n - 1)  # In case of rounding
+        return idx if numpy.ndim(a) == 0 else xp.asarray(a)[idx]
+
+    def __getattr__(self, name):
+        # Everything else (integers, normal...) straight from the
+        # underlying generator:
+        if name.startswith('_') or name in ('rng',):
+            raise AttributeError(name)
+        self._wait()
+        return getattr(self.rng, name)
+
+    # Futures can't be copied or pickled; wait for them instead:
+    def __getstate__(self):
+        self._wait()
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
@@ -0,0 +1,97 @@
+## Per-state buckets of molecules
+# Pulses, deletions and queries all act on the molecules in one
+# electronic state, and finding them by comparing every molecule's
+# state costs a pass over the whole population, even when only a few
+# thousand triplets are left among millions of molecules. Buckets keep,
+# for each state, the indices of the molecules in it.
+#
+# Molecules never move around in the store (see MoleculeStore), so a
+# bucket is a list of indices rather than a slice. Keeping buckets
+# exact on every transition would mean finding each molecule that left
+# a state in its old bucket, so we're lazy instead: molecules that
+# enter a state are appended to its bucket, and molecules that leave
+# just mark their old bucket as stale. A stale bucket is cleaned up
+# (filtered against the current states, and deduplicated) the next
+# time somebody asks for it, which only touches that bucket. Buckets
+# nobody asks for are cleaned up once they hold more than twice the
+# population, so they can't grow with the number of transitions.
+from rotational_diffusion.src.backends import namespace
+
+
+class StateBuckets:
+    """
+    For each state number, the (sorted) indices of the molecules in it.
+
+    Parameters:
+    states (array): Every molecule's state number
+    num_states (int): Number of states; other numbers (e.g. DEAD) aren't kept
+    """
+    def __init__(self, states, num_states):
+        xp = namespace(states)
+        self.num_states = int(num_states)
+        # One sort groups everybody by state (stable, so each bucket is
+        # in storage order):
+        order = xp.argsort(states, kind='stable')
+        bounds = xp.searchsorted(states[order], xp.arange(self.num_states + 1), 'left')
+        bounds = [int(b) for b in bounds]
+        # Each bucket is a list of index arrays, joined up when needed:
+        self._buckets = [[order[start:stop]] for start, stop in zip(bounds[:-1], bounds[1:])]
+        self._stale = [False] * self.num_states  # Might hold molecules that left?
+        self._lengths = [stop - start for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def get(self, state, states):
+        """The indices of the molecules in 'state', given everybody's
+        current 'states'. Sorted, so they visit memory in order."""
+        xp = namespace(states)
+        bucket = self._buckets[state]
+        if len(bucket) == 1 and not self._stale[state]:
+            return bucket[0]
+        idx = xp.concatenate(bucket)
+        if self._stale[state]:
+            idx = idx[states[idx] == state]
+        # Molecules that left and came back are in the bucket twice:
+        idx = xp.unique(idx)
+        self._buckets[state], self._stale[state] = [idx], False
+        self._lengths[state] = len(idx)
+        return idx
+
+    def moved(self, idx, old_states, new_states, states):
+        """
+        Molecules 'idx' (indices) just went from 'old_states' to
+        'new_states' (arrays like idx, or single state numbers), and
+        'states' (everybody's) already says so.
+        """
+        xp = namespace(idx)
+        if len(idx) == 0:
+            return None
+        for state in self._present(old_states, xp):
+            self._stale[state] = True
+        if xp.ndim(new_states) == 0:
+            if int(new_states) < self.num_states:
+                self._add(int(new_states), idx, states)
+            return None
+        for state in self._present(new_states, xp):
+            self._add(state, idx[new_states == state], states)
+
+    def _add(self, state, idx, states):
+        bucket = self._buckets[state]
+        bucket.append(idx)
+        self._lengths[state] += len(idx)
+        if self._lengths[state] > 2 * len(states):  # Mostly stale or repeated
+            self.get(state, states)
+        elif len(bucket) > 64:  # Lots of little waves; join them up, without cleaning
+            self._buckets[state] = [bucket[0], namespace(idx).concatenate(bucket[1:])]
+
+    def clear(self, state):
+        """Everybody in 'state' just left it, e.g. they've been deleted."""
+        xp = namespace(self._buckets[state][0])
+        self._buckets[state], self._stale[state] = [xp.zeros(0, dtype='int64')], False
+        self._lengths[state] = 0
+
+    def _present(self, states, xp):
+        """The state numbers in 'states' that we keep buckets for."""
+        if xp.ndim(states) == 0:
+            states = [int(states)]
+        else:
+            states = xp.unique(states).tolist()
+        return [s for s in states if s < self.num_states]
@@ -0,0 +1,58 @@
+## Thread-pool execution
+# NumPy releases the GIL inside most of its elementwise kernels, and our
+# compiled kernels don't hold it at all, so we can step (and
+# photoselect) chunks of molecules concurrently in one process, with
+# no pickling or shared memory. Chunks are small enough that their
+# temporaries stay in cache.
+#
+# The global np.random isn't safe to share between threads, so each
+# chunk draws from its own generator. The generators are seeded from
+# the caller's generator (np.random by default), one per chunk (not per
+# thread, since which thread runs which chunk varies), so seeding that
+# generator still makes a threaded simulation reproducible.
+from concurrent.futures import ThreadPoolExecutor
+
+from rotational_diffusion.src.backends import draw_seed
+import numpy
+
+chunk_size = 2**14  # Molecules per chunk; ~2 MB of stepping temporaries
+
+_pools = {}  # One pool per thread count, shared by everybody
+
+
+def pool(num_threads):
+    """A (shared) pool of 'num_threads' threads."""
+    if num_threads not in _pools:
+        _pools[num_threads] = ThreadPoolExecutor(num_threads)
+    return _pools[num_threads]
+
+
+def generators(num, rng=None):
+    """'num' independent random number generators, seeded from 'rng'
+    (default np.random)."""
+    seed = numpy.random.SeedSequence(draw_seed(numpy.random if rng is None else rng))
+    return [numpy.random.default_rng(s) for s in seed.spawn(num)]
+
+
+def run(function, num_items, num_threads, rng=None):
+    """
+    Call function(s, rng) for chunks 's' (slices) of range(num_items),
+    concurrently, each with its own random number generator 'rng'.
+
+    Parameters:
+    function (callable): Called once per chunk. Chunks must not write
+                         to the same memory, which must be on the host.
+    num_items (int): Total number of items to split into chunks
+    num_threads (int): Number of threads to use
+    rng (np.random.Generator): Seeds each chunk's generator; default is np.random
+
+    Returns:
+    list: The return value of each call, in chunk order
+    """
+    chunks = [slice(start, min(start + chunk_size, num_items))
+              for start in range(0, num_items, chunk_size)]
+    if len(chunks) == 0:
+        return []
+    rngs = generators(len(chunks), rng)
+    futures = [pool(num_threads).submit(function, s, rng) for s, rng in zip(chunks, rngs)]
+    return [f.result() for f in futures]
@@ -0,0 +1,31 @@
+## Shared test fixtures
+# State graphs for the tests to simulate. Collections only read their
+# PossibleStates, so one can be shared by every collection in a test.
+import pytest
+
+from rotational_diffusion.src import fluorophore as f
+
+
+@pytest.fixture
+def two_states():
+    """Ground, and an excited state that decays back to it in 4 ns."""
+    ground = f.ElectronicState('ground')
+    excited = f.ElectronicState('excited', lifetime=4, transition_states=['ground'])
+    states = f.PossibleStates(ground)
+    states.add_state(excited)
+    return states
+
+
+@pytest.fixture
+def triplet_states():
+    """Ground, a singlet that decays in 3 ns (to the ground state, or
+    1 time in 5 to a long-lived triplet), and the triplet, like the
+    crescent scheme's fluorophore but with more triplets."""
+    ground = f.ElectronicState('ground')
+    singlet = f.ElectronicState(
+        'singlet', lifetime=3, transition_states=['ground', 'triplet'], probabilities=[0.8, 0.2])
+    triplet = f.ElectronicState('triplet', lifetime=5e5, transition_states='ground')
+    states = f.PossibleStates(ground)
+    states.add_state(singlet)
+    states.add_state(triplet)
+    return states
@@ -0,0 +1,52 @@
+## Backends
+# CI has no GPU, so we stand in for one with a backend that wraps numpy
+# in a module of its own: it's not numpy, so collections take the same
+# (non-host) paths they would on cupy, but its arrays are still numpy
+# arrays we can compare against.
+import copy
+import pickle
+import types
+
+import numpy
+
+from rotational_diffusion.src import backends, fluorophore as f
+
+xp = types.ModuleType('standin')
+xp.__getattr__ = lambda name: getattr(numpy, name)  # Everything else is numpy's
+transfers = []  # Arrays that went through the stand-in's to_host
+
+
+def standin_to_host(x):
+    transfers.append(x)
+    return numpy.asarray(x)
+
+
+standin = backends.register(backends.Backend(xp, 'standin', to_host=standin_to_host))
+
+
+def run(states, backend):
+    c = f.FluorophoreCollection(
+        2000, 100, states, backend=backend, rng=numpy.random.RandomState(5))
+    for _ in range(3):
+        c.phototransition('ground', 'excited', intensity=0.5, polarization_xyz=(1, 0, 0))
+        c.time_evolve(20)
+    return c
+
+
+def test_standin_backend(two_states):
+    assert backends.get('standin') is standin
+    assert not standin.is_host
+    c = run(two_states, 'standin')
+    assert c.backend is standin
+    # Copies and pickles find the same backend by name:
+    assert copy.deepcopy(c).backend is standin
+    assert pickle.loads(pickle.dumps(standin)) is standin
+    # Same generator, so the same answer as a plain numpy collection:
+    expected = run(two_states, 'numpy').get_xyzt_at_transitions('excited', 'ground')
+    del transfers[:]
+    xyzt = [standin.to_host(a) for a in c.get_xyzt_at_transitions('excited', 'ground')]
+    assert len(transfers) == 4
+    assert len(xyzt[3]) > 0
+    for a, b in zip(xyzt, expected):
+        assert isinstance(a, numpy.ndarray)
+        assert numpy.array_equal(a, b)
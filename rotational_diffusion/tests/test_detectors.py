@@ -0,0 +1,44 @@
+## Streaming detectors
+# A PolarizationDetector counts photons as they're emitted; fed the
+# same transitions, it should count exactly what the get_figures
+# scripts count afterwards from the recorded events.
+import numpy
+
+from rotational_diffusion.get_figures.simulation_crescent.simulation_crescent import Experiment
+from rotational_diffusion.src import fluorophore as f
+from rotational_diffusion.src.detectors import PolarizationDetector
+
+window = (30, 90)
+
+
+def run(states, detector, weighted=False):
+    c = f.FluorophoreCollection(20000, 300, states, rng=5, weighted=weighted)
+    c.attach(detector)
+    if weighted:  # So pulses weigh molecules, rather than sampling them
+        c.declare_measurements([('singlet', 'ground')], [('ground', 'singlet')] * 3)
+    for _ in range(3):
+        c.phototransition('ground', 'singlet', intensity=0.5, polarization_xyz=(0, 1, 0))
+        c.time_evolve(30)
+    return c
+
+
+def test_detector_matches_get_detector_counts(triplet_states):
+    bins = numpy.linspace(*window, 7)
+    detector = PolarizationDetector('singlet', 'ground', window, bins, rng=numpy.random.default_rng(6))
+    c = run(triplet_states, detector)
+    # The same coin flips, from an identical generator:
+    expected = Experiment.get_detector_counts(c, 'singlet', 'ground', window,
+                                              numpy.random.default_rng(6))
+    assert detector.counts() == expected
+    assert expected[3] > 1000
+    assert detector.histogram_x.sum() == expected[1]
+    assert detector.histogram_y.sum() == expected[2]
+
+
+def test_weighted_detector_matches_get_expected_counts(triplet_states):
+    detector = PolarizationDetector('singlet', 'ground', window)
+    c = run(triplet_states, detector, weighted=True)
+    assert detector.expected  # Always, for weighted collections
+    assert len(numpy.unique(c.event_log.get(1, 0)['weight'])) > 1  # singlet->ground
+    _, photons_x, photons_y = c.get_expected_counts('singlet', 'ground', window)
+    numpy.testing.assert_allclose(detector.counts()[1:3], (photons_x, photons_y), rtol=1e-12)
@@ -0,0 +1,55 @@
+## Dispatch
+# Two CPU implementations stand in for, e.g., numpy and the GPU: one
+# with a fixed cost (launch overhead), one whose cost grows with the
+# number of items. Sleeping makes their timings predictable enough to
+# know where the crossover has to be.
+import json
+import time
+
+from rotational_diffusion.src.utils import dispatch
+
+
+def fixed_cost(n):
+    return lambda: time.sleep(5e-3)
+
+
+def per_item_cost(n):
+    return lambda: time.sleep(1e-6 * n)  # 5 ms at 5000 items
+
+
+def untimeable(n):
+    raise AssertionError("Shouldn't recalibrate with a cached calibration")
+
+
+def test_crossover_and_cache(tmp_path):
+    path = str(tmp_path / 'calibration.json')
+    sizes = (10, 100, 1000, 100000)
+    d = dispatch.Dispatcher(
+        'test', {'fixed': fixed_cost, 'per_item': per_item_cost},
+        sizes=sizes, repeats=1, path=path)
+    assert d.choose(10) == 'per_item'
+    assert d.thresholds == [(10, 'per_item'), (100000, 'fixed')]
+    assert d.choose(1) == 'per_item'  # Below the smallest size
+    assert d.choose(99999) == 'per_item'
+    assert d.choose(100000) == 'fixed'
+    assert d.choose(10**7) == 'fixed'  # Beyond the largest size
+    with open(path) as f:
+        assert len(json.load(f)) == 1
+
+    # A new dispatcher for the same operation uses the saved calibration:
+    again = dispatch.Dispatcher(
+        'test', {'fixed': untimeable, 'per_item': untimeable},
+        sizes=sizes, repeats=1, path=path)
+    assert again.choose(100000) == 'fixed'
+    assert again.table == d.table
+
+
+def test_cache_path_from_environment(tmp_path, monkeypatch):
+    # Set after import, like a driver or worker process might:
+    path = tmp_path / 'elsewhere.json'
+    monkeypatch.setenv('ROTATIONAL_DIFFUSION_CALIBRATION', str(path))
+    d = dispatch.Dispatcher('test', {'fixed': fixed_cost, 'per_item': per_item_cost},
+                            sizes=(10,), repeats=1)
+    d.choose(10)
+    assert dispatch.cache_path() == str(path)
+    assert path.exists()
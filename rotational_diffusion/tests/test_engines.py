@@ -0,0 +1,38 @@
+## Engines
+# The event-driven engine (the default) and the original sorted engine
+# draw their random numbers in different orders, so they only agree in
+# distribution. Different seeds make sure we compare just that.
+import numpy
+
+from rotational_diffusion.src import fluorophore as f
+
+
+def run(states, engine, seed, n=200000):
+    c = f.FluorophoreCollection(n, 300, states, engine=engine, rng=seed)
+    c.phototransition('ground', 'singlet', intensity=2, polarization_xyz=(0, 1, 0))
+    c.time_evolve(130)
+    c.delete_fluorophores_in_state('ground')
+    c.phototransition('triplet', 'singlet', intensity=1, polarization_xyz=(1, 0, 0))
+    c.time_evolve(30)
+    return c
+
+
+def measure(c):
+    """Transition counts, ratio_xy before and after the trigger, and the
+    singlet's mean lifetime"""
+    x, y, z, t = c.get_xyzt_at_transitions('singlet', 'ground')
+    after = t > 130
+    ratio = lambda m: (x[m]**2).sum() / (y[m]**2).sum()
+    counts = (len(t), after.sum(), len(c.get_xyzt_at_transitions('singlet', 'triplet')[3]))
+    return counts, (ratio(~after), ratio(after)), t[~after].mean()
+
+
+def test_event_matches_sorted(triplet_states):
+    event = measure(run(triplet_states, 'event', seed=1))
+    sorted_ = measure(run(triplet_states, 'sorted', seed=2))
+    for a, b in zip(event[0], sorted_[0]):
+        assert abs(a - b) < 5 * numpy.sqrt(a)
+    # ~50000 photons before the trigger, ~2000 after:
+    assert abs(event[1][0] / sorted_[1][0] - 1) < 0.03
+    assert abs(event[1][1] / sorted_[1][1] - 1) < 0.15
+    assert abs(event[2] - 3) < 0.05 and abs(sorted_[2] - 3) < 0.05
@@ -0,0 +1,54 @@
+## Spilling events to disk
+# A collection with an 'event_dir' writes its events out in segments,
+# but what we read back should be exactly what an in-memory log holds,
+# whether we read it from the collection, from a copy of it, or from
+# the directory after the fact.
+import copy
+import os
+
+import numpy
+
+from rotational_diffusion.src import fluorophore as f
+from rotational_diffusion.src.utils.event_log import EventLog
+
+
+def pulse(c):
+    c.phototransition('ground', 'singlet', intensity=0.5, polarization_xyz=(0, 1, 0))
+    c.time_evolve(30)
+
+
+def assert_same_events(log, expected):
+    assert log.pairs() == expected.pairs()
+    for pair in expected.pairs():
+        a, b = log.get(*pair), expected.get(*pair)
+        assert sorted(a) == sorted(b)
+        for k in b:
+            assert numpy.array_equal(a[k], b[k])
+
+
+def test_spill_round_trip(triplet_states, tmp_path):
+    in_memory = f.FluorophoreCollection(5000, 300, triplet_states, rng=3)
+    spilling = f.FluorophoreCollection(5000, 300, triplet_states, rng=3, event_dir=str(tmp_path))
+    spilling.event_log.spill_rows = 500  # Small, so we get plenty of segments
+    for c in (in_memory, spilling):
+        pulse(c)
+        pulse(c)
+    # A copy spills to a directory of its own, and carries on from there:
+    in_memory_copy, spilling_copy = copy.deepcopy(in_memory), copy.deepcopy(spilling)
+    assert os.path.dirname(spilling_copy.event_log.directory) == str(tmp_path)
+    assert os.path.basename(spilling_copy.event_log.directory).startswith('copy-')
+    for c in (in_memory, spilling, in_memory_copy, spilling_copy):
+        pulse(c)
+    assert_same_events(spilling.event_log, in_memory.event_log)
+    assert_same_events(spilling_copy.event_log, in_memory_copy.event_log)
+    assert len(list(spilling.event_log.segments(1, 0))) > 2
+    # Counting segment by segment adds up in a different order:
+    for window in (None, (30, 60)):
+        numpy.testing.assert_allclose(
+            spilling.get_expected_counts('singlet', 'ground', window),
+            in_memory.get_expected_counts('singlet', 'ground', window), rtol=1e-12)
+    # Once everything's written out, the directories have every event:
+    for c in (spilling, spilling_copy):
+        c.event_log.flush()
+    assert_same_events(EventLog.open(str(tmp_path)), in_memory.event_log)
+    assert_same_events(EventLog.open(spilling_copy.event_log.directory), in_memory_copy.event_log)
@@ -0,0 +1,44 @@
+## Stepping kernels
+# The compiled kernel draws its random numbers one molecule at a time,
+# from numba's generator, so it only agrees with the numpy kernel in
+# distribution. Both should follow rotational diffusion from the pole:
+# <z> = exp(-t/tau) and <z^2> = (1 + 2 exp(-3t/tau)) / 3.
+import numpy
+import pytest
+
+from rotational_diffusion.src import fluorophore as f
+from rotational_diffusion.src.utils import compiled
+
+
+def diffuse(states, kernel, n=100000, tau=100):
+    c = f.FluorophoreCollection(n, tau, states, orientation_initial='polar', kernel=kernel, rng=1)
+    moments = []
+    for _ in range(4):
+        c.time_evolve(25)
+        z = c.orientations.z
+        moments.append((float(c.orientations.t[0]), z.mean(), (z**2).mean()))
+    return moments
+
+
+def ratio_xy(states, kernel):
+    c = f.FluorophoreCollection(100000, 100, states, kernel=kernel, rng=2)
+    for _ in range(5):
+        c.phototransition('ground', 'excited', intensity=0.3, polarization_xyz=(1, 0, 0))
+        c.time_evolve(20)
+    x, y, z, t = c.get_xyzt_at_transitions('excited', 'ground')
+    return (x**2).sum() / (y**2).sum()
+
+
+@pytest.mark.skipif(not compiled.available, reason="kernel='compiled' needs numba")
+def test_compiled_matches_numpy(two_states):
+    error = 5 / numpy.sqrt(100000)  # z and z^2 have a spread of at most 1
+    for kernel in ('numpy', 'compiled'):
+        for t, z, z2 in diffuse(two_states, kernel):
+            assert abs(z - numpy.exp(-t / 100)) < error
+            assert abs(z2 - (1 + 2 * numpy.exp(-3 * t / 100)) / 3) < error
+    assert abs(ratio_xy(two_states, 'compiled') / ratio_xy(two_states, 'numpy') - 1) < 0.05
+
+
+def test_default_kernel_is_numpy(two_states):
+    # So seeded runs don't depend on whether numba is installed:
+    assert f.FluorophoreCollection(10, 100, two_states).orientations.kernel == 'numpy'
@@ -0,0 +1,40 @@
+## Compact precision
+# precision='compact' keeps orientations and clocks in float32 (see
+# Orientations). Rounding may send a molecule down a slightly different
+# path, so runs needn't match the float64 ones exactly, but what we
+# measure shouldn't move beyond noise, and nobody should drift off
+# the unit sphere.
+import numpy
+
+from rotational_diffusion.src import fluorophore as f
+
+
+def run(states, precision, seed=1):
+    c = f.FluorophoreCollection(20000, 100, states, precision=precision, rng=seed)
+    for _ in range(10):
+        c.phototransition('ground', 'excited', intensity=0.3, polarization_xyz=(1, 0, 0))
+        c.time_evolve(50)
+    return c
+
+
+def ratio_xy(c):
+    x, y, z, t = c.get_xyzt_at_transitions('excited', 'ground')
+    return float((x**2).sum() / (y**2).sum())
+
+
+def norm_error(c):
+    o = c.orientations
+    x, y, z = (numpy.asarray(a, dtype='float64') for a in (o.x, o.y, o.z))
+    return float(numpy.abs(x**2 + y**2 + z**2 - 1).max())
+
+
+def test_compact_matches_double(two_states):
+    double, compact = run(two_states, 'double'), run(two_states, 'compact')
+    assert compact.orientations.x.dtype == numpy.float32
+    assert abs(ratio_xy(compact) / ratio_xy(double) - 1) < 0.02
+    assert norm_error(compact) < 1e-6  # float32 rounding, not accumulated drift
+    # Transition times come out as absolute float64 times, even though
+    # the clocks were rebased along the way:
+    t = compact.get_xyzt_at_transitions('excited', 'ground')[3]
+    assert t.dtype == numpy.float64
+    assert 0 < t.min() and 450 < t.max() <= 500
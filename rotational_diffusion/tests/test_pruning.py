@@ -0,0 +1,65 @@
+## Pruning
+# declare_measurements deletes molecules that can't reach a measured
+# transition anymore, in the middle of time_evolve. If live_states got
+# that wrong, we'd delete molecules that should have been measured,
+# and every measured ratio would quietly be biased.
+import numpy
+import pytest
+
+from rotational_diffusion.src import fluorophore as f
+
+measured = [('singlet', 'ground')]
+pulses = [('ground', 'singlet'), ('triplet', 'singlet')]  # Excite, then trigger
+
+
+def test_live_states(triplet_states):
+    live = lambda *args: triplet_states.live_states(*args).tolist()  # ground, singlet, triplet
+    # Without pulses, only singlets can still decay to the ground state:
+    assert live(measured) == [False, True, False]
+    # A trigger to come brings triplets back...
+    assert live(measured, pulses[1:]) == [False, True, True]
+    # ...and an excitation before it brings everybody back:
+    assert live(measured, pulses) == [True, True, True]
+    # Order matters: molecules excited to the singlet by the last pulse
+    # can still decay, and triplets get there by decaying first:
+    assert live(measured, pulses[::-1]) == [True, True, True]
+    # Measuring triplets instead, singlets are live as their parents:
+    assert live([('triplet', 'ground')]) == [False, True, True]
+    with pytest.raises(AssertionError):
+        live([('ground', 'singlet')])  # Not a spontaneous transition
+
+
+def run(states, declare, seed, n=200000):
+    c = f.FluorophoreCollection(n, 300, states, rng=seed)
+    if declare:
+        c.declare_measurements(measured, pulses)
+    alive = []
+    c.phototransition('ground', 'singlet', intensity=2, polarization_xyz=(0, 1, 0))
+    c.time_evolve(130)  # Singlets decay, triplets diffuse
+    alive.append(c.num_alive)
+    c.phototransition('triplet', 'singlet', intensity=1, polarization_xyz=(1, 0, 0))
+    c.time_evolve(30)
+    alive.append(c.num_alive)
+    return c, alive
+
+
+def counts(c):
+    """Decays before the trigger, decays after it, and ratio_xy after it"""
+    x, y, z, t = c.get_xyzt_at_transitions('singlet', 'ground')
+    after = t > 130
+    return ((~after).sum(), after.sum(),
+            (x[after]**2).sum() / (y[after]**2).sum())
+
+
+def test_declared_matches_undeclared(triplet_states):
+    undeclared, alive_undeclared = run(triplet_states, False, seed=1)
+    declared, alive_declared = run(triplet_states, True, seed=2)
+    assert alive_undeclared == [200000, 200000]
+    # Only the triplets are left after the excitation, and nobody at all
+    # once the last pulse's singlets have decayed:
+    assert alive_declared[0] < 0.1 * 200000
+    assert alive_declared[1] <= 10
+    # Yet we measure the same thing, within noise:
+    for a, b in zip(counts(undeclared)[:2], counts(declared)[:2]):
+        assert abs(a - b) < 5 * numpy.sqrt(a)
+    assert abs(counts(declared)[2] / counts(undeclared)[2] - 1) < 0.15
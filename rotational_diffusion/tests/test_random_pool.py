@@ -0,0 +1,35 @@
+## Random pools
+# A prefetching pool draws on a background thread. With the shared
+# stream, that mustn't make seeded runs depend on who else draws from
+# np.random, and when.
+import numpy
+
+from rotational_diffusion.src.utils.random_pool import RandomPool
+
+
+def interleaved(seed, prefetch):
+    """Draws from a pool and from np.random, taking turns."""
+    numpy.random.seed(seed)
+    pool = RandomPool(block_size=1000, prefetch=prefetch)
+    draws = []
+    for _ in range(20):
+        draws.append(pool.uniform(0, 1, 300).copy())
+        draws.append(pool.exponential(2.0, 300).copy())
+        draws.append(numpy.random.random(300))
+    return numpy.concatenate(draws)
+
+
+def test_prefetch_is_reproducible():
+    for prefetch in (False, True):
+        first = interleaved(0, prefetch)
+        for _ in range(3):
+            assert numpy.array_equal(interleaved(0, prefetch), first)
+        assert not numpy.array_equal(interleaved(1, prefetch), first)
+
+
+def test_prefetch_has_a_stream_of_its_own():
+    numpy.random.seed(0)
+    assert RandomPool(prefetch=True).rng is not numpy.random
+    assert RandomPool().rng is numpy.random
+    generator = numpy.random.default_rng(0)
+    assert RandomPool(generator, prefetch=True).rng is generator
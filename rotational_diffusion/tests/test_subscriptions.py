@@ -0,0 +1,40 @@
+## Subscriptions
+# Once somebody subscribes, _record drops every other transition before
+# gathering anything, and only keeps the subscribed fields. That must
+# not change what we do keep, or the random numbers anybody draws.
+import numpy
+
+from rotational_diffusion.src import fluorophore as f
+
+
+def run(states, subscribe=None):
+    c = f.FluorophoreCollection(20000, 300, states, rng=4)
+    if subscribe is not None:
+        subscribe(c)
+    for _ in range(3):
+        c.phototransition('ground', 'singlet', intensity=0.5, polarization_xyz=(0, 1, 0))
+        c.time_evolve(30)
+    return c
+
+
+def test_subscribe(triplet_states):
+    everything = run(triplet_states)
+    assert everything.event_log.pairs() == [(1, 0), (1, 2)]  # singlet->ground, singlet->triplet
+    x, y, z, t = everything.get_xyzt_at_transitions('singlet', 'ground')
+
+    measured = run(triplet_states, lambda c: c.subscribe('singlet', 'ground', fields=('x', 'y', 't')))
+    assert measured.event_log.pairs() == [(1, 0)]  # No singlet->triplet
+    assert len(measured.get_xyzt_at_transitions('singlet', 'triplet')[3]) == 0
+    x_, y_, z_, t_ = measured.get_xyzt_at_transitions('singlet', 'ground')
+    assert z_ is None  # Not recorded
+    for a, b in ((x_, x), (y_, y), (t_, t)):
+        assert numpy.array_equal(a, b)
+
+    # Windows are inclusive, and more of them add up:
+    windows = [(0, 30), (60, 75)]
+    gated = run(triplet_states, lambda c: c.subscribe('singlet', 'ground', windows))
+    in_window = ((t >= 0) & (t <= 30)) | ((t >= 60) & (t <= 75))
+    assert numpy.array_equal(gated.get_xyzt_at_transitions('singlet', 'ground')[3], t[in_window])
+
+    nothing = run(triplet_states, lambda c: c.subscribe('singlet', 'ground', collection_times=[]))
+    assert len(nothing.event_log) == 0
@@ -0,0 +1,65 @@
+## Weighted photoselection
+# weighted=True trades sampling who's photoselected for weighing
+# everybody by their chance of it. The expected ratio_xy shouldn't
+# change, but its noise should drop a lot. The spectral solver gives us
+# the exact expected ratio to compare both against.
+import copy
+
+import numpy
+
+from rotational_diffusion.src import fluorophore as f
+from rotational_diffusion.src.chunked import ChunkedFluorophoreCollection
+from rotational_diffusion.src.sharded import ShardedFluorophoreCollection
+from rotational_diffusion.src.spectral import SpectralFluorophoreCollection
+
+
+def expected_ratio_xy(c):
+    """Excite, trigger the triplets, and count the triggered photons,
+    the way the get_figures scripts do."""
+    if c.weighted:  # Declare the pulses, so they weigh rather than sample
+        c.declare_measurements([('singlet', 'ground')], [('ground', 'singlet'), ('triplet', 'singlet')])
+    c.phototransition('ground', 'singlet', intensity=0.5, polarization_xyz=(0, 1, 0))
+    c.time_evolve(130)
+    c.delete_fluorophores_in_state('ground')
+    c.phototransition('triplet', 'singlet', intensity=0.25, polarization_xyz=(1, 0, 0))
+    c.time_evolve(30)
+    _, photons_x, photons_y = c.get_expected_counts('singlet', 'ground', (130, 160))
+    return photons_x / photons_y
+
+
+def test_weighted_matches_unweighted(triplet_states):
+    exact = expected_ratio_xy(SpectralFluorophoreCollection(20000, 300, triplet_states))
+    seeds = range(10)
+    sampled = [expected_ratio_xy(f.FluorophoreCollection(20000, 300, triplet_states, rng=s))
+               for s in seeds]
+    weighted = [expected_ratio_xy(f.FluorophoreCollection(20000, 300, triplet_states, rng=s,
+                                                          weighted=True))
+                for s in seeds]
+    for ratios in (sampled, weighted):
+        standard_error = numpy.std(ratios) / numpy.sqrt(len(seeds))
+        assert abs(numpy.mean(ratios) - exact) < 3 * standard_error
+    # With these weak pulses, most of the noise is in who's photoselected:
+    assert numpy.std(weighted) < numpy.std(sampled) / 3
+
+
+def test_weighted_attribute(triplet_states):
+    # The scripts ask any collection whether it's weighted:
+    spectral = SpectralFluorophoreCollection(20000, 300, triplet_states)
+    assert spectral.weighted is False
+    exact = expected_ratio_xy(spectral)
+    chunked = ChunkedFluorophoreCollection(
+        20000, 300, triplet_states, chunk_size=5000, weighted=True, rng=0)
+    assert chunked.weighted is True
+    assert copy.deepcopy(chunked).weighted is True
+    assert abs(expected_ratio_xy(chunked) / exact - 1) < 0.15
+    sharded = ShardedFluorophoreCollection(
+        20000, 300, triplet_states, num_shards=2, weighted=True, rng=0)
+    sharded_copy = copy.deepcopy(sharded)
+    try:
+        assert sharded.weighted is True
+        assert sharded_copy.weighted is True
+        assert abs(expected_ratio_xy(sharded_copy) / exact - 1) < 0.15
+    finally:  # Otherwise the workers wait for garbage collection
+        sharded.close()
+        sharded_copy.close()
+    assert ChunkedFluorophoreCollection(100, 300, triplet_states).weighted is False